@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Logging
+Queued logging shared by the validator and time tracker: callers only
+enqueue records, and a background thread writes them in batches to a
+size-rotated log file
+"""
+import os
+import sys
+import queue
+import atexit
+import logging
+import logging.handlers
+
+# Configuration
+CONFIG = {
+    "log_dir": "/home/pi/arcade/logs",
+    "max_bytes": 1024 * 1024,  # Rotate a log file once it reaches this size
+    "backups": 3,              # Rotated files to keep (name.log.1 ... .3)
+    "level": logging.INFO
+}
+
+# One line per event; the runcommand hook writes the same layout
+FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# The running listener, so setup() is idempotent and can be stopped at exit
+LISTENER = {"listener": None}
+
+
+class BatchedFileHandler(logging.handlers.RotatingFileHandler):
+    """Size-rotated file handler that flushes once per batch, not per record"""
+
+    def flush(self):
+        """Leave records buffered until flush_batch()"""
+
+    def flush_batch(self):
+        """Write out buffered records"""
+        super().flush()
+
+    def close(self):
+        """Flush and close the file"""
+        self.flush_batch()
+        super().close()
+
+
+class BatchingListener(logging.handlers.QueueListener):
+    """Queue listener that flushes its handlers whenever the queue drains
+
+    A burst of records becomes one write(); nothing is fsync'd, so a slow
+    SD card can never stall the thread that logged.
+    """
+
+    def dequeue(self, block):
+        """Return the next record, flushing first if none is waiting"""
+        try:
+            return self.queue.get(block=False)
+        except queue.Empty:
+            for handler in self.handlers:
+                handler.flush_batch()
+            return self.queue.get(block=block)
+
+
+def setup(component, filename=None, stream=False):
+    """Send logging for this process through a queue to a rotated log file
+
+    component names the process in each line; filename defaults to
+    "<component>.log" in CONFIG["log_dir"]. With stream=True records are
+    echoed to stderr as well. Safe to call more than once.
+    """
+    if LISTENER["listener"] is not None:
+        return
+    path = filename or os.path.join(CONFIG["log_dir"], f"{component}.log")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    handler = BatchedFileHandler(path, maxBytes=CONFIG["max_bytes"],
+                                 backupCount=CONFIG["backups"], encoding="utf-8")
+    handler.setFormatter(logging.Formatter(FORMAT.replace("%(name)s", component), DATE_FORMAT))
+    handlers = [handler]
+    if stream:
+        echo = logging.StreamHandler(sys.stderr)
+        echo.flush_batch = echo.flush
+        echo.setFormatter(logging.Formatter("%(message)s"))
+        handlers.append(echo)
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(CONFIG["level"])
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(logging.handlers.QueueHandler(records))
+
+    listener = BatchingListener(records, *handlers)
+    listener.start()
+    LISTENER["listener"] = listener
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Write out queued records and stop the listener thread"""
+    listener = LISTENER["listener"]
+    if listener is None:
+        return
+    LISTENER["listener"] = None
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
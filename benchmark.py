@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Benchmarks
+Headless latency benchmarks for the validation screen, code store and
+time tracker, with results written as JSON
+"""
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import contextlib
+import importlib.util
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import metrics
+import prefetch
+import joystick_input
+from code_store import CodeStore
+
+MOVES = joystick_input.CONTROL_NAMES
+
+# ---------------------------------------------------------------------------
+# Headless Tk
+
+class FakeWidget:
+    """Stands in for any Tk widget or font; accepts every call and draws nothing"""
+
+    def __init__(self, *args, **kwargs):
+        self.options = dict(kwargs)
+
+    def config(self, **kwargs):
+        self.options.update(kwargs)
+
+    configure = config
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+class FakeTk(FakeWidget):
+    """Tk root whose after() timers run on a virtual clock"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.now = 0.0
+        self.ids = 0
+        self.timers = []
+        self.idle = []
+        self.cancelled = set()
+
+    def after(self, ms, func, *args):
+        self.ids += 1
+        heapq.heappush(self.timers, (self.now + ms / 1000.0, self.ids, func, args))
+        return self.ids
+
+    def after_idle(self, func, *args):
+        self.ids += 1
+        self.idle.append((self.ids, func, args))
+        return self.ids
+
+    def after_cancel(self, ident):
+        self.cancelled.add(ident)
+
+    def run_idle(self):
+        """Run every pending idle callback (a frame's worth of redraws)"""
+        while self.idle:
+            ident, func, args = self.idle.pop(0)
+            if ident not in self.cancelled:
+                func(*args)
+
+    def advance(self, seconds):
+        """Move the virtual clock forward, firing timers that fall due"""
+        end = self.now + seconds
+        while self.timers and self.timers[0][0] <= end:
+            due, ident, func, args = heapq.heappop(self.timers)
+            self.now = due
+            if ident not in self.cancelled:
+                func(*args)
+                self.run_idle()
+        self.now = end
+
+def install_fake_tk():
+    """Replace tkinter (and pygame if it is missing) before loading the UI"""
+    tk = types.ModuleType("tkinter")
+    tk.Tk = FakeTk
+    tk.Frame = tk.Label = tk.Canvas = tk.PhotoImage = FakeWidget
+    tk.X, tk.BOTH, tk.LEFT, tk.BOTTOM, tk.READABLE = "x", "both", "left", "bottom", 2
+    tk.font = types.ModuleType("tkinter.font")
+    tk.font.Font = FakeWidget
+    sys.modules["tkinter"] = tk
+    sys.modules["tkinter.font"] = tk.font
+    try:
+        import pygame
+    except ImportError:
+        sys.modules["pygame"] = types.ModuleType("pygame")
+
+def load_script(name):
+    """Import one of the hyphen-named scripts (installed with underscores)"""
+    for filename in (f"{name}.py", f"{name.replace('_', '-')}.py"):
+        path = os.path.join(HERE, filename)
+        if os.path.exists(path):
+            spec = importlib.util.spec_from_file_location(name, path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            return module
+    raise ImportError(f"Cannot find {name}.py")
+
+# ---------------------------------------------------------------------------
+# Helpers
+
+def summarize(name, samples, **params):
+    """Reduce samples (seconds) to a result record in milliseconds"""
+    ordered = sorted(s * 1000.0 for s in samples)
+    count = len(ordered)
+    return {
+        "name": name,
+        "params": params,
+        "unit": "ms",
+        "samples": count,
+        "mean": round(sum(ordered) / count, 4),
+        "p50": round(ordered[count // 2], 4),
+        "p95": round(ordered[min(count - 1, int(count * 0.95))], 4),
+        "max": round(ordered[-1], 4)
+    }
+
+def random_sequence(rng, length):
+    """Random move sequence"""
+    return [rng.choice(MOVES) for _ in range(length)]
+
+def build_store(path, size, length=8, games=50, seed=1):
+    """Create a synthetic code store with size codes spread over games"""
+    rng = random.Random(seed)
+    store = CodeStore(path)
+    batch = []
+    for i in range(size):
+        batch.append({
+            "game": f"Game {i % games}",
+            "sequence": random_sequence(rng, length),
+            "created_at": 1646092800,
+            "expires_at": 9999999999
+        })
+        if len(batch) == 50000:
+            store.add_codes(batch)
+            batch = []
+    store.add_codes(batch)
+    store.close()
+
+def synthetic_trace(sequence, gap=0.25, hold=0.1):
+    """Press and release each move of a sequence in turn"""
+    trace = []
+    for i, move in enumerate(sequence):
+        trace.append((i * gap, move, True))
+        trace.append((i * gap + hold, move, False))
+    return trace
+
+# ---------------------------------------------------------------------------
+# Benchmarks
+
+def bench_input_to_render(vs, workdir, length, rounds, trace=None):
+    """Time from an input edge to its slot being redrawn"""
+    rng = random.Random(length)
+    path = os.path.join(workdir, f"input-{length}.db")
+    store = CodeStore(path)
+    codes = [random_sequence(rng, length) for _ in range(rounds)]
+    store.add_codes({"game": "Bench", "sequence": code} for code in codes)
+    store.close()
+    vs.CONFIG["code_store"] = path
+
+    latencies = []
+    for _ in range(rounds):
+        root = FakeTk()
+        controls = joystick_input.Controls()
+        screen = vs.ValidationScreen(root, "Bench", controls=controls, on_finish=lambda result: None)
+        root.run_idle()
+        events = trace or synthetic_trace(screen.expected_sequence)
+        for seconds, control, down in events:
+            controls.clock = lambda: seconds
+            start = time.perf_counter()
+            controls.set_state(control, down)
+            root.run_idle()
+            if down:
+                latencies.append(time.perf_counter() - start)
+        screen.finish(True)
+    return summarize("input_to_render", latencies, code_length=length, trace=bool(trace))
+
+def bench_code_store(vs, workdir, size, rounds):
+    """Time load_code and mark_code_used against a database of size codes"""
+    path = os.path.join(workdir, f"codes-{size}.db")
+    build_store(path, size)
+    vs.CONFIG["code_store"] = path
+
+    loads, checks, marks = [], [], []
+    for i in range(rounds):
+        # A bare screen: only the attributes the code store calls use
+        screen = vs.ValidationScreen.__new__(vs.ValidationScreen)
+        screen.game_name = f"Game {i % 50}"
+        screen.store = None
+        screen.code_id = None
+        screen.expected_sequence = []
+        screen.user_sequence = []
+        screen.code_complete = False
+        screen.matched_code = None
+
+        start = time.perf_counter()
+        screen.load_code()
+        loads.append(time.perf_counter() - start)
+
+        for move in screen.expected_sequence:
+            screen.user_sequence.append(move)
+            start = time.perf_counter()
+            screen.check_prefix()
+            checks.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        screen.mark_code_used()
+        marks.append(time.perf_counter() - start)
+        screen.store.close()
+    return [summarize("load_code", loads, database_size=size),
+            summarize("check_prefix", checks, database_size=size),
+            summarize("mark_code_used", marks, database_size=size)]
+
+def bench_cold_start(workdir, rounds, real_tk, sdl=False, prefetch_path=None, start_delay=None):
+    """Time from spawning the validator to its first frame
+
+    With prefetch_path, that file is evicted and prefetched alongside, as
+    the hook does with the ROM, to show what the prefetch costs the screen.
+    """
+    path = os.path.join(workdir, "cold.db")
+    store = CodeStore(path)
+    rng = random.Random(0)
+    store.add_codes({"game": "Bench", "sequence": random_sequence(rng, 8)} for _ in range(100))
+    store.close()
+
+    samples = []
+    for _ in range(rounds):
+        command = [sys.executable, os.path.abspath(__file__), "--cold-start-child", path]
+        if real_tk:
+            command.append("--real-tk")
+        if sdl:
+            command.append("--sdl")
+        prefetcher = None
+        if prefetch_path:
+            evict(prefetch_path)
+        start = time.perf_counter()
+        child = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if prefetch_path:
+            prefetcher = prefetch.Prefetcher([prefetch_path], start_delay=start_delay).start()
+        line = child.stdout.readline()
+        samples.append(time.perf_counter() - start)
+        child.wait()
+        if prefetcher:
+            prefetcher.cancel()
+        if line.strip() != b"ready":
+            raise RuntimeError("Cold start child failed")
+    if prefetch_path:
+        return summarize("cold_start_to_first_frame", samples, real_tk=real_tk, prefetching=True,
+                         start_delay=prefetcher.start_delay, idle_io=prefetch.CONFIG["idle_io"])
+    if sdl:
+        return summarize("cold_start_to_first_frame", samples, renderer="sdl")
+    return summarize("cold_start_to_first_frame", samples, real_tk=real_tk)
+
+def cold_start_child(path, real_tk, sdl=False):
+    """Child side of bench_cold_start"""
+    if sdl:
+        # SDL draws off-screen unless a real video driver is chosen
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    elif not real_tk:
+        install_fake_tk()
+    vs = load_script("validation_screen")
+    vs.CONFIG["code_store"] = path
+    vs.CONFIG["database"] = os.path.join(os.path.dirname(path), "missing.json")
+    joystick_input.CONFIG["device"] = None
+    joystick_input.CONFIG["device_glob"] = os.path.join(os.path.dirname(path), "no-such-device")
+    if sdl:
+        vs.CONFIG["renderer"] = "sdl"
+        vs.CONFIG["fullscreen"] = False
+    root = vs.make_root()
+    vs.screen_class()(root, "Bench", on_finish=lambda result: None)
+    if sdl:
+        root.run_idle()
+        root.present()
+    elif real_tk:
+        root.update()
+    else:
+        root.run_idle()
+    sys.__stdout__.write("ready\n")
+    sys.__stdout__.flush()
+
+def bench_tracker_exit(rounds, use_pidfd):
+    """Time from a game process dying to the tracker noticing"""
+    tt = load_script("time_tracker")
+    samples = []
+    for _ in range(rounds):
+        child = subprocess.Popen(["sleep", "60"])
+        pidfd = tt.open_pidfd(child.pid) if use_pidfd else None
+        killed = {}
+
+        def kill():
+            time.sleep(0.05)
+            killed["at"] = time.perf_counter()
+            child.kill()
+            child.wait()  # Reap so kill(pid, 0) stops seeing a zombie
+
+        thread = threading.Thread(target=kill)
+        thread.start()
+        tt.wait_for_exit(child.pid, pidfd, 60)
+        detected = time.perf_counter()
+        thread.join()
+        if pidfd is not None:
+            os.close(pidfd)
+        samples.append(detected - killed["at"])
+    mode = "pidfd" if use_pidfd else "poll"
+    return summarize("tracker_exit_detection", samples, mode=mode,
+                     poll_interval=None if use_pidfd else tt.CONFIG["poll_interval"])
+
+def make_rom(workdir, megabytes):
+    """Write a ROM-sized file of random bytes, flushed to disk"""
+    path = os.path.join(workdir, "rom.bin")
+    with open(path, "wb") as f:
+        f.write(os.urandom(1024 * 1024) * megabytes)
+        f.flush()
+        os.fsync(f.fileno())
+    return path
+
+def evict(path):
+    """Drop a file's clean pages from the page cache"""
+    fd = os.open(path, os.O_RDONLY)
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    os.close(fd)
+
+def bench_prefetch(workdir, rounds, megabytes):
+    """Time reading a ROM-sized file cold, then after the prefetcher has run
+
+    The file's pages are dropped with POSIX_FADV_DONTNEED before each
+    sample, which needs no root (unlike drop_caches) but only evicts
+    clean pages, hence the fsync.
+    """
+    path = make_rom(workdir, megabytes)
+
+    def read_all():
+        started = time.perf_counter()
+        with open(path, "rb", buffering=0) as f:
+            while f.read(1024 * 1024):
+                pass
+        return time.perf_counter() - started
+
+    cold, warm = [], []
+    for _ in range(rounds):
+        evict(path)
+        cold.append(read_all())
+        evict(path)
+        prefetch.Prefetcher([path], start_delay=0).start().thread.join()
+        warm.append(read_all())
+    return [summarize("rom_read", cold, megabytes=megabytes, prefetched=False),
+            summarize("rom_read", warm, megabytes=megabytes, prefetched=True)]
+
+# ---------------------------------------------------------------------------
+
+def compare(results, baseline_path, tolerance):
+    """Return the results whose p50 regressed beyond tolerance"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {(r["name"], json.dumps(r["params"], sort_keys=True)): r
+                for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get((result["name"], json.dumps(result["params"], sort_keys=True)))
+        if old and result["p50"] > old["p50"] * (1 + tolerance):
+            regressions.append({"name": result["name"], "params": result["params"],
+                                "baseline_p50": old["p50"], "p50": result["p50"]})
+    return regressions
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description="Arcade payment system benchmarks")
+    parser.add_argument("--sizes", default="10,1000,100000,1000000",
+                        help="comma-separated code database sizes")
+    parser.add_argument("--rounds", type=int, default=20, help="samples per benchmark")
+    parser.add_argument("--trace", help="replay this input trace instead of a synthetic one")
+    parser.add_argument("--real-tk", action="store_true",
+                        help="cold-start with real Tk (needs a display, e.g. xvfb-run)")
+    parser.add_argument("--sdl", action="store_true",
+                        help="also cold-start the SDL renderer (SDL_VIDEODRIVER defaults to dummy)")
+    parser.add_argument("--tracker-poll", action="store_true",
+                        help="also measure the kill(pid, 0) polling fallback (slow)")
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    parser.add_argument("--baseline", help="previous results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed p50 slowdown against the baseline")
+    parser.add_argument("--cold-start-child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Keep the scripts' own prints out of the JSON on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.cold_start_child:
+            cold_start_child(args.cold_start_child, args.real_tk, args.sdl)
+            return
+        report = run(args)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if report.get("regressions"):
+        sys.exit(1)
+
+def run(args):
+    """Run every benchmark and return the report"""
+
+    install_fake_tk()
+    vs = load_script("validation_screen")
+    trace = joystick_input.load_trace(args.trace) if args.trace else None
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        vs.CONFIG["database"] = os.path.join(workdir, "missing.json")
+        metrics.CONFIG["directory"] = os.path.join(workdir, "metrics")
+        for length in (8, 32):
+            results.append(bench_input_to_render(vs, workdir, length, args.rounds, trace))
+        for size in (int(s) for s in args.sizes.split(",")):
+            results.extend(bench_code_store(vs, workdir, size, args.rounds))
+        results.append(bench_cold_start(workdir, min(args.rounds, 5), args.real_tk))
+        if args.sdl:
+            results.append(bench_cold_start(workdir, min(args.rounds, 5), False, sdl=True))
+        results.extend(bench_prefetch(workdir, min(args.rounds, 5), 64))
+        # The prefetch's cost to the screen, started at once and as the hook starts it
+        for start_delay in (0, None):
+            results.append(bench_cold_start(workdir, min(args.rounds, 5), args.real_tk,
+                                            prefetch_path=os.path.join(workdir, "rom.bin"),
+                                            start_delay=start_delay))
+        results.append(bench_tracker_exit(args.rounds, True))
+        if args.tracker_poll:
+            results.append(bench_tracker_exit(3, False))
+
+    report = {
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results
+    }
+    if args.baseline:
+        report["regressions"] = compare(results, args.baseline, args.tolerance)
+    return report
+
+if __name__ == "__main__":
+    main()
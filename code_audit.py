@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Code Audit
+Cross-checks the code store against the hook, validation and tracker
+logs: redemptions nothing in the logs accounts for, codes used twice,
+sessions that ran without a code and codes that expired unsold
+"""
+import os
+import re
+import sys
+import json
+import glob
+import mmap
+import bisect
+import time
+import sqlite3
+import argparse
+import multiprocessing
+from collections import Counter, defaultdict
+import session_ledger
+from code_store import CONFIG as STORE_CONFIG, NO_EXPIRY, read_journal
+
+# Configuration
+CONFIG = {
+    "logs": [session_ledger.CONFIG["hook_log"], session_ledger.CONFIG["tracker_log"],
+             "/home/pi/arcade/logs/validation.log"],  # Each is read with its rotations
+    "chunk_bytes": 16 * 1024 * 1024,  # Log bytes per task
+    "id_ranges": 64,      # Code id ranges the store is split into
+    "slack": 10,          # Seconds a validation may be logged before its redemption
+    "match_window": 120,  # Seconds after a redemption its validation may be logged
+    "limit": 20           # Items listed per finding (--json lists all)
+}
+
+# Session ledger events plus the ones only the audit needs
+EVENTS = [
+    ("redeemed", re.compile(rb"Redeemed code (\d+) for (.*)")),
+    ("reused", re.compile(rb"Code (\d+) was already redeemed")),
+    ("skipped", re.compile(rb"Skipping validation for (.*)")),
+    ("resumed", re.compile(rb"Resuming (.*) with \d+ minutes left"))
+] + session_ledger.EVENTS
+
+
+def log_files(paths):
+    """Return every log file and its rotations, oldest first per log"""
+    files = []
+    for path in paths:
+        rotated = [name for name in glob.glob(glob.escape(path) + ".*")
+                   if name.rsplit(".", 1)[1].isdigit()]
+        rotated.sort(key=lambda name: int(name.rsplit(".", 1)[1]), reverse=True)
+        files.extend(name for name in rotated + [path] if os.path.isfile(name))
+    return files
+
+
+def log_tasks(files):
+    """Split the logs into byte ranges of about chunk_bytes"""
+    tasks = []
+    for rank, path in enumerate(files):
+        size = os.path.getsize(path)
+        for start in range(0, size, CONFIG["chunk_bytes"]):
+            tasks.append(("log", path, rank, start, min(size, start + CONFIG["chunk_bytes"])))
+    return tasks
+
+
+def code_tasks(database, now):
+    """Split the code store's ids into ranges"""
+    conn = sqlite3.connect(f"file:{database}?mode=ro", uri=True)
+    try:
+        low, high = conn.execute(
+            "SELECT MIN(low), MAX(high) FROM (SELECT MIN(id) AS low, MAX(id) AS high FROM codes "
+            "UNION ALL SELECT MIN(id), MAX(id) FROM redeemed "
+            "UNION ALL SELECT MIN(id), MAX(id) FROM expired)").fetchone()
+    finally:
+        conn.close()
+    if low is None:
+        return []
+    step = (high - low) // CONFIG["id_ranges"] + 1
+    return [("codes", database, start, start + step, now) for start in range(low, high + 1, step)]
+
+
+def scan_log(path, rank, start, end):
+    """Return the events of the lines that begin in [start, end) of path"""
+    parser = session_ledger.LineParser(EVENTS)
+    events = []
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return events
+        with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as data:
+            offset = start
+            if start and data[start - 1:start] != b"\n":
+                # The line in progress belongs to the previous range
+                offset = data.find(b"\n", start) + 1 or len(data)
+            while offset < end:
+                newline = data.find(b"\n", offset)
+                if newline < 0:
+                    newline = len(data)
+                event = parser.event(data[offset:newline])
+                if event is not None:
+                    moment, kind, fields = event
+                    events.append((moment, rank, offset, kind, fields))
+                offset = newline + 1
+    return events
+
+
+def scan_codes(database, low, high, now):
+    """Return the redemptions ((id, game, used_at)) and the unused expired
+    codes ((id, game, expires_at)) with ids in [low, high), including
+    those compaction moved out of the codes table"""
+    conn = sqlite3.connect(f"file:{database}?mode=ro", uri=True)
+    try:
+        used = conn.execute(
+            "SELECT id, game, used_at FROM codes WHERE id >= ? AND id < ? AND used = 1 "
+            "UNION ALL SELECT id, game, used_at FROM redeemed WHERE id >= ? AND id < ?",
+            (low, high, low, high)).fetchall()
+        expired = conn.execute(
+            "SELECT id, game, expires_at FROM codes "
+            "WHERE id >= ? AND id < ? AND used = 0 AND expires_at <= ? "
+            "UNION ALL SELECT id, game, expires_at FROM expired WHERE id >= ? AND id < ?",
+            (low, high, int(now), low, high)).fetchall()
+    finally:
+        conn.close()
+    return used, expired
+
+
+def run_task(task):
+    """Pool worker: scan one log range or one id range"""
+    kind, *args = task
+    if kind == "log":
+        return kind, scan_log(*args)
+    return kind, scan_codes(*args)
+
+
+def gather(database, files, workers, now):
+    """Scan the logs and the store across a process pool
+
+    Returns the log events in order, the redemptions and the unused
+    expired codes.
+    """
+    tasks = code_tasks(database, now) + log_tasks(files)
+    events, redemptions, expired = [], [], []
+    with multiprocessing.Pool(workers) as pool:
+        for kind, result in pool.imap_unordered(run_task, tasks):
+            if kind == "log":
+                events.extend(result)
+            else:
+                redemptions.extend(result[0])
+                expired.extend(result[1])
+    events.sort(key=lambda event: event[:3])
+
+    # Redemptions still in the journal are rows with used = 0; the store
+    # is only read, so the audit never changes it
+    journal = read_journal(database)
+    if journal:
+        expired = [code for code in expired if code[0] not in journal]
+        conn = sqlite3.connect(f"file:{database}?mode=ro", uri=True)
+        try:
+            rows = conn.execute(
+                f"SELECT id, game FROM codes WHERE id IN ({','.join('?' * len(journal))})",
+                list(journal)).fetchall()
+        finally:
+            conn.close()
+        redemptions.extend((code_id, game, journal[code_id]) for code_id, game in rows)
+    return events, redemptions, expired
+
+
+def audit(events, redemptions, expired):
+    """Match redemptions, validations and sessions and return the findings"""
+    window = session_ledger.CONFIG["join_window"]
+    since = events[0][0] if events else None
+
+    # Successful validations and top-ups, per game, that a redemption can
+    # account for; the hook names the game in the line before "successful"
+    permits = defaultdict(list)  # game -> [time, kind, redeemed]
+    starts = []
+    logged = Counter()           # code id -> "Redeemed code" lines
+    reuse_attempts = Counter()
+    hook_game = None
+    for moment, _, _, kind, fields in events:
+        if kind == "run":
+            hook_game = fields[0]
+        elif kind == "valid" and hook_game is not None:
+            permits[hook_game].append([moment, "validated", False])
+        elif kind == "extended":
+            permits[fields[0]].append([moment, "extended", False])
+        elif kind in ("skipped", "resumed"):
+            permits[fields[0]].append([moment, kind, True])
+        elif kind == "start":
+            starts.append((moment, fields[0]))
+        elif kind == "redeemed":
+            logged[int(fields[0])] += 1
+        elif kind == "reused":
+            reuse_attempts[int(fields[0])] += 1
+
+    # Each redemption takes the first free validation of its game logged
+    # from slack before it to match_window after it
+    by_game = defaultdict(list)
+    uses = Counter()
+    earlier = 0
+    for code_id, game, used_at in redemptions:
+        uses[code_id] += 1
+        if since is None or used_at is None or used_at < since:
+            earlier += 1  # Before the oldest log line: nothing to check against
+        else:
+            by_game[game].append((used_at, code_id))
+    orphans = []
+    for game, used in by_game.items():
+        used.sort()
+        candidates = [permit for permit in permits.get(game, ())
+                      if permit[1] in ("validated", "extended")]
+        index = 0
+        for used_at, code_id in used:
+            while index < len(candidates) and candidates[index][0] < used_at - CONFIG["slack"]:
+                index += 1
+            if index < len(candidates) and candidates[index][0] <= used_at + CONFIG["match_window"]:
+                candidates[index][2] = True
+                index += 1
+            elif not logged[code_id]:
+                orphans.append({"id": code_id, "game": game, "used_at": used_at})
+
+    # Each session takes the latest validation of its game within the
+    # join window before it; one that matched no redemption doesn't count
+    unpaid = []
+    times = {game: [permit[0] for permit in game_permits] for game, game_permits in permits.items()}
+    taken = set()
+    for moment, game in starts:
+        game_permits = permits.get(game, [])
+        found = None
+        for index in range(bisect.bisect_right(times.get(game, []), moment) - 1, -1, -1):
+            permit = game_permits[index]
+            if (game, index) in taken:
+                continue
+            if permit[0] < moment - window:
+                break
+            if permit[1] != "extended":
+                found = permit
+                taken.add((game, index))
+                break
+        if found is None:
+            unpaid.append({"game": game, "start": moment, "reason": "no validation"})
+        elif not found[2]:
+            unpaid.append({"game": game, "start": moment, "reason": "no code redeemed"})
+
+    doubles = [{"id": code_id, "store_records": uses[code_id], "log_lines": logged[code_id]}
+               for code_id in sorted(set(uses) | set(logged))
+               if uses[code_id] > 1 or logged[code_id] > 1]
+    inventory = defaultdict(lambda: [0, None])
+    for code_id, game, expires_at in expired:
+        entry = inventory[game]
+        entry[0] += 1
+        entry[1] = expires_at if entry[1] is None else min(entry[1], expires_at)
+
+    return {
+        "logs_since": since,
+        "redemptions": len(redemptions),
+        "redemptions_before_logs": earlier,
+        "sessions": len(starts),
+        "orphan_redemptions": orphans,
+        "double_uses": doubles,
+        "reuse_attempts": [{"id": code_id, "attempts": count}
+                           for code_id, count in sorted(reuse_attempts.items())],
+        "sessions_without_code": unpaid,
+        "expired_unredeemed": [{"game": game, "codes": count, "oldest_expiry": oldest}
+                               for game, (count, oldest) in sorted(inventory.items())]
+    }
+
+
+def format_time(moment):
+    """Format an epoch time for the report"""
+    if moment is None or moment >= NO_EXPIRY:
+        return "-"
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(moment))
+
+
+def print_report(report, limit):
+    """Print the findings, listing at most limit items of each"""
+    print(f"Logs from {format_time(report['logs_since'])}: {report['sessions']} sessions, "
+          f"{report['redemptions']} redemptions "
+          f"({report['redemptions_before_logs']} before the logs, not checked)")
+    sections = (
+        ("orphan_redemptions", "Redemptions with no validation in the logs",
+         lambda item: f"code {item['id']}\t{item['game']}\t{format_time(item['used_at'])}"),
+        ("double_uses", "Codes redeemed more than once",
+         lambda item: f"code {item['id']}\t{item['store_records']} in the store\t"
+                      f"{item['log_lines']} in the logs"),
+        ("reuse_attempts", "Rejected attempts to reuse a code",
+         lambda item: f"code {item['id']}\t{item['attempts']} attempts"),
+        ("sessions_without_code", "Sessions without a code",
+         lambda item: f"{item['game']}\t{format_time(item['start'])}\t{item['reason']}"),
+        ("expired_unredeemed", "Codes that expired unused",
+         lambda item: f"{item['game']}\t{item['codes']} codes\toldest {format_time(item['oldest_expiry'])}")
+    )
+    for key, title, line in sections:
+        items = report[key]
+        print(f"\n{title}: {len(items)}")
+        for item in items[:limit]:
+            print(f"  {line(item)}")
+        if len(items) > limit:
+            print(f"  ... {len(items) - limit} more")
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description="Audit the code store against the logs")
+    parser.add_argument("--db", default=STORE_CONFIG["database"], help="code store path")
+    parser.add_argument("--log", action="append", dest="logs",
+                        help="log to read with its rotations (repeatable; default: "
+                             "runcommand, validation and time_tracker logs)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes to use")
+    parser.add_argument("--json", action="store_true", help="print every finding as JSON")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"No code store at {args.db}")
+        sys.exit(1)
+    started = time.monotonic()
+    files = log_files(args.logs or CONFIG["logs"])
+    events, redemptions, expired = gather(args.db, files, args.workers, time.time())
+    report = audit(events, redemptions, expired)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report, CONFIG["limit"])
+        print(f"\nRead {len(files)} log files and {len(events)} events "
+              f"in {time.monotonic() - started:.1f} s")
+    # Non-zero for cron when something needs a look
+    if report["orphan_redemptions"] or report["double_uses"] or report["sessions_without_code"]:
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
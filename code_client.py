@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Code Client
+Uses a venue's code server (code_server.py) through a local cache, so
+a validation never waits on the network
+"""
+import os
+import sys
+import json
+import time
+import queue
+import fcntl
+import socket
+import logging
+import sqlite3
+import threading
+import http.client
+import urllib.parse
+from code_store import CodeStore, NO_EXPIRY
+
+# Configuration
+CONFIG = {
+    "server": "arcade-server.local:9102",  # host:port of code_server.py
+    "token": None,                         # Must match the server's token
+    "cabinet": socket.gethostname(),       # Reported with each redemption
+    "cache": "/home/pi/arcade/code-cache.db",  # Local copy of recently used games
+    "queue": "/home/pi/arcade/redemptions.queue",  # Redemptions not yet uploaded
+    "ttl": 120,           # Seconds before a game's cached codes are fetched again
+    "max_games": 50,      # Games kept in the cache; least recently used go first
+    "sync_interval": 30,  # Seconds between upload attempts while any are queued
+    "batch_size": 100,    # Redemptions per upload
+    "timeout": 5,         # Seconds before a request to the server gives up
+    "close_timeout": 2    # Seconds close() waits for queued uploads to go out
+}
+
+
+class ConnectionPool:
+    """Persistent HTTP/1.1 connections to the code server, reused between requests"""
+
+    def __init__(self, server=None, size=2):
+        """Remember where the server is; connections open on first use"""
+        host, _, port = (server or CONFIG["server"]).rpartition(":")
+        self.host, self.port = host, int(port)
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def request(self, method, path, body=None):
+        """Send a request and return the decoded JSON reply
+
+        Raises OSError or http.client.HTTPException when the server can't
+        be reached or answers with an error.
+        """
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=CONFIG["timeout"])
+        headers = {"Content-Type": "application/json"}
+        if CONFIG["token"]:
+            headers["X-Arcade-Token"] = CONFIG["token"]
+        try:
+            conn.request(method, path, body=None if body is None else json.dumps(body), headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            raise
+        if response.status != 200:
+            conn.close()
+            raise http.client.HTTPException(f"{method} {path}: HTTP {response.status} {data[:200]!r}")
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+            else:
+                conn.close()
+        return json.loads(data)
+
+    def close(self):
+        """Close idle connections"""
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+
+class RedemptionQueue:
+    """Redemptions waiting to be uploaded, one "<id> <used_at>" line each
+
+    Lines are appended and fsync'd under an exclusive flock, so a
+    redemption survives a crash or power cut until the server has it.
+    Uploaded lines are removed from the front of the file.
+    """
+
+    def __init__(self, path=None):
+        """Use the queue file at path"""
+        self.path = path or CONFIG["queue"]
+
+    def append(self, code_id, used_at):
+        """Queue one redemption durably"""
+        with open(self.path, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(f"{code_id} {used_at}\n".encode())
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def peek(self, limit):
+        """Return up to limit queued (id, used_at) pairs and their size in bytes"""
+        try:
+            with open(self.path, "rb") as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                data = f.read()
+        except FileNotFoundError:
+            return [], 0
+        lines = data.split(b"\n")[:-1][:limit]  # A torn last line is left for later
+        size = sum(len(line) + 1 for line in lines)
+        return [tuple(int(field) for field in line.split()) for line in lines], size
+
+    def pending(self):
+        """Return the ids of every queued redemption"""
+        entries, _ = self.peek(sys.maxsize)
+        return {code_id for code_id, _ in entries}
+
+    def drop(self, size):
+        """Remove the first size bytes (uploaded lines)"""
+        with open(self.path, "r+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(size)
+                rest = f.read()
+                f.seek(0)
+                f.write(rest)
+                f.truncate()
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def fetch_game(pool, cache, game, redemptions):
+    """Replace a game's cached codes with the server's live codes"""
+    reply = pool.request("GET", "/codes?" + urllib.parse.urlencode({"game": game}))
+    skip = redemptions.pending()
+    rows = [
+        (code["id"], game, " ".join(code["sequence"]), None,
+         code["expires_at"] or NO_EXPIRY, 0, None)
+        for code in reply["codes"] if code["id"] not in skip
+    ]
+    with cache.conn:
+        cache.conn.execute("DELETE FROM codes WHERE game = ?", (game,))
+        cache.conn.executemany("INSERT OR REPLACE INTO codes VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        cache.conn.execute("INSERT OR REPLACE INTO cache_games (game, fetched_at) VALUES (?, ?)",
+                           (game, time.time()))
+        evict(cache)
+    return len(rows)
+
+
+def evict(cache):
+    """Drop the least recently fetched games beyond max_games"""
+    stale = [game for (game,) in cache.conn.execute(
+        "SELECT game FROM cache_games ORDER BY fetched_at DESC LIMIT -1 OFFSET ?",
+        (CONFIG["max_games"],))]
+    for game in stale:
+        cache.conn.execute("DELETE FROM codes WHERE game = ?", (game,))
+        cache.conn.execute("DELETE FROM cache_games WHERE game = ?", (game,))
+
+
+def upload(pool, redemptions):
+    """Upload queued redemptions in batches; returns how many were sent"""
+    sent = 0
+    while True:
+        entries, size = redemptions.peek(CONFIG["batch_size"])
+        if not entries:
+            return sent
+        reply = pool.request("POST", "/redeem", {
+            "cabinet": CONFIG["cabinet"],
+            "redemptions": [{"id": code_id, "used_at": used_at} for code_id, used_at in entries]
+        })
+        for code_id, accepted in reply["results"].items():
+            if not accepted:
+                logging.warning(f"Code {code_id} was also redeemed on another cabinet")
+        redemptions.drop(size)
+        sent += len(entries)
+
+
+def open_cache(path=None):
+    """Open the local cache (a CodeStore keyed by the server's code ids)"""
+    cache = CodeStore(path or CONFIG["cache"])
+    cache.conn.execute("CREATE TABLE IF NOT EXISTS cache_games "
+                       "(game TEXT PRIMARY KEY, fetched_at REAL NOT NULL)")
+    return cache
+
+
+class RemoteCodeStore:
+    """The code store interface the validation screen uses, backed by a
+    venue server
+
+    Lookups and redemptions only touch the local cache and queue. A
+    background thread refetches a game once its cached codes are older
+    than the TTL, and uploads queued redemptions right after each one and
+    every sync_interval while any are left (e.g. while offline). The server
+    settles a code redeemed on two cabinets in that window in favour of
+    the first upload.
+    """
+
+    # An empty cache means no codes, not the validation screen's demo code
+    offers_demo_code = False
+
+    def __init__(self, cache_path=None, queue_path=None, server=None):
+        """Open the cache and start the sync thread"""
+        self.cache_path = cache_path or CONFIG["cache"]
+        self.cache = open_cache(self.cache_path)
+        self.redemptions = RedemptionQueue(queue_path)
+        self.pool = ConnectionPool(server)
+        self.requests = queue.Queue()
+        self.fetching = set()
+        self.thread = threading.Thread(target=self.sync_loop, name="code-sync", daemon=True)
+        self.thread.start()
+        self.requests.put(("upload", None))
+
+    def close(self):
+        """Stop the sync thread and close the cache
+
+        The thread gets close_timeout seconds to finish the uploads ahead
+        of the stop request, so a one-shot validation sends its redemption
+        before the process exits; anything it can't send in time stays
+        queued for the next sync.
+        """
+        self.requests.put(("stop", None))
+        self.thread.join(CONFIG["close_timeout"])
+        if self.thread.is_alive():
+            logging.warning("Code server upload still running; left queued for the next sync")
+        self.pool.close()
+        self.cache.close()
+
+    def refresh(self):
+        """Pick up redemptions made by other processes on this cabinet"""
+        self.cache.refresh()
+
+    def touch(self, game):
+        """Queue a background fetch of game if its cache entry is missing or stale"""
+        row = self.cache.conn.execute(
+            "SELECT fetched_at FROM cache_games WHERE game = ?", (game,)).fetchone()
+        if (row is None or time.time() - row[0] > CONFIG["ttl"]) and game not in self.fetching:
+            self.fetching.add(game)
+            self.requests.put(("fetch", game))
+
+    def fetch_pending(self, game):
+        """Check whether a background fetch of game hasn't finished yet"""
+        return game in self.fetching
+
+    def next_code(self, game, now=None):
+        """Return a cached live code for game"""
+        self.touch(game)
+        return self.cache.next_code(game, now)
+
+    def find_code(self, game, sequence, now=None):
+        """Return the cached live code for game spelled by sequence"""
+        return self.cache.find_code(game, sequence, now)
+
+    def has_prefix(self, game, moves, now=None):
+        """Check whether a cached live code for game continues moves"""
+        return self.cache.has_prefix(game, moves, now)
+
+    def max_length(self, game, now=None):
+        """Return the number of moves in game's longest cached live code"""
+        return self.cache.max_length(game, now)
+
+    def redeem(self, code_id, used_at=None):
+        """Redeem a code locally and queue it for the server"""
+        if used_at is None:
+            used_at = int(time.time())
+        if not self.cache.redeem(code_id, used_at):
+            return False
+        self.redemptions.append(code_id, used_at)
+        self.requests.put(("upload", None))
+        return True
+
+    def sync_loop(self):
+        """Serve fetch and upload requests from the validation screen"""
+        cache = open_cache(self.cache_path)  # SQLite connections stay in their thread
+        try:
+            while True:
+                try:
+                    kind, game = self.requests.get(timeout=CONFIG["sync_interval"])
+                except queue.Empty:
+                    kind, game = "idle", None
+                try:
+                    if kind == "stop":
+                        return
+                    if kind == "fetch":
+                        count = fetch_game(self.pool, cache, game, self.redemptions)
+                        logging.debug(f"Cached {count} codes for {game}")
+                    elif kind == "idle":
+                        # Nothing waits on the cache between requests
+                        try:
+                            cache.compact_if_needed()
+                        except (OSError, sqlite3.Error) as e:
+                            logging.error(f"Error compacting the code cache: {e}")
+                        upload(self.pool, self.redemptions)
+                    else:
+                        upload(self.pool, self.redemptions)
+                except (OSError, ValueError, KeyError, http.client.HTTPException) as e:
+                    logging.warning(f"Code server unavailable ({kind}): {e}")
+                finally:
+                    if kind == "fetch":
+                        self.fetching.discard(game)
+        finally:
+            cache.close()
+
+
+def main():
+    """Command line entry point"""
+    if len(sys.argv) < 2 or sys.argv[1] not in ("sync", "fetch", "status"):
+        print("Usage: python code_client.py sync | fetch <game>... | status")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    redemptions = RedemptionQueue()
+
+    if sys.argv[1] == "status":
+        entries, _ = redemptions.peek(sys.maxsize)
+        cache = open_cache()
+        try:
+            for game, fetched_at in cache.conn.execute("SELECT game, fetched_at FROM cache_games"):
+                count = sum(1 for _ in cache.live_codes(game))
+                print(f"{game}\t{count} codes\tfetched {int(time.time() - fetched_at)}s ago")
+        finally:
+            cache.close()
+        print(f"{len(entries)} redemptions waiting to upload")
+        return
+
+    pool = ConnectionPool()
+    try:
+        if sys.argv[1] == "sync":
+            print(f"Uploaded {upload(pool, redemptions)} redemptions")
+            return
+        cache = open_cache()
+        try:
+            for game in sys.argv[2:]:
+                print(f"Cached {fetch_game(pool, cache, game, redemptions)} codes for {game}")
+        finally:
+            cache.close()
+    except (OSError, http.client.HTTPException) as e:
+        print(f"Code server unavailable: {e}")
+        sys.exit(1)
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Code Generator
+Generates batches of unique codes for a game and imports them into the
+code store
+"""
+import sys
+import json
+import time
+import secrets
+import argparse
+from code_store import CONFIG as STORE_CONFIG
+from code_store import CodeStore, decode_sequence, pack_sequence, unpack_sequence
+
+
+def neighbours(packed, length):
+    """Every packed code that differs from packed in exactly one move"""
+    return {packed ^ (delta << (3 * i)) for i in range(length) for delta in range(1, 8)}
+
+
+def packed_length(packed):
+    """Number of moves in a packed sequence"""
+    return (packed.bit_length() - 1) // 3
+
+
+def generate(taken, count, length, min_distance=1):
+    """Generate count new packed codes not in (or, with min_distance 2, next to) taken
+
+    taken is updated with the new codes. Candidates are drawn as whole
+    random integers and filtered with set operations, so duplicates never
+    need a per-code comparison against the existing codes. Codes that
+    start another code, or start with one, are never drawn: entry stops
+    at the first complete code, so the longer one could not be entered.
+    """
+    prefix = 1 << (3 * length)
+    lengths = {packed_length(packed) for packed in taken}
+    shorter = sorted(other for other in lengths if other < length)
+    # The first length moves of every longer code
+    blocked = {packed >> (3 * (packed_length(packed) - length))
+               for packed in taken if packed_length(packed) > length}
+    fresh = set()
+    while len(fresh) < count:
+        wanted = count - len(fresh)
+        # Over-draw a little so one pass usually suffices
+        candidates = {prefix | secrets.randbits(3 * length) for _ in range(wanted + wanted // 8 + 16)}
+        candidates -= taken
+        candidates -= blocked
+        if shorter:
+            candidates = {packed for packed in candidates
+                          if all(packed >> (3 * (length - other)) not in taken for other in shorter)}
+        if min_distance >= 2:
+            for packed in candidates:
+                if len(fresh) >= count:
+                    break
+                if neighbours(packed, length).isdisjoint(taken):
+                    fresh.add(packed)
+                    taken.add(packed)
+            continue
+        for packed in candidates:
+            if len(fresh) >= count:
+                break
+            fresh.add(packed)
+        taken |= fresh
+    return fresh
+
+
+def occupied(taken, length):
+    """How many length-move codes taken rules out (at most; longer codes
+    sharing their first moves are counted once each)"""
+    return sum(8 ** max(0, length - packed_length(packed)) for packed in taken)
+
+
+def stored_packed(store, game):
+    """Packed sequences of every code stored for game
+
+    This is the live codes plus expired ones not yet compacted away,
+    which the store's unique index of unused codes still counts as taken.
+    """
+    rows = store.conn.execute("SELECT sequence FROM codes WHERE game = ? AND used = 0", (game,))
+    return {pack_sequence(decode_sequence(row[0])) for row in rows}
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description="Generate and import codes for a game")
+    parser.add_argument("game", help="game name as shown on the validation screen")
+    parser.add_argument("count", type=int, help="number of codes to generate")
+    parser.add_argument("--length", type=int, default=8, help="moves per code")
+    parser.add_argument("--expires-in", type=float, default=365,
+                        help="days until the batch expires")
+    parser.add_argument("--batch", type=int, default=50000, help="codes per import batch")
+    parser.add_argument("--min-distance", type=int, default=1, choices=(1, 2),
+                        help="2 also rejects codes one move away from a live code")
+    parser.add_argument("--db", default=STORE_CONFIG["database"], help="code store path")
+    parser.add_argument("--export", help="also write the new codes to this JSON file")
+    args = parser.parse_args()
+
+    # Keep the code space at most half full so random draws stay cheap
+    capacity = 8 ** args.length // 2
+    if args.min_distance >= 2:
+        capacity //= 7 * args.length + 1
+    store = CodeStore(args.db)
+    try:
+        taken = stored_packed(store, args.game)
+        if occupied(taken, args.length) + args.count > capacity:
+            print(f"Not enough {args.length}-move codes left for {args.count} more")
+            sys.exit(1)
+
+        created_at = int(time.time())
+        expires_at = created_at + int(args.expires_in * 86400)
+        exported = []
+        remaining = args.count
+        while remaining > 0:
+            fresh = generate(taken, min(args.batch, remaining), args.length, args.min_distance)
+            codes = [
+                {
+                    "game": args.game,
+                    "sequence": unpack_sequence(packed),
+                    "created_at": created_at,
+                    "expires_at": expires_at,
+                    "used": False
+                }
+                for packed in fresh
+            ]
+            store.add_codes(codes)
+            if args.export:
+                exported.extend(codes)
+            remaining -= len(codes)
+            print(f"Imported {args.count - remaining}/{args.count} codes for {args.game}")
+    finally:
+        store.close()
+
+    if args.export:
+        with open(args.export, 'w') as f:
+            json.dump(exported, f, indent=2)
+        print(f"Wrote {len(exported)} codes to {args.export}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Code Server
+Serves one venue's code store to every cabinet, so a code sold at the
+counter works on any machine and can only be redeemed once
+"""
+import sys
+import json
+import time
+import logging
+import sqlite3
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from code_store import CodeStore
+
+# Configuration
+CONFIG = {
+    "database": "/home/pi/arcade/server/codes.db",  # The venue's code store
+    "port": 9102,
+    "token": None,  # Shared secret cabinets must send (X-Arcade-Token), or None
+    "compact_interval": 300  # Seconds between checks for a journal worth compacting
+}
+
+
+class CodeRequestHandler(BaseHTTPRequestHandler):
+    """JSON API used by code_client.RemoteCodeStore
+
+    GET  /codes?game=<name>  -> {"time": now, "codes": [{"id", "sequence", "expires_at"}]}
+    POST /redeem {"cabinet": name, "redemptions": [{"id", "used_at"}]}
+                             -> {"results": {"<id>": true if redeemed by this request}}
+
+    HTTP/1.1, so each cabinet keeps one connection open. Every handler
+    thread opens its own CodeStore; the store's journal lock makes
+    redemption first-come-first-served across them.
+    """
+
+    protocol_version = "HTTP/1.1"
+    stores = threading.local()
+
+    def store(self):
+        """Return this thread's code store"""
+        if getattr(self.stores, "store", None) is None:
+            self.stores.store = CodeStore(self.server.database)
+        return self.stores.store
+
+    def send_json(self, status, body):
+        """Send a JSON response, keeping the connection open"""
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def authorized(self):
+        """Check the shared token, answering 403 if it is wrong"""
+        if CONFIG["token"] and self.headers.get("X-Arcade-Token") != CONFIG["token"]:
+            self.send_json(403, {"error": "bad token"})
+            return False
+        return True
+
+    def do_GET(self):
+        """Return the live codes for a game"""
+        if not self.authorized():
+            return
+        url = urlsplit(self.path)
+        game = parse_qs(url.query).get("game", [None])[0]
+        if url.path != "/codes" or not game:
+            self.send_json(404, {"error": "use /codes?game=<name>"})
+            return
+        now = time.time()
+        codes = [
+            {"id": code["id"], "sequence": code["sequence"], "expires_at": code.get("expires_at")}
+            for code in self.store().live_codes(game, now)
+        ]
+        self.send_json(200, {"time": now, "codes": codes})
+
+    def do_POST(self):
+        """Redeem a batch of codes"""
+        if not self.authorized():
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.path != "/redeem":
+            self.send_json(404, {"error": "unknown path"})
+            return
+        try:
+            message = json.loads(body)
+            redemptions = [(int(redemption["id"]), redemption.get("used_at"))
+                           for redemption in message["redemptions"]]
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        store = self.store()
+        results = {}
+        for code_id, used_at in redemptions:
+            results[str(code_id)] = store.redeem(code_id, used_at)
+            if not results[str(code_id)]:
+                logging.warning(f"Code {code_id} from {message.get('cabinet')} was already redeemed")
+        self.send_json(200, {"results": results})
+
+    def log_message(self, format, *args):
+        """Log requests at debug level only"""
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+def compact_loop(database, stop):
+    """Compact the store in the background until stop is set
+
+    Redemptions only append to the journal, so requests never wait on a
+    compaction.
+    """
+    store = CodeStore(database)
+    try:
+        while not stop.wait(CONFIG["compact_interval"]):
+            try:
+                removed = store.compact_if_needed()
+                if removed:
+                    logging.info(f"Compacted {database}, removed {removed} codes")
+            except (OSError, sqlite3.Error) as e:
+                logging.error(f"Error compacting {database}: {e}")
+    finally:
+        store.close()
+
+
+def make_server(port=None, database=None, host=""):
+    """Create (but don't start) the server"""
+    server = ThreadingHTTPServer((host, CONFIG["port"] if port is None else port), CodeRequestHandler)
+    server.daemon_threads = True
+    server.database = database or CONFIG["database"]
+    return server
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description="Serve a venue's codes to its cabinets")
+    parser.add_argument("--port", type=int, default=CONFIG["port"])
+    parser.add_argument("--database", default=CONFIG["database"],
+                        help="code store (fill it with code_store.py import)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    CodeStore(args.database).close()  # Create it up front
+    server = make_server(args.port, args.database)
+    stop = threading.Event()
+    threading.Thread(target=compact_loop, args=(args.database, stop),
+                     name="compact", daemon=True).start()
+    print(f"Serving {args.database} on port {server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
+    finally:
+        stop.set()
+
+
+if __name__ == "__main__":
+    main()
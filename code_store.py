@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Code Store
+Indexed SQLite storage for payment codes, importable from codes.json
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import logging
+import sqlite3
+
+# Configuration
+CONFIG = {
+    "database": "/home/pi/arcade/codes.db",   # Indexed code store
+    "json_database": "/home/pi/arcade/codes.json",  # Legacy JSON database
+    "compact_threshold": 1000   # Journal records before automatic compaction
+}
+
+# Codes without an expiry are stored with this value so that every
+# lookup stays a single range scan on the (game, used, expires_at) index
+NO_EXPIRY = 2 ** 62
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS codes (
+    id INTEGER PRIMARY KEY,
+    game TEXT NOT NULL,
+    sequence TEXT NOT NULL,
+    created_at INTEGER,
+    expires_at INTEGER NOT NULL,
+    used INTEGER NOT NULL DEFAULT 0,
+    used_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS codes_live ON codes (game, used, expires_at);
+DROP INDEX IF EXISTS codes_sequence;
+CREATE UNIQUE INDEX IF NOT EXISTS codes_live_sequence ON codes (game, sequence) WHERE used = 0;
+CREATE INDEX IF NOT EXISTS codes_expiry ON codes (expires_at);
+CREATE INDEX IF NOT EXISTS codes_live_length ON codes (game, LENGTH(sequence) - LENGTH(REPLACE(sequence, ' ', ''))) WHERE used = 0;
+CREATE TABLE IF NOT EXISTS redeemed (
+    id INTEGER PRIMARY KEY,
+    game TEXT NOT NULL,
+    sequence TEXT NOT NULL,
+    created_at INTEGER,
+    expires_at INTEGER NOT NULL,
+    used_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS expired (
+    id INTEGER PRIMARY KEY,
+    game TEXT NOT NULL,
+    sequence TEXT NOT NULL,
+    created_at INTEGER,
+    expires_at INTEGER NOT NULL
+);
+"""
+
+COLUMNS = "id, game, sequence, created_at, expires_at, used, used_at"
+
+
+# The move alphabet; packed codes use 3 bits per move in this order
+MOVES = ("UP", "DOWN", "LEFT", "RIGHT", "A", "B", "X", "Y")
+MOVE_BITS = {move: i for i, move in enumerate(MOVES)}
+
+
+def pack_sequence(sequence):
+    """Pack a move list into an int, 3 bits per move
+
+    A leading 1 bit keeps sequences of different lengths distinct
+    (UP is 0b1000, UP UP is 0b1000000).
+    """
+    packed = 1
+    for move in sequence:
+        packed = (packed << 3) | MOVE_BITS[move]
+    return packed
+
+
+def unpack_sequence(packed):
+    """Unpack an int made by pack_sequence"""
+    moves = []
+    while packed > 1:
+        moves.append(MOVES[packed & 7])
+        packed >>= 3
+    moves.reverse()
+    return moves
+
+
+def parse_journal(data, redeemed):
+    """Add the "<id> <used_at>" records in data to redeemed
+
+    Returns the length of the complete records; anything after them is
+    a torn write from a crash and was never acknowledged.
+    """
+    end = data.rfind(b"\n") + 1
+    for line in data[:end].splitlines():
+        if line.startswith(b"#"):
+            continue
+        try:
+            code_id, used_at = line.split()
+            redeemed[int(code_id)] = int(used_at)
+        except ValueError:
+            continue
+    return end
+
+
+def read_journal(path):
+    """Return the redemptions (id -> used_at) journaled for the store at path"""
+    redeemed = {}
+    try:
+        journal = open(path + ".journal", 'rb')
+    except FileNotFoundError:
+        return redeemed
+    with journal:
+        fcntl.flock(journal, fcntl.LOCK_SH)
+        try:
+            parse_journal(journal.read(), redeemed)
+        finally:
+            fcntl.flock(journal, fcntl.LOCK_UN)
+    return redeemed
+
+
+def encode_sequence(sequence):
+    """Encode a move list for storage"""
+    return " ".join(sequence)
+
+
+def decode_sequence(text):
+    """Decode a stored move list"""
+    return text.split() if text else []
+
+
+class CodeStore:
+    """Code database indexed by game and expiry
+
+    The SQLite file is only rewritten by compact(). Redemptions are
+    appended to a journal next to it ("<id> <used_at>" per line, fsync'd
+    under an exclusive flock) and replayed whenever the store is opened
+    or a redemption is attempted. Each compaction starts the journal
+    over with a new "#<generation>" header line.
+    """
+
+    def __init__(self, path):
+        """Open (and create if needed) the code store at path"""
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+        # Redemptions not yet folded into the database (id -> used_at)
+        self.redeemed = {}
+        self.journal_offset = 0
+        self.generation = b""
+        self.refresh()
+
+    def refresh(self):
+        """Pick up redemptions journaled by other processes"""
+        with open(self.journal_path, 'a+b') as journal:
+            fcntl.flock(journal, fcntl.LOCK_SH)
+            try:
+                self._replay(journal)
+            finally:
+                fcntl.flock(journal, fcntl.LOCK_UN)
+
+    def close(self):
+        """Close the database connection"""
+        self.conn.close()
+
+    def _replay(self, journal):
+        """Apply journal records written since the last replay
+
+        Returns the offset just past the last complete record; anything
+        after it is a torn write from a crash and was never acknowledged.
+        """
+        # Compaction restarts the journal under a new generation header
+        header = os.pread(journal.fileno(), 64, 0)
+        generation = header.split(b"\n", 1)[0] if header.startswith(b"#") else b""
+        if generation != self.generation:
+            self.generation = generation
+            self.redeemed = {}
+            self.journal_offset = 0
+        journal.seek(self.journal_offset)
+        self.journal_offset += parse_journal(journal.read(), self.redeemed)
+        return self.journal_offset
+
+    def _record(self, row):
+        """Convert a database row into a code record"""
+        code_id, game, sequence, created_at, expires_at, used, used_at = row
+        if code_id in self.redeemed:
+            used, used_at = 1, self.redeemed[code_id]
+        record = {
+            "id": code_id,
+            "game": game,
+            "sequence": decode_sequence(sequence),
+            "created_at": created_at,
+            "used": bool(used)
+        }
+        if expires_at != NO_EXPIRY:
+            record["expires_at"] = expires_at
+        if used_at is not None:
+            record["used_at"] = used_at
+        return record
+
+    def next_code(self, game, now=None):
+        """Return the unused, unexpired code for game that expires soonest"""
+        if now is None:
+            now = time.time()
+        self.refresh()
+        cursor = self.conn.execute(
+            f"SELECT {COLUMNS} FROM codes "
+            "WHERE game = ? AND used = 0 AND expires_at > ? "
+            "ORDER BY expires_at",
+            (game, int(now))
+        )
+        # Skip codes redeemed since the last compaction
+        for row in cursor:
+            if row[0] not in self.redeemed:
+                return self._record(row)
+        return None
+
+    def live_codes(self, game, now=None):
+        """Yield every unused, unexpired code for game"""
+        if now is None:
+            now = time.time()
+        self.refresh()
+        cursor = self.conn.execute(
+            f"SELECT {COLUMNS} FROM codes "
+            "WHERE game = ? AND used = 0 AND expires_at > ?",
+            (game, int(now))
+        )
+        for row in cursor:
+            if row[0] not in self.redeemed:
+                yield self._record(row)
+
+    def find_code(self, game, sequence, now=None):
+        """Return the live code for game whose sequence is exactly sequence"""
+        if now is None:
+            now = time.time()
+        self.refresh()
+        row = self.conn.execute(
+            f"SELECT {COLUMNS} FROM codes "
+            "WHERE game = ? AND sequence = ? AND used = 0 AND expires_at > ?",
+            (game, encode_sequence(sequence), int(now))
+        ).fetchone()
+        if row and row[0] not in self.redeemed:
+            return self._record(row)
+        return None
+
+    def has_prefix(self, game, moves, now=None):
+        """Check whether any live code for game starts with moves and is longer
+
+        This is a range scan on the (game, sequence) index of unused
+        codes: stored sequences are space separated and no move name is a
+        prefix of another, so codes continuing "UP A" sort between "UP A "
+        and "UP A!". Redeemed codes still in the journal and expired ones
+        are skipped until the next compaction removes them.
+        """
+        if now is None:
+            now = time.time()
+        self.refresh()
+        prefix = encode_sequence(moves)
+        cursor = self.conn.execute(
+            "SELECT id FROM codes INDEXED BY codes_live_sequence "
+            "WHERE game = ? AND sequence >= ? AND sequence < ? "
+            "AND used = 0 AND expires_at > ?",
+            (game, prefix + " ", prefix + "!", int(now))
+        )
+        for (code_id,) in cursor:
+            if code_id not in self.redeemed:
+                return True
+        return False
+
+    def max_length(self, game, now=None):
+        """Return the number of moves in game's longest live code (0 if none)
+
+        Walks the (game, spaces in sequence) index down from the longest
+        code to the first live one.
+        """
+        if now is None:
+            now = time.time()
+        self.refresh()
+        cursor = self.conn.execute(
+            "SELECT id, expires_at, LENGTH(sequence) - LENGTH(REPLACE(sequence, ' ', '')) AS spaces "
+            "FROM codes INDEXED BY codes_live_length WHERE game = ? AND used = 0 ORDER BY spaces DESC",
+            (game,)
+        )
+        for code_id, expires_at, spaces in cursor:
+            if expires_at > now and code_id not in self.redeemed:
+                return spaces + 1
+        return 0
+
+    def redeem(self, code_id, used_at=None):
+        """Mark a code as used, returning False if it was already redeemed"""
+        if used_at is None:
+            used_at = int(time.time())
+        with open(self.journal_path, 'r+b') as journal:
+            # Exclusive lock so two validators can't redeem the same code
+            fcntl.flock(journal, fcntl.LOCK_EX)
+            try:
+                end = self._replay(journal)
+                if code_id in self.redeemed:
+                    return False
+                row = self.conn.execute(
+                    "SELECT used FROM codes WHERE id = ?", (code_id,)
+                ).fetchone()
+                if row is None or row[0]:
+                    return False
+
+                # Drop any torn record before appending ours
+                journal.truncate(end)
+                journal.seek(end)
+                record = f"{code_id} {used_at}\n".encode()
+                journal.write(record)
+                journal.flush()
+                os.fsync(journal.fileno())
+                self.redeemed[code_id] = used_at
+                self.journal_offset = end + len(record)
+                return True
+            finally:
+                fcntl.flock(journal, fcntl.LOCK_UN)
+
+    def compact(self, now=None):
+        """Fold the journal into the database and drop used or expired codes
+
+        Redeemed codes are moved to the redeemed table and unused expired
+        ones to the expired table, so they stay available for export and
+        auditing. Returns the number of codes removed from the live table.
+        """
+        if now is None:
+            now = time.time()
+        with open(self.journal_path, 'r+b') as journal:
+            fcntl.flock(journal, fcntl.LOCK_EX)
+            try:
+                self._replay(journal)
+                with self.conn:
+                    self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS journal "
+                                      "(id INTEGER PRIMARY KEY, used_at INTEGER)")
+                    self.conn.execute("DELETE FROM temp.journal")
+                    self.conn.executemany("INSERT OR REPLACE INTO temp.journal VALUES (?, ?)",
+                                          self.redeemed.items())
+                    self.conn.execute(
+                        "UPDATE codes SET used = 1, used_at = "
+                        "(SELECT used_at FROM temp.journal WHERE temp.journal.id = codes.id) "
+                        "WHERE id IN (SELECT id FROM temp.journal)"
+                    )
+                    self.conn.execute(
+                        "INSERT OR IGNORE INTO redeemed "
+                        "SELECT id, game, sequence, created_at, expires_at, used_at "
+                        "FROM codes WHERE used = 1"
+                    )
+                    self.conn.execute(
+                        "INSERT OR IGNORE INTO expired "
+                        "SELECT id, game, sequence, created_at, expires_at "
+                        "FROM codes WHERE used = 0 AND expires_at <= ?",
+                        (int(now),)
+                    )
+                    removed = self.conn.execute(
+                        "DELETE FROM codes WHERE used = 1 OR expires_at <= ?",
+                        (int(now),)
+                    ).rowcount
+
+                # The database now holds every journaled redemption
+                self.generation = f"#{time.time_ns()}".encode()
+                journal.truncate(0)
+                journal.seek(0)
+                journal.write(self.generation + b"\n")
+                journal.flush()
+                os.fsync(journal.fileno())
+                self.redeemed = {}
+                self.journal_offset = len(self.generation) + 1
+                return removed
+            finally:
+                fcntl.flock(journal, fcntl.LOCK_UN)
+
+    def compact_if_needed(self, now=None):
+        """Compact once the journal holds enough records to be worth it,
+        or once any code has expired"""
+        if now is None:
+            now = time.time()
+        if len(self.redeemed) >= CONFIG["compact_threshold"]:
+            return self.compact(now)
+        oldest = self.conn.execute("SELECT MIN(expires_at) FROM codes").fetchone()[0]
+        if oldest is not None and oldest <= now:
+            return self.compact(now)
+        return 0
+
+    def add_codes(self, codes, now=None):
+        """Insert code records, returning how many were added
+
+        A sequence only has to be unique among a game's unused codes, so
+        a new code may repeat a redeemed one. Unused codes repeating a
+        live sequence are skipped and reported, and so are live codes that
+        continue another live code of the same game, or that one
+        continues: entry would always stop at the shorter code.
+        """
+        if now is None:
+            now = time.time()
+        if self.redeemed:
+            # Fold pending redemptions in so their codes count as used
+            self.compact()
+        rows = []
+        for code in codes:
+            rows.append((
+                len(rows),
+                code["game"],
+                encode_sequence(code.get("sequence", [])),
+                code.get("created_at"),
+                code.get("expires_at", NO_EXPIRY),
+                1 if code.get("used", False) else 0,
+                code.get("used_at")
+            ))
+
+        # Among the new live codes, sorted, a code's prefixes come just
+        # before it (everything between them continues the prefix too)
+        live = sorted((row[1], row[2], row[0]) for row in rows if not row[5] and row[4] > now)
+        continuing, prefixes, last = [], [], None
+        for game, sequence, index in live:
+            if last is not None and last[0] == game and sequence.startswith(last[1] + " "):
+                continuing.append((index,))
+                continue
+            last = (game, sequence)
+            moves = decode_sequence(sequence)
+            prefixes.extend((index, game, encode_sequence(moves[:length]))
+                            for length in range(1, len(moves)))
+
+        with self.conn:
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS incoming "
+                              "(id INTEGER PRIMARY KEY, game, sequence, created_at, expires_at, used, used_at)")
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS prefixes (id, game, sequence)")
+            self.conn.execute("DELETE FROM temp.incoming")
+            self.conn.execute("DELETE FROM temp.prefixes")
+            self.conn.executemany("INSERT INTO temp.incoming VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.executemany("INSERT INTO temp.prefixes VALUES (?, ?, ?)", prefixes)
+
+            # New codes continuing a live code, or continued by one
+            overlapping = self.conn.execute(
+                "SELECT id FROM temp.prefixes AS new WHERE EXISTS (SELECT 1 FROM codes "
+                "WHERE codes.game = new.game AND codes.sequence = new.sequence "
+                "AND used = 0 AND expires_at > ?) "
+                "UNION SELECT id FROM temp.incoming AS new WHERE used = 0 AND expires_at > ? "
+                "AND EXISTS (SELECT 1 FROM codes INDEXED BY codes_live_sequence "
+                "WHERE codes.game = new.game AND codes.sequence >= new.sequence || ' ' "
+                "AND codes.sequence < new.sequence || '!' AND used = 0 AND expires_at > ?)",
+                (int(now), int(now), int(now))
+            ).fetchall() + continuing
+            if overlapping:
+                game, sequence = self.conn.execute(
+                    "SELECT game, sequence FROM temp.incoming WHERE id = ?", overlapping[0]).fetchone()
+                self.conn.executemany("DELETE FROM temp.incoming WHERE id = ?", overlapping)
+                logging.warning(f"Skipped {len(overlapping)} codes that continue or are continued "
+                                f"by another live code (e.g. {game}: {sequence})")
+
+            conflicts = self.conn.execute(
+                "SELECT game, sequence, COUNT(*) FROM temp.incoming AS new WHERE used = 0 "
+                "GROUP BY game, sequence HAVING COUNT(*) > 1 OR EXISTS (SELECT 1 FROM codes "
+                "WHERE codes.game = new.game AND codes.sequence = new.sequence AND used = 0)"
+            ).fetchall()
+            before = self.conn.total_changes
+            self.conn.execute(
+                "INSERT OR IGNORE INTO codes "
+                "(game, sequence, created_at, expires_at, used, used_at) "
+                "SELECT game, sequence, created_at, expires_at, used, used_at "
+                "FROM temp.incoming ORDER BY id"
+            )
+            added = self.conn.total_changes - before
+        if conflicts:
+            game, sequence, _ = conflicts[0]
+            skipped = len(rows) - len(overlapping) - added
+            logging.warning(f"Skipped {skipped} codes repeating a live code's "
+                            f"sequence ({len(conflicts)} sequences, e.g. {game}: {sequence})")
+        return added
+
+    def import_json(self, json_path):
+        """Import codes from a codes.json file"""
+        with open(json_path, 'r') as f:
+            codes = json.load(f)
+        return self.add_codes(codes)
+
+    def export_json(self, json_path):
+        """Write every stored code back out in the codes.json format"""
+        codes = []
+        rows = self.conn.execute(
+            f"SELECT {COLUMNS} FROM codes "
+            "UNION ALL SELECT id, game, sequence, created_at, expires_at, 1, used_at "
+            "FROM redeemed UNION ALL SELECT id, game, sequence, created_at, expires_at, 0, NULL "
+            "FROM expired ORDER BY id"
+        )
+        for row in rows:
+            record = self._record(row)
+            del record["id"]
+            codes.append(record)
+        with open(json_path, 'w') as f:
+            json.dump(codes, f, indent=2)
+        return len(codes)
+
+
+def open_code_store(path=None, json_path=None):
+    """Open the code store, importing the legacy JSON database on first use"""
+    path = path or CONFIG["database"]
+    json_path = json_path or CONFIG["json_database"]
+
+    is_new = not os.path.exists(path)
+    store = CodeStore(path)
+    if is_new and os.path.exists(json_path):
+        count = store.import_json(json_path)
+        logging.info(f"Imported {count} codes from {json_path}")
+    return store
+
+
+def main():
+    """Command line entry point"""
+    if len(sys.argv) >= 2 and sys.argv[1] == "compact":
+        db_path = sys.argv[2] if len(sys.argv) > 2 else CONFIG["database"]
+        store = CodeStore(db_path)
+        try:
+            removed = store.compact()
+            print(f"Compacted {db_path}, removed {removed} used or expired codes")
+        finally:
+            store.close()
+        return
+
+    if len(sys.argv) < 3 or sys.argv[1] not in ("import", "export"):
+        print("Usage: python code_store.py import|export <codes.json> [codes.db]")
+        print("       python code_store.py compact [codes.db]")
+        sys.exit(1)
+
+    command = sys.argv[1]
+    json_path = sys.argv[2]
+    db_path = sys.argv[3] if len(sys.argv) > 3 else CONFIG["database"]
+
+    store = CodeStore(db_path)
+    try:
+        if command == "import":
+            count = store.import_json(json_path)
+            print(f"Imported {count} codes into {db_path}")
+        else:
+            count = store.export_json(json_path)
+            print(f"Exported {count} codes to {json_path}")
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Derived Codes
+Stateless codes computed from a secret, the game name and a serial
+number, with redemptions kept in a memory-mapped bitmap
+"""
+import os
+import re
+import sys
+import hmac
+import json
+import mmap
+import fcntl
+import hashlib
+import secrets
+import argparse
+from code_store import pack_sequence, unpack_sequence
+
+# Configuration
+CONFIG = {
+    "secret": "/home/pi/arcade/codes.secret",   # Shared HMAC key (keep private)
+    "bitmap": "/home/pi/arcade/redeemed.bitmap",  # One bit per serial
+    "serial_moves": 7,   # 21 bits: 2M serials, a 256 KB bitmap
+    "tag_moves": 5       # 15 bits of HMAC tag: 1 in 32768 guesses works
+}
+
+# Any byte with a clear bit holds an unredeemed serial
+UNREDEEMED = re.compile(rb"[^\xff]")
+
+
+class DerivedCodeStore:
+    """Validates and redeems derived codes without storing any codes
+
+    A code is serial_moves moves holding the serial (scrambled per game
+    by a keyed odd multiplier and mask, so consecutive serials don't look
+    alike) followed by tag_moves moves of
+    HMAC-SHA256(secret, game, serial). Checking a code is one HMAC;
+    redeeming it sets bit `serial` in the bitmap under an exclusive flock.
+    Serials are shared by all games, so give every code sold a new one.
+
+    Offers the same lookups as code_store.CodeStore, with the serial as
+    the code id, so the validation screen can use either.
+    """
+
+    def __init__(self, secret_path=None, bitmap_path=None):
+        """Load the secret and map (creating if needed) the bitmap"""
+        with open(secret_path or CONFIG["secret"], "rb") as f:
+            self.secret = f.read().strip()
+        self.serial_bits = 3 * CONFIG["serial_moves"]
+        self.tag_bits = 3 * CONFIG["tag_moves"]
+        self.length = CONFIG["serial_moves"] + CONFIG["tag_moves"]
+        self.scrambles = {}
+
+        size = (1 << self.serial_bits) // 8
+        self.fd = os.open(bitmap_path or CONFIG["bitmap"], os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.bitmap = mmap.mmap(self.fd, size)
+
+    def close(self):
+        """Unmap the bitmap"""
+        self.bitmap.close()
+        os.close(self.fd)
+
+    def refresh(self):
+        """Nothing to do: the bitmap is shared with other processes"""
+
+    def _mac(self, *parts):
+        """HMAC-SHA256 of the NUL-joined parts as an int"""
+        message = b"\0".join(str(part).encode() for part in parts)
+        return int.from_bytes(hmac.new(self.secret, message, hashlib.sha256).digest(), "big")
+
+    def _scramble(self, game):
+        """Per-game (multiplier, inverse, mask) for the serial field"""
+        scramble = self.scrambles.get(game)
+        if scramble is None:
+            modulus = 1 << self.serial_bits
+            key = self._mac("serial", game)
+            # Odd multipliers are invertible modulo a power of two
+            multiplier = (key >> self.serial_bits) % modulus | 1
+            scramble = (multiplier, pow(multiplier, -1, modulus), key % modulus)
+            self.scrambles[game] = scramble
+        return scramble
+
+    def sequence(self, game, serial):
+        """Return the code for game and serial"""
+        tag = self._mac("tag", game, serial) & ((1 << self.tag_bits) - 1)
+        multiplier, _, mask = self._scramble(game)
+        field = (serial * multiplier) % (1 << self.serial_bits) ^ mask
+        return unpack_sequence((1 << 3 * self.length) | (field << self.tag_bits) | tag)
+
+    def _serial(self, game, moves):
+        """Recover the serial from the first serial_moves moves"""
+        field = pack_sequence(moves[:CONFIG["serial_moves"]]) ^ (1 << self.serial_bits)
+        _, inverse, mask = self._scramble(game)
+        return (field ^ mask) * inverse % (1 << self.serial_bits)
+
+    def is_redeemed(self, serial):
+        """Check the serial's bit"""
+        return bool(self.bitmap[serial >> 3] & (1 << (serial & 7)))
+
+    def _record(self, game, serial, sequence):
+        """Build a code record like CodeStore's"""
+        return {
+            "id": serial,
+            "game": game,
+            "sequence": sequence,
+            "created_at": None,
+            "used": False
+        }
+
+    def next_code(self, game, now=None):
+        """Return the code for game with the lowest unredeemed serial"""
+        match = UNREDEEMED.search(self.bitmap)
+        if match is None:
+            return None
+        index = match.start()
+        byte = self.bitmap[index]
+        serial = index * 8 + next(bit for bit in range(8) if not byte & (1 << bit))
+        return self._record(game, serial, self.sequence(game, serial))
+
+    def find_code(self, game, sequence, now=None):
+        """Return the unredeemed code for game spelled by sequence"""
+        if len(sequence) != self.length:
+            return None
+        serial = self._serial(game, sequence)
+        if self.is_redeemed(serial):
+            return None
+        expected = self.sequence(game, serial)
+        if not hmac.compare_digest(" ".join(sequence), " ".join(expected)):
+            return None
+        return self._record(game, serial, expected)
+
+    def has_prefix(self, game, moves, now=None):
+        """Check whether an unredeemed code for game starts with moves and is longer
+
+        Only the serial is checked: answering for each tag move would let
+        someone find the tag one move at a time (8 tries a move instead
+        of 32768 for the whole tag), so it is checked by find_code once
+        every move is in.
+        """
+        if len(moves) >= self.length:
+            return False
+        if len(moves) < CONFIG["serial_moves"]:
+            return True  # Every serial is a valid code
+        return not self.is_redeemed(self._serial(game, moves))
+
+    def max_length(self, game, now=None):
+        """Return the number of moves in every code"""
+        return self.length
+
+    def redeem(self, code_id, used_at=None):
+        """Set the serial's bit, returning False if it was already set"""
+        index, bit = code_id >> 3, 1 << (code_id & 7)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if self.bitmap[index] & bit:
+                return False
+            self.bitmap[index] |= bit
+            # msync just the page holding the bit
+            page = index - index % mmap.PAGESIZE
+            self.bitmap.flush(page, min(mmap.PAGESIZE, len(self.bitmap) - page))
+            return True
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def redeemed_count(self):
+        """Count redeemed serials"""
+        return bin(int.from_bytes(self.bitmap, "little")).count("1")
+
+
+def create_secret(path):
+    """Write a new random secret readable only by its owner"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(secrets.token_hex(32) + "\n")
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Issue and inspect derived codes")
+    parser.add_argument("--secret", default=CONFIG["secret"], help="secret key file")
+    parser.add_argument("--bitmap", default=CONFIG["bitmap"], help="redemption bitmap")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("init", help="create a new secret")
+    issue = commands.add_parser("issue", help="print the codes for a range of serials")
+    issue.add_argument("game", help="game name as shown on the validation screen")
+    issue.add_argument("first", type=int, help="first serial")
+    issue.add_argument("count", type=int, help="number of codes")
+    issue.add_argument("--export", help="write the codes to this JSON file instead")
+    commands.add_parser("status", help="show how many serials are redeemed")
+    args = parser.parse_args()
+
+    if args.command == "init":
+        try:
+            create_secret(args.secret)
+        except FileExistsError:
+            print(f"{args.secret} already exists")
+            sys.exit(1)
+        print(f"Wrote a new secret to {args.secret}; copy it to every cabinet")
+        return
+
+    store = DerivedCodeStore(args.secret, args.bitmap)
+    try:
+        if args.command == "status":
+            total = len(store.bitmap) * 8
+            print(f"{store.redeemed_count()} of {total} serials redeemed")
+            return
+
+        last = args.first + args.count
+        if args.first < 0 or last > 1 << store.serial_bits:
+            print(f"Serials must be between 0 and {(1 << store.serial_bits) - 1}")
+            sys.exit(1)
+        codes = [
+            {"game": args.game, "serial": serial, "sequence": store.sequence(args.game, serial)}
+            for serial in range(args.first, last)
+        ]
+    finally:
+        store.close()
+
+    if args.export:
+        with open(args.export, 'w') as f:
+            json.dump(codes, f, indent=2)
+        print(f"Wrote {len(codes)} codes to {args.export}")
+        return
+    for code in codes:
+        print(f"{code['serial']}\t{' '.join(code['sequence'])}")
+
+
+if __name__ == "__main__":
+    main()
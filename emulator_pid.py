@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Emulator PID Resolver
+Finds the emulator process that runcommand launches for a ROM
+"""
+import os
+import time
+import errno
+import logging
+import select
+import socket
+import struct
+
+# Configuration
+CONFIG = {
+    "timeout": 30,        # Seconds to wait for the emulator to start
+    "interval": 0.02,     # Seconds between /proc scans without netlink
+    "shells": ("sh", "bash", "dash")  # Wrappers that are never the emulator
+}
+
+# Netlink proc connector constants (linux/connector.h, linux/cn_proc.h)
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+NLMSG_DONE = 3
+PROC_CN_MCAST_LISTEN = 1
+PROC_EVENT_EXEC = 0x00000002
+NLMSG_HEADER = struct.Struct("=IHHII")
+CN_MSG_HEADER = struct.Struct("=IIIIHH")
+PROC_EVENT = struct.Struct("=IIQII")
+
+def read_cmdline(pid):
+    """Return the argument list of a process, or None if it is gone"""
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    return [arg.decode(errors="replace") for arg in data.split(b"\0") if arg]
+
+def parent_pid(pid):
+    """Return the parent PID of a process, or None if it is gone"""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The command name may contain spaces, so split after its closing paren
+    return int(stat[stat.rindex(b")") + 2:].split()[1])
+
+def children(pid):
+    """Return the direct children of a process"""
+    found = []
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return found
+    for tid in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                found.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return found
+
+def descendants(root_pid):
+    """Return every descendant of root_pid, nearest first"""
+    found = []
+    queue = [root_pid]
+    while queue:
+        for child in children(queue.pop(0)):
+            found.append(child)
+            queue.append(child)
+    return found
+
+def is_descendant(pid, root_pid):
+    """Check whether pid is below root_pid in the process tree"""
+    while pid and pid > 1:
+        pid = parent_pid(pid)
+        if pid == root_pid:
+            return True
+    return False
+
+def is_emulator(pid, rom, emulator):
+    """Check whether a process looks like the emulator running rom"""
+    if pid == os.getpid():
+        return False
+    cmdline = read_cmdline(pid)
+    if not cmdline:
+        return False
+    program = os.path.basename(cmdline[0])
+    if program in CONFIG["shells"] or program.startswith("python"):
+        # runcommand, the hook and launch wrappers mention the ROM too
+        return False
+    if rom and any(rom in arg for arg in cmdline[1:]):
+        return True
+    # Emulators like lr-* run as retroarch and some don't take the ROM path
+    name = "retroarch" if emulator.startswith("lr-") else emulator
+    return bool(name) and name in program
+
+def find_emulator(root_pid, rom, emulator):
+    """Return the first descendant of root_pid that is the emulator"""
+    for pid in descendants(root_pid):
+        if is_emulator(pid, rom, emulator):
+            return pid
+    return None
+
+def open_proc_connector():
+    """Subscribe to process events, or return None without CAP_NET_ADMIN"""
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_CONNECTOR)
+    except (AttributeError, OSError):
+        return None
+    try:
+        sock.bind((os.getpid(), CN_IDX_PROC))
+        op = struct.pack("=I", PROC_CN_MCAST_LISTEN)
+        cn_msg = CN_MSG_HEADER.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0, len(op), 0) + op
+        header = NLMSG_HEADER.pack(NLMSG_HEADER.size + len(cn_msg), NLMSG_DONE, 0, 0, os.getpid())
+        sock.send(header + cn_msg)
+    except OSError as e:
+        if e.errno not in (errno.EPERM, errno.EACCES, errno.EPROTONOSUPPORT):
+            logging.warning(f"Proc connector unavailable: {e}")
+        sock.close()
+        return None
+    sock.setblocking(False)
+    return sock
+
+def exec_events(sock):
+    """Yield the PIDs from queued exec events"""
+    offset = NLMSG_HEADER.size + CN_MSG_HEADER.size
+    while True:
+        try:
+            data = sock.recv(4096)
+        except BlockingIOError:
+            return
+        if len(data) < offset + PROC_EVENT.size:
+            continue
+        what, _, _, pid, tgid = PROC_EVENT.unpack_from(data, offset)
+        if what == PROC_EVENT_EXEC and pid == tgid:
+            yield pid
+
+def resolve_emulator_pid(root_pid, rom, emulator, timeout=None):
+    """Wait for the emulator started under root_pid and return its PID
+
+    With CAP_NET_ADMIN the kernel reports every exec through the proc
+    connector, so the emulator is found as soon as it execs. Otherwise
+    the process tree under root_pid is rescanned every CONFIG["interval"]
+    seconds. Returns None if nothing matches before the timeout.
+    """
+    if timeout is None:
+        timeout = CONFIG["timeout"]
+    deadline = time.monotonic() + timeout
+    # Subscribe before the first scan so an exec in between isn't missed
+    sock = open_proc_connector()
+    try:
+        pid = find_emulator(root_pid, rom, emulator)
+        while pid is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            if sock is None:
+                time.sleep(min(CONFIG["interval"], remaining))
+                pid = find_emulator(root_pid, rom, emulator)
+                continue
+            if not select.select([sock], [], [], remaining)[0]:
+                return None
+            for exec_pid in exec_events(sock):
+                if is_descendant(exec_pid, root_pid) and is_emulator(exec_pid, rom, emulator):
+                    pid = exec_pid
+                    break
+        return pid
+    finally:
+        if sock is not None:
+            sock.close()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Game Names
+Resolves ROM paths to the display names codes are sold under, from
+EmulationStation's gamelist.xml files and an alias table
+"""
+import os
+import glob
+import json
+import mmap
+import struct
+import hashlib
+import logging
+import argparse
+
+# Configuration
+CONFIG = {
+    # Where EmulationStation keeps gamelists; "*" is the system name
+    "gamelists": [
+        "/home/pi/RetroPie/roms/*/gamelist.xml",
+        "/home/pi/.emulationstation/gamelists/*/gamelist.xml",
+        "/opt/retropie/configs/all/emulationstation/gamelists/*/gamelist.xml"
+    ],
+    # {"pacman": "Pac-Man", "arcade/mspacman": "Ms. Pac-Man"}; wins over gamelists
+    "aliases": "/home/pi/arcade/aliases.json",
+    "index": "/home/pi/arcade/game_names.idx",    # Lookup table read at launch
+    "state": "/home/pi/arcade/game_names.json"    # Parsed gamelists, for rebuilds
+}
+
+# Index layout: header, then a power-of-two table of (key hash, entry
+# offset) slots, then entries of (key length, value length, key, value)
+HEADER = struct.Struct("<4sII")
+SLOT = struct.Struct("<QI")
+ENTRY = struct.Struct("<HH")
+MAGIC = b"GNX1"
+
+# Keys recording the mtime of each source file start with a NUL, which
+# no ROM name contains
+MTIME_PREFIX = "\0mtime "
+
+
+def key_hash(key):
+    """64-bit hash of an index key, never 0 (0 marks an empty slot)"""
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+def rom_keys(system, rom):
+    """Return the keys a ROM is looked up by: "<system>/<stem>", then "<stem>" """
+    stem = os.path.splitext(os.path.basename(rom))[0].lower()
+    return [f"{system.lower()}/{stem}", stem]
+
+
+def source_mtime(path):
+    """Return path's mtime in ns as a string, or "" if it doesn't exist"""
+    try:
+        return str(os.stat(path).st_mtime_ns)
+    except OSError:
+        return ""
+
+
+def read_gamelist(path):
+    """Return {key: display name} for the games in one gamelist.xml
+
+    The system is the name of the directory the gamelist lives in.
+    ElementTree is imported here: only rebuilds need it, and it would
+    otherwise be most of a launch's import time.
+    """
+    import xml.etree.ElementTree as ElementTree
+    system = os.path.basename(os.path.dirname(path))
+    names = {}
+    for _, element in ElementTree.iterparse(path):
+        if element.tag != "game":
+            continue
+        rom = element.findtext("path")
+        name = element.findtext("name")
+        if rom and name:
+            system_key, stem = rom_keys(system, rom.strip())
+            names[system_key] = name.strip()
+            names.setdefault(stem, name.strip())
+        element.clear()
+    return names
+
+
+def read_aliases(path):
+    """Return {key: display name} from the alias table"""
+    try:
+        with open(path) as f:
+            aliases = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return {key.lower(): name for key, name in aliases.items()}
+
+
+def gamelist_paths():
+    """Return every gamelist.xml the configured patterns find"""
+    paths = []
+    for pattern in CONFIG["gamelists"]:
+        paths.extend(sorted(glob.glob(pattern)))
+    return paths
+
+
+class NameIndex:
+    """Read-only view of the lookup table, mapped into memory
+
+    A lookup hashes the key and probes the slot table, so it costs the
+    same however many games the gamelists hold.
+    """
+
+    def __init__(self, path=None):
+        """Map the index file"""
+        with open(path or CONFIG["index"], "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slots, self.count = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            self.data.close()
+            raise ValueError(f"{path or CONFIG['index']} is not a game name index")
+
+    def close(self):
+        """Unmap the index"""
+        self.data.close()
+
+    def get(self, key):
+        """Return the value stored for key, or None"""
+        wanted = key_hash(key)
+        mask = self.slots - 1
+        slot = wanted & mask
+        while True:
+            stored, offset = SLOT.unpack_from(self.data, HEADER.size + slot * SLOT.size)
+            if stored == 0:
+                return None
+            if stored == wanted:
+                key_length, value_length = ENTRY.unpack_from(self.data, offset)
+                start = offset + ENTRY.size
+                if self.data[start:start + key_length] == key.encode():
+                    return self.data[start + key_length:start + key_length + value_length].decode()
+            slot = (slot + 1) & mask
+
+    def stale(self, system):
+        """Return True if a source file that can name system's ROMs changed"""
+        paths = [pattern.replace("*", system) for pattern in CONFIG["gamelists"]]
+        paths.append(CONFIG["aliases"])
+        for path in paths:
+            if (self.get(MTIME_PREFIX + path) or "") != source_mtime(path):
+                return True
+        return False
+
+
+def write_index(path, entries):
+    """Write {key: value} as an index file, replacing path atomically"""
+    slots = 8
+    while slots < 2 * len(entries):
+        slots *= 2
+    table = [(0, 0)] * slots
+    pool = bytearray()
+    base = HEADER.size + slots * SLOT.size
+    for key, value in entries.items():
+        encoded_key, encoded_value = key.encode(), value.encode()
+        slot = key_hash(key) & (slots - 1)
+        while table[slot][0]:
+            slot = (slot + 1) & (slots - 1)
+        table[slot] = (key_hash(key), base + len(pool))
+        pool += ENTRY.pack(len(encoded_key), len(encoded_value)) + encoded_key + encoded_value
+
+    data = bytearray(HEADER.pack(MAGIC, slots, len(entries)))
+    for hashed, offset in table:
+        data += SLOT.pack(hashed, offset)
+    data += pool
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+def update(force=False):
+    """Rebuild the index from any gamelists (or aliases) that changed
+
+    Parsed gamelists are kept in the state file with their mtimes, so
+    only new or modified gamelists are parsed again. Returns the number
+    of source files parsed.
+    """
+    try:
+        with open(CONFIG["state"]) as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        state = {}
+
+    sources = {}
+    parsed = 0
+    for path in gamelist_paths() + [CONFIG["aliases"]]:
+        mtime = source_mtime(path)
+        if not mtime:
+            continue
+        previous = state.get(path)
+        if previous and previous["mtime"] == mtime and not force:
+            sources[path] = previous
+            continue
+        try:
+            if path == CONFIG["aliases"]:
+                names = read_aliases(path)
+            else:
+                names = read_gamelist(path)
+        except (OSError, ValueError, SyntaxError) as e:  # ParseError is a SyntaxError
+            logging.warning(f"Skipping {path}: {e}")
+            names = {}
+        sources[path] = {"mtime": mtime, "names": names}
+        parsed += 1
+
+    if not parsed and sources.keys() == state.keys() and os.path.exists(CONFIG["index"]):
+        return 0
+
+    # Gamelists in configured order (the first to name a ROM wins), then
+    # aliases: "system/stem" replaces one entry, a bare stem every system's
+    entries = {}
+    for path, source in sources.items():
+        if path != CONFIG["aliases"]:
+            for key, name in source["names"].items():
+                entries.setdefault(key, name)
+    aliases = sources.get(CONFIG["aliases"], {"names": {}})["names"]
+    for key in entries:
+        stem = key.rpartition("/")[2]
+        if stem in aliases:
+            entries[key] = aliases[stem]
+    entries.update(aliases)
+    for path, source in sources.items():
+        entries[MTIME_PREFIX + path] = source["mtime"]
+
+    write_index(CONFIG["index"], entries)
+    temporary = f"{CONFIG['state']}.{os.getpid()}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(sources, f)
+    os.replace(temporary, CONFIG["state"])
+    return parsed
+
+
+def open_index():
+    """Return the NameIndex, building it first if it doesn't exist yet"""
+    try:
+        return NameIndex()
+    except (FileNotFoundError, ValueError):
+        update(force=True)
+        return NameIndex()
+
+
+def resolve(system, rom):
+    """Return the display name for a ROM, or its file name without extension
+
+    Only the gamelists that could list this system are checked for
+    changes, so a launch costs a few stat() calls and hash probes.
+    """
+    fallback = os.path.splitext(os.path.basename(rom))[0]
+    try:
+        index = open_index()
+        if index.stale(system):
+            index.close()
+            update()
+            index = NameIndex()
+    except (OSError, ValueError) as e:
+        logging.error(f"Game name index unavailable: {e}")
+        return fallback
+    try:
+        for key in rom_keys(system, rom):
+            name = index.get(key)
+            if name:
+                return name
+        return fallback
+    finally:
+        index.close()
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Resolve ROMs to game names")
+    commands = parser.add_subparsers(dest="command", required=True)
+    rebuild = commands.add_parser("update", help="parse changed gamelists and rebuild the index")
+    rebuild.add_argument("--force", action="store_true", help="parse every gamelist again")
+    lookup = commands.add_parser("resolve", help="print the game name for a ROM")
+    lookup.add_argument("system", help="system name, e.g. arcade")
+    lookup.add_argument("rom", help="ROM path")
+    args = parser.parse_args()
+
+    if args.command == "update":
+        parsed = update(force=args.force)
+        print(f"Parsed {parsed} changed source files")
+        return
+    print(resolve(args.system, args.rom))
+
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,8 @@ sudo apt-get install -y python3-pip python3-tk python3-pygame
 echo "Setting permissions..."
 chmod +x "$ARCADE_DIR/validation_screen.py"
 chmod +x "$ARCADE_DIR/time_tracker.py"
+chmod +x "$ARCADE_DIR/validation_client.py"
+chmod +x "$ARCADE_DIR/runcommand_hook.py"
 
 # Backup existing runcommand script if it exists
 if [ -f "$RUNCOMMAND_SCRIPT" ]; then
@@ -34,6 +36,53 @@ cp "$ARCADE_DIR/runcommand-onstart.sh" "$RUNCOMMAND_SCRIPT"
 # Make runcommand hook executable
 chmod +x "$RUNCOMMAND_SCRIPT"
 
+# Run the tracker supervisor as a service; without it each game is
+# tracked by its own process, with no saved state to resume after a
+# crash or power cut and no pause or top-up
+echo "Installing time tracker supervisor service..."
+sudo tee /etc/systemd/system/arcade-tracker.service > /dev/null << EOF
+[Unit]
+Description=Arcade Payment System time tracker supervisor
+After=local-fs.target
+
+[Service]
+User=pi
+ExecStart=/usr/bin/python3 $ARCADE_DIR/time_tracker.py --supervisor
+Restart=on-failure
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+# Keep the validation screen warm in a daemon; without it every launch
+# falls back to starting the one-shot screen from cold. It restarts until
+# the display it draws on (X for Tk, KMS for SDL) is available
+echo "Installing validation daemon service..."
+sudo tee /etc/systemd/system/arcade-validation.service > /dev/null << EOF
+[Unit]
+Description=Arcade Payment System validation daemon
+After=local-fs.target
+
+[Service]
+User=pi
+SupplementaryGroups=video input
+Environment=DISPLAY=:0
+ExecStart=/usr/bin/python3 $ARCADE_DIR/validation_screen.py --daemon
+Restart=always
+RestartSec=5
+
+[Install]
+WantedBy=multi-user.target
+EOF
+sudo systemctl daemon-reload
+sudo systemctl enable --now arcade-tracker.service
+sudo systemctl enable --now arcade-validation.service
+
+# Fold the redemption journal into the code store overnight rather than
+# while a game is launching
+echo "Scheduling code store compaction..."
+echo "30 4 * * * pi /usr/bin/python3 $ARCADE_DIR/code_store.py compact" | sudo tee /etc/cron.d/arcade-compact > /dev/null
+
 echo "Installation complete!"
 echo "The arcade payment system has been installed."
 echo "Test the system by launching a game in RetroPie."
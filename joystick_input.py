@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Joystick Input
+Event-driven joystick input with per-control edge detection and debouncing
+"""
+import os
+import glob
+import time
+import fcntl
+import logging
+import struct
+
+# Configuration
+CONFIG = {
+    "device": None,              # evdev device, None to auto-detect
+    "device_glob": "/dev/input/by-id/*-event-joystick",
+    "axis_threshold": 0.7,       # Fraction of full deflection for a direction
+    "debounce": 0.08,            # Seconds between presses of the same control
+    "wake_glob": "/dev/input/event*",  # Devices watched for SDL (pygame) input
+    "pygame_interval": 10,       # Milliseconds between pygame drains just after input,
+    "pygame_idle_interval": 100, # and when idle, if no device could be watched
+    "active_period": 2.0,        # Seconds after input that count as "just after"
+    "record": None               # Append raw input edges to this trace file
+}
+
+# File handler mask for Tk's createfilehandler (tkinter.READABLE), which
+# the SDL event loop understands too
+READABLE = 2
+
+# Linux input event layout and codes (linux/input.h)
+EVENT = struct.Struct("llHHi")
+EV_KEY = 0x01
+EV_ABS = 0x03
+ABS_X = 0x00
+ABS_Y = 0x01
+ABS_HAT0X = 0x10
+ABS_HAT0Y = 0x11
+
+# Button codes for gamepads (BTN_SOUTH...) and generic arcade
+# encoders (BTN_TRIGGER...), in the same A/B/X/Y order pygame uses
+BUTTONS = {
+    0x130: "A", 0x131: "B", 0x133: "X", 0x134: "Y",
+    0x120: "A", 0x121: "B", 0x122: "X", 0x123: "Y"
+}
+
+# Input traces are a sequence of (milliseconds since start, control
+# index, 1 for press / 0 for release) records
+CONTROL_NAMES = ("UP", "DOWN", "LEFT", "RIGHT", "A", "B", "X", "Y")
+TRACE_RECORD = struct.Struct("<IBB")
+
+def load_trace(path):
+    """Read an input trace as a list of (seconds, control, down) tuples"""
+    with open(path, "rb") as f:
+        data = f.read()
+    trace = []
+    for offset in range(0, len(data) - TRACE_RECORD.size + 1, TRACE_RECORD.size):
+        ms, index, down = TRACE_RECORD.unpack_from(data, offset)
+        trace.append((ms / 1000.0, CONTROL_NAMES[index], bool(down)))
+    return trace
+
+def save_trace(path, trace):
+    """Write (seconds, control, down) tuples as an input trace"""
+    with open(path, "wb") as f:
+        for seconds, control, down in trace:
+            f.write(TRACE_RECORD.pack(int(seconds * 1000), CONTROL_NAMES.index(control), int(down)))
+
+def eviocgabs(axis):
+    """ioctl request number for EVIOCGABS(axis)"""
+    return (2 << 30) | (24 << 16) | (ord("E") << 8) | (0x40 + axis)
+
+class Controls:
+    """Tracks press/release edges per control and reports debounced presses"""
+
+    def __init__(self):
+        """Initialize control state"""
+        self.callback = None
+        self.pressed = set()
+        self.last_press = {}
+        self.clock = time.monotonic
+        self.started = self.clock()
+        self.trace = open(CONFIG["record"], "ab") if CONFIG["record"] else None
+
+    def listen(self, callback):
+        """Send presses to callback (None to stop)"""
+        self.callback = callback
+
+    def record(self, control, down):
+        """Append a raw input edge to the trace file"""
+        ms = int((self.clock() - self.started) * 1000)
+        self.trace.write(TRACE_RECORD.pack(ms, CONTROL_NAMES.index(control), int(down)))
+        self.trace.flush()
+
+    def set_state(self, control, down):
+        """Record the state of a control, reporting a press on its down edge"""
+        if self.trace and down != (control in self.pressed):
+            self.record(control, down)
+        if not down:
+            self.pressed.discard(control)
+        elif control not in self.pressed:
+            self.pressed.add(control)
+            self.press(control)
+
+    def press(self, control):
+        """Report a press unless the same control was pressed too recently"""
+        now = self.clock()
+        if now - self.last_press.get(control, float("-inf")) < CONFIG["debounce"]:
+            return
+        self.last_press[control] = now
+        if self.callback:
+            self.callback(control)
+
+    def set_directions(self, x, y):
+        """Update the four directions from normalized axis values"""
+        threshold = CONFIG["axis_threshold"]
+        self.set_state("UP", y < -threshold)
+        self.set_state("DOWN", y > threshold)
+        self.set_state("LEFT", x < -threshold)
+        self.set_state("RIGHT", x > threshold)
+
+    def close(self):
+        """Release the input source"""
+        self.callback = None
+        if self.trace:
+            self.trace.close()
+            self.trace = None
+
+class EvdevControls(Controls):
+    """Reads an evdev device from the Tk event loop without polling"""
+
+    def __init__(self, root, path):
+        """Open the device and register it with Tk"""
+        super().__init__()
+        self.root = root
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        self.ranges = {}
+        self.axes = {}
+        for axis in (ABS_X, ABS_Y, ABS_HAT0X, ABS_HAT0Y):
+            self.ranges[axis] = self.axis_range(axis)
+        self.root.createfilehandler(self.fd, READABLE, self.read_events)
+        logging.info(f"Using input device: {path}")
+
+    def axis_range(self, axis):
+        """Return (min, max) for an absolute axis"""
+        try:
+            info = fcntl.ioctl(self.fd, eviocgabs(axis), bytes(24))
+            _, minimum, maximum, _, _, _ = struct.unpack("6i", info)
+            if maximum > minimum:
+                return minimum, maximum
+        except OSError:
+            pass
+        return (-1, 1) if axis in (ABS_HAT0X, ABS_HAT0Y) else (-32768, 32767)
+
+    def normalize(self, axis, value):
+        """Scale an axis value to -1.0..1.0"""
+        minimum, maximum = self.ranges.get(axis, (-32768, 32767))
+        return (2.0 * (value - minimum) / (maximum - minimum)) - 1.0
+
+    def read_events(self, fd, mask):
+        """Handle every event the device has queued"""
+        try:
+            data = os.read(self.fd, EVENT.size * 64)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logging.error(f"Input device error: {e}")
+            self.close()
+            return
+
+        for offset in range(0, len(data) - EVENT.size + 1, EVENT.size):
+            _, _, ev_type, code, value = EVENT.unpack_from(data, offset)
+            if ev_type == EV_KEY and code in BUTTONS:
+                # value is 1 on press, 0 on release, 2 on autorepeat
+                self.set_state(BUTTONS[code], value != 0)
+            elif ev_type == EV_ABS and code in self.ranges:
+                self.axes[code] = self.normalize(code, value)
+                stick_x = self.axes.get(ABS_X, 0.0)
+                stick_y = self.axes.get(ABS_Y, 0.0)
+                hat_x = self.axes.get(ABS_HAT0X, 0.0)
+                hat_y = self.axes.get(ABS_HAT0Y, 0.0)
+                # Whichever of stick and hat is deflected further wins
+                x = stick_x if abs(stick_x) >= abs(hat_x) else hat_x
+                y = stick_y if abs(stick_y) >= abs(hat_y) else hat_y
+                self.set_directions(x, y)
+
+    def close(self):
+        """Unregister from Tk and close the device"""
+        super().close()
+        if self.fd is not None:
+            self.root.deletefilehandler(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+class InputWakeups:
+    """Calls back when any input device has events, for SDL, which reads
+    the devices itself and has no descriptor to wait on
+
+    Every open evdev file gets its own copy of each event, so these
+    read-only descriptors become readable exactly when SDL has input to
+    pump; their copies are discarded. Devices that can't be opened are
+    skipped, leaving fds empty if none could be.
+    """
+
+    def __init__(self, root, callback):
+        """Open the input devices and register them with the event loop"""
+        self.root = root
+        self.callback = callback
+        self.fds = []
+        for path in sorted(glob.glob(CONFIG["wake_glob"])):
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                continue
+            self.fds.append(fd)
+            self.root.createfilehandler(fd, READABLE, self.readable)
+
+    def readable(self, fd, mask):
+        """Discard the device's copy of its events and call back"""
+        try:
+            while os.read(fd, EVENT.size * 64):
+                pass
+            gone = True  # End of file, which an input device never reports
+        except BlockingIOError:
+            gone = False
+        except OSError:
+            gone = True  # Unplugged
+        if gone:
+            # Stop watching it rather than spin on it
+            self.root.deletefilehandler(fd)
+            os.close(fd)
+            self.fds.remove(fd)
+        self.callback()
+
+    def close(self):
+        """Stop watching the devices"""
+        for fd in self.fds:
+            self.root.deletefilehandler(fd)
+            os.close(fd)
+        self.fds = []
+
+class PygameControls(Controls):
+    """Fallback that drains pygame JOY* events from the Tk loop
+
+    Drains run when an input device becomes readable; only if no device
+    can be watched does it poll, quickly just after input and slowly
+    when idle.
+    """
+
+    def __init__(self, root, joystick):
+        """Start draining joystick events"""
+        super().__init__()
+        import pygame
+        self.pygame = pygame
+        self.root = root
+        self.joystick = joystick
+        self.axes = {}
+        self.hat = (0, 0)
+        self.last_event = float("-inf")
+        self.drain_id = None
+        self.wakeups = InputWakeups(root, self.drain)
+        self.schedule()
+
+    def schedule(self):
+        """Arrange the next poll, unless devices are being watched"""
+        if self.wakeups.fds:
+            return
+        recent = self.clock() - self.last_event < CONFIG["active_period"]
+        delay = CONFIG["pygame_interval"] if recent else CONFIG["pygame_idle_interval"]
+        self.drain_id = self.root.after(delay, self.poll)
+
+    def poll(self):
+        """Drain events, then poll again"""
+        self.drain()
+        self.schedule()
+
+    def drain(self):
+        """Apply queued joystick events"""
+        pygame = self.pygame
+        try:
+            events = pygame.event.get((pygame.JOYAXISMOTION, pygame.JOYHATMOTION,
+                                       pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP))
+        except pygame.error:
+            # The SDL renderer closes video (and with it events) between games
+            events = []
+        if events:
+            self.last_event = self.clock()
+        for event in events:
+            if event.type == pygame.JOYAXISMOTION and event.axis in (0, 1):
+                self.axes[event.axis] = event.value
+            elif event.type == pygame.JOYHATMOTION:
+                # Hat y is positive for up, unlike stick axes
+                self.hat = (event.value[0], -event.value[1])
+            elif event.type in (pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP):
+                if event.button < 4:
+                    self.set_state("ABXY"[event.button], event.type == pygame.JOYBUTTONDOWN)
+                continue
+            x = self.axes.get(0, 0.0) or self.hat[0]
+            y = self.axes.get(1, 0.0) or self.hat[1]
+            self.set_directions(x, y)
+
+    def close(self):
+        """Stop draining events"""
+        super().close()
+        self.wakeups.close()
+        if self.drain_id:
+            self.root.after_cancel(self.drain_id)
+            self.drain_id = None
+
+def find_device():
+    """Return the configured or first detected joystick event device"""
+    if CONFIG["device"]:
+        return CONFIG["device"]
+    devices = sorted(glob.glob(CONFIG["device_glob"]))
+    return devices[0] if devices else None
+
+def open_controls(root, get_joystick):
+    """Open the best available input source
+
+    evdev is preferred because Tk can wait on its file descriptor
+    directly; get_joystick is only called (to bring up pygame) when no
+    evdev device can be opened.
+    """
+    path = find_device()
+    if path:
+        try:
+            return EvdevControls(root, path)
+        except OSError as e:
+            logging.warning(f"Cannot open {path}: {e}")
+
+    joystick = get_joystick()
+    if joystick:
+        return PygameControls(root, joystick)
+
+    # Keyboard only
+    return Controls()
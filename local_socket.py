@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Local Socket Helpers
+JSON-lines request/response over Unix domain sockets
+"""
+import os
+import json
+import socket
+
+
+def listen(path):
+    """Create a non-blocking listening socket at path, replacing a stale one"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(8)
+    server.setblocking(False)
+    return server
+
+
+def send_message(sock, message):
+    """Send one JSON message terminated by a newline"""
+    sock.sendall(json.dumps(message).encode() + b"\n")
+
+
+def recv_message(sock, limit=65536):
+    """Receive one newline-terminated JSON message, or None on EOF"""
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(4096)
+        if not chunk:
+            return None
+        data += chunk
+        if len(data) > limit:
+            raise ValueError("Message too long")
+    return json.loads(data)
+
+
+def request(path, message, connect_timeout=1.0, reply_timeout=None):
+    """Send a request to the server at path and wait for its reply
+
+    Raises OSError (FileNotFoundError, ConnectionRefusedError, ...) when
+    nothing is listening, so callers can fall back to running locally.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(connect_timeout)
+        sock.connect(path)
+        sock.settimeout(reply_timeout)
+        send_message(sock, message)
+        reply = recv_message(sock)
+        if reply is None:
+            raise ConnectionResetError("Server closed the connection")
+        return reply
+    finally:
+        sock.close()
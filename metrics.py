@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Metrics
+Fixed-size counters and histograms exported as Prometheus text files,
+plus a tiny HTTP endpoint that serves them
+"""
+import os
+import sys
+import glob
+import fcntl
+import bisect
+import logging
+
+# Configuration
+CONFIG = {
+    "directory": "/home/pi/arcade/metrics",  # One <component>.prom per process type
+    "port": 9101                             # Port for `metrics.py --serve`
+}
+
+
+class Counter:
+    """A counter, optionally split by one label with a fixed set of values"""
+
+    def __init__(self, name, help_text, label=None, values=()):
+        """Create the counter with every label value at zero"""
+        self.name = name
+        self.help = help_text
+        self.type = "counter"
+        if label:
+            self.keys = [f'{name}{{{label}="{value}"}}' for value in values]
+            self.index = {value: i for i, value in enumerate(values)}
+        else:
+            self.keys = [name]
+            self.index = {None: 0}
+        self.pending = [0] * len(self.keys)
+
+    def inc(self, value=None, amount=1):
+        """Add amount to the counter (for label value `value`)"""
+        self.pending[self.index[value]] += amount
+
+    def samples(self):
+        """Yield (sample key, increment since the last flush)"""
+        return zip(self.keys, self.pending)
+
+    def reset(self):
+        """Forget increments that have been flushed"""
+        self.pending = [0] * len(self.keys)
+
+
+class Histogram:
+    """A histogram with fixed bucket bounds"""
+
+    def __init__(self, name, help_text, buckets):
+        """Create the histogram with empty buckets"""
+        self.name = name
+        self.help = help_text
+        self.type = "histogram"
+        self.bounds = tuple(buckets)
+        self.reset()
+
+    def observe(self, value):
+        """Record one value"""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+    def samples(self):
+        """Yield (sample key, increment since the last flush)"""
+        cumulative = 0
+        for bound, count in zip(self.bounds + (None,), self.counts):
+            cumulative += count
+            le = "+Inf" if bound is None else repr(float(bound))
+            yield f'{self.name}_bucket{{le="{le}"}}', cumulative
+        yield f"{self.name}_sum", self.total
+        yield f"{self.name}_count", cumulative
+
+    def reset(self):
+        """Forget observations that have been flushed"""
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+
+
+class Registry:
+    """The metrics one component (validation, time_tracker) exports
+
+    Metrics only count in memory. flush() adds what was counted since the
+    last flush to <component>.prom under a lock, so one-shot processes and
+    concurrent processes of the same component all add up to one total.
+    """
+
+    def __init__(self, component):
+        """Create an empty registry for component"""
+        self.component = component
+        self.metrics = []
+
+    def counter(self, name, help_text, label=None, values=()):
+        """Create and register a Counter"""
+        metric = Counter(name, help_text, label, values)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets):
+        """Create and register a Histogram"""
+        metric = Histogram(name, help_text, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def path(self):
+        """Return the text file this registry is exported to"""
+        return os.path.join(CONFIG["directory"], f"{self.component}.prom")
+
+    def flush(self):
+        """Add the counts since the last flush to the exported text file"""
+        path = self.path()
+        try:
+            os.makedirs(CONFIG["directory"], exist_ok=True)
+            with open(path + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                totals = read_samples(path)
+                lines = []
+                for metric in self.metrics:
+                    lines.append(f"# HELP {metric.name} {metric.help}")
+                    lines.append(f"# TYPE {metric.name} {metric.type}")
+                    for key, delta in metric.samples():
+                        lines.append(f"{key} {format_value(totals.get(key, 0) + delta)}")
+                # Write a new file and rename it so readers never see half of one
+                with open(path + ".tmp", "w") as f:
+                    f.write("\n".join(lines) + "\n")
+                os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.error(f"Error writing metrics to {path}: {e}")
+            return
+        for metric in self.metrics:
+            metric.reset()
+
+
+def format_value(value):
+    """Format a sample value as Prometheus text"""
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def read_samples(path):
+    """Return {sample key: value} from a Prometheus text file"""
+    samples = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith("#") or not line.strip():
+                    continue
+                key, _, value = line.rstrip("\n").rpartition(" ")
+                samples[key] = float(value)
+    except FileNotFoundError:
+        pass
+    return samples
+
+
+def make_handler():
+    """Return the HTTP handler class for `--serve`
+
+    http.server is imported here rather than at the top: it takes longer to
+    import than the rest of this module, and every launch imports metrics.
+    """
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """Serves every exported text file at /metrics"""
+
+        def do_GET(self):
+            """Return the concatenated text files"""
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = b""
+            for path in sorted(glob.glob(os.path.join(CONFIG["directory"], "*.prom"))):
+                with open(path, "rb") as f:
+                    body += f.read()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            """Stay quiet; Prometheus scrapes every few seconds"""
+
+    return MetricsHandler
+
+
+def main():
+    """Main entry point"""
+    if len(sys.argv) < 2 or sys.argv[1] != "--serve":
+        print("Usage: python metrics.py --serve [port]")
+        print(f"Or point node_exporter's textfile collector at {CONFIG['directory']}")
+        sys.exit(1)
+    from http.server import HTTPServer
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else CONFIG["port"]
+    server = HTTPServer(("", port), make_handler())
+    print(f"Serving {CONFIG['directory']} on port {port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Move Glyphs
+Shape definitions for move icons and input slots, plus a rasterizer so
+each glyph can be rendered once and cached by the UI
+"""
+import math
+
+# Glyphs are drawn on a SIZE x SIZE cell
+SIZE = 40
+
+# 5x7 bitmaps for the button letters
+LETTERS = {
+    "A": [".###.", "#...#", "#...#", "#####", "#...#", "#...#", "#...#"],
+    "B": ["####.", "#...#", "#...#", "####.", "#...#", "#...#", "####."],
+    "X": ["#...#", "#...#", ".#.#.", "..#..", ".#.#.", "#...#", "#...#"],
+    "Y": ["#...#", "#...#", ".#.#.", "..#..", "..#..", "..#..", "..#.."]
+}
+
+# Shapes are tuples understood by rasterize() (and by any other renderer):
+#   ("polygon", points, fill)
+#   ("rect", (x1, y1, x2, y2), fill)
+#   ("oval", (x1, y1, x2, y2), fill, outline, width, dash)
+#   ("text", (cx, cy), letter, fill)
+
+def move_shapes(move, colors):
+    """Shapes for a move icon"""
+    color = colors.get(move, colors["text"])
+    if move == "UP":
+        return [("polygon", [(10, 30), (20, 10), (30, 30)], color),
+                ("rect", (15, 30, 25, 35), color)]
+    if move == "DOWN":
+        return [("polygon", [(10, 10), (20, 30), (30, 10)], color),
+                ("rect", (15, 5, 25, 10), color)]
+    if move == "LEFT":
+        return [("polygon", [(30, 10), (10, 20), (30, 30)], color),
+                ("rect", (30, 15, 35, 25), color)]
+    if move == "RIGHT":
+        return [("polygon", [(10, 10), (30, 20), (10, 30)], color),
+                ("rect", (5, 15, 10, 25), color)]
+    # Button
+    return [("oval", (5, 5, 35, 35), color, colors["text"], 2, None),
+            ("text", (20, 20), move, colors["text"])]
+
+def slot_shapes(move, state, colors):
+    """Shapes for an input slot
+
+    state is "correct" or "incorrect" for a filled slot, "empty" for an
+    unfilled one and "current" for the slot awaiting the next move.
+    """
+    if state in ("empty", "current"):
+        shapes = [("oval", (5, 5, 35, 35), None, colors["text"], 1, (3, 3))]
+        if state == "current":
+            shapes.append(("oval", (0, 0, 40, 40), None, colors["highlight"], 2, (5, 3)))
+        return shapes
+    return move_shapes(move, colors) + [
+        ("oval", (15, 35, 25, 45), colors[state], "#000000", 1, None)
+    ]
+
+def _in_polygon(x, y, points):
+    """Even-odd point in polygon test"""
+    inside = False
+    j = len(points) - 1
+    for i in range(len(points)):
+        xi, yi = points[i]
+        xj, yj = points[j]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+def _oval_color(x, y, shape):
+    """Color of an oval shape at pixel center (x, y), or None"""
+    _, (x1, y1, x2, y2), fill, outline, width, dash = shape
+    rx, ry = (x2 - x1) / 2.0, (y2 - y1) / 2.0
+    dx, dy = x - (x1 + rx), y - (y1 + ry)
+    distance = math.hypot(dx / rx, dy / ry)
+    if distance > 1.0:
+        return None
+    # Outline is a ring `width` pixels inside the bounding ellipse
+    if outline and distance >= 1.0 - width / min(rx, ry):
+        if dash:
+            position = (math.atan2(dy, dx) % (2 * math.pi)) * (rx + ry) / 2.0
+            if position % (dash[0] + dash[1]) >= dash[0]:
+                return fill
+        return outline
+    return fill
+
+def rasterize(shapes, background, size=SIZE):
+    """Render shapes into rows of "#rrggbb" colors"""
+    rows = []
+    for py in range(size):
+        row = []
+        for px in range(size):
+            x, y = px + 0.5, py + 0.5
+            color = background
+            for shape in shapes:
+                kind = shape[0]
+                if kind == "polygon":
+                    if _in_polygon(x, y, shape[1]):
+                        color = shape[2]
+                elif kind == "rect":
+                    x1, y1, x2, y2 = shape[1]
+                    if x1 <= x <= x2 and y1 <= y <= y2:
+                        color = shape[2]
+                elif kind == "oval":
+                    color = _oval_color(x, y, shape) or color
+                elif kind == "text":
+                    (cx, cy), letter, fill = shape[1], shape[2], shape[3]
+                    bitmap = LETTERS.get(letter)
+                    if bitmap:
+                        bx, by = px - (cx - 2), py - (cy - 3)
+                        if 0 <= by < 7 and 0 <= bx < 5 and bitmap[by][bx] == "#":
+                            color = fill
+            row.append(color)
+        rows.append(row)
+    return rows
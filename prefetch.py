@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Prefetch
+Reads the ROM, emulator and core into the page cache while the player
+is entering a code, so the game loads from memory once it is accepted
+"""
+import os
+import sys
+import time
+import shlex
+import ctypes
+import logging
+import platform
+import threading
+
+# Configuration
+CONFIG = {
+    "max_bytes": 256 * 1024 * 1024,  # Read no more than this per launch
+    "chunk": 1024 * 1024,            # Bytes per read; cancellation is checked between reads
+    "start_delay": 1.0,              # Seconds to leave the validation screen's own start-up reads
+    "idle_io": True                  # Read in the idle I/O class, only when the disk is otherwise idle
+}
+
+# ioprio_set(2) has no Python wrapper; its syscall number per architecture
+IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "armv7l": 314, "armv6l": 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_IDLE = 3 << 13  # IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+
+
+def set_idle_io():
+    """Move the calling thread to the idle I/O scheduling class
+
+    Returns False where that isn't available; the schedulers that ignore
+    I/O classes (none, mq-deadline) read as if it had worked.
+    """
+    number = IOPRIO_SET.get(platform.machine())
+    if number is None:
+        return False
+    libc = ctypes.CDLL(None, use_errno=True)
+    return libc.syscall(number, IOPRIO_WHO_PROCESS, threading.get_native_id(), IOPRIO_IDLE) == 0
+
+
+def launch_files(rom, command):
+    """Return the files a launch will load: the ROM, then every existing
+    file named in the emulator command (binary, core, config)"""
+    try:
+        words = shlex.split(command or "")
+    except ValueError:
+        # Unbalanced quotes, e.g. an apostrophe in a ROM name
+        words = (command or "").split()
+    files = []
+    for path in [rom] + words:
+        if path.startswith("/") and path not in files and os.path.isfile(path):
+            files.append(path)
+    return files
+
+
+class Prefetcher:
+    """Reads files into the page cache on a background thread
+
+    Reads are plain sequential reads into one reused buffer, so they stop
+    within one chunk of cancel() and the cap is exact. Pages already cached
+    cost a memory copy, not a disk read. Reading starts start_delay seconds
+    in, at idle I/O priority, so it doesn't slow the validation screen it
+    runs alongside.
+    """
+
+    def __init__(self, files, max_bytes=None, start_delay=None):
+        """Prepare to read files, up to max_bytes in total"""
+        self.files = list(files)
+        self.max_bytes = CONFIG["max_bytes"] if max_bytes is None else max_bytes
+        self.start_delay = CONFIG["start_delay"] if start_delay is None else start_delay
+        self.cancelled = threading.Event()
+        self.bytes_read = 0
+        self.elapsed = 0.0
+        self.thread = threading.Thread(target=self.run, name="prefetch", daemon=True)
+
+    def start(self):
+        """Start reading in the background"""
+        self.thread.start()
+        return self
+
+    def cancel(self):
+        """Stop reading and wait for the thread to finish"""
+        self.cancelled.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def run(self):
+        """Read each file in turn until done, capped or cancelled"""
+        if self.cancelled.wait(self.start_delay):
+            return
+        if CONFIG["idle_io"] and not set_idle_io():
+            logging.debug("Prefetching without idle I/O priority")
+        started = time.monotonic()
+        buffer = bytearray(CONFIG["chunk"])
+        view = memoryview(buffer)
+        for path in self.files:
+            if self.cancelled.is_set() or self.bytes_read >= self.max_bytes:
+                break
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError as e:
+                logging.debug(f"Not prefetching {path}: {e}")
+                continue
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                while not self.cancelled.is_set():
+                    wanted = min(len(buffer), self.max_bytes - self.bytes_read)
+                    count = os.readv(fd, [view[:wanted]]) if wanted else 0
+                    if not count:
+                        break
+                    self.bytes_read += count
+            except OSError as e:
+                logging.debug(f"Prefetch of {path} stopped: {e}")
+            finally:
+                os.close(fd)
+        self.elapsed = time.monotonic() - started
+
+
+def main():
+    """Prefetch files given on the command line and report the read rate"""
+    if len(sys.argv) < 2:
+        print("Usage: python prefetch.py <file>...")
+        sys.exit(1)
+    prefetcher = Prefetcher(sys.argv[1:], start_delay=0).start()
+    prefetcher.thread.join()
+    megabytes = prefetcher.bytes_read / (1024 * 1024)
+    print(f"Read {megabytes:.1f} MB in {prefetcher.elapsed:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
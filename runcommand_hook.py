@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - RunCommand Hook
+Everything runcommand-onstart.sh used to do, in one process: read the
+launch arguments, apply the skip list, validate, and hand the game to
+the time tracker
+"""
+import os
+import re
+import sys
+import time
+import fnmatch
+import logging
+import arcade_log
+import metrics
+import game_names
+import prefetch
+import local_socket
+import validation_client
+
+# Configuration
+CONFIG = {
+    "log_file": "/home/pi/arcade/logs/runcommand.log",
+    "minutes": 30,  # Play time a validated launch buys
+    "tracker_socket": "/home/pi/arcade/run/time_tracker.sock",  # For owed time
+    # Launches that skip validation, as shell-style patterns per field
+    # (system, emulator, rom, game); a launch matching any pattern is free
+    "skip": {
+        "game": ["Setup"],
+        "system": ["ports"]
+    }
+}
+
+# Metrics, added to /home/pi/arcade/metrics/hook.prom after each launch
+METRICS = metrics.Registry("hook")
+OVERHEAD = METRICS.histogram(
+    "arcade_hook_overhead_seconds",
+    "Time the hook adds to a launch, not counting the validation screen",
+    (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5))
+LAUNCHES = METRICS.counter(
+    "arcade_hook_launches_total", "Launches seen by the hook", "outcome",
+    ("skipped", "resumed", "validated", "rejected"))
+PREFETCHED = METRICS.counter(
+    "arcade_hook_prefetch_bytes_total", "Bytes of ROM, emulator and core read ahead during validation")
+
+
+def compile_skip_list(skip):
+    """Return {field: regex} matching any of the field's patterns"""
+    return {field: re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns))
+            for field, patterns in skip.items() if patterns}
+
+
+# Compiled once; call compile_skip_list() again after changing CONFIG["skip"]
+SKIP = compile_skip_list(CONFIG["skip"])
+
+
+def parse_launch(argv):
+    """Return the launch runcommand describes in the hook's arguments
+
+    runcommand passes system, emulator, ROM path and the full command.
+    The game is named as in EmulationStation (and the code store), falling
+    back to the ROM's file name.
+    """
+    system, emulator, rom, command = (list(argv) + [""] * 4)[:4]
+    game = game_names.resolve(system, rom)
+    return {"system": system, "emulator": emulator, "rom": rom, "command": command, "game": game}
+
+
+def should_skip(launch, skip=None):
+    """Return True if the launch matches the skip list"""
+    skip = SKIP if skip is None else skip
+    return any(regex.match(launch.get(field, "")) for field, regex in skip.items())
+
+
+def claim_credit(game_name):
+    """Return minutes owed for game_name from a session a reboot cut short"""
+    try:
+        reply = local_socket.request(CONFIG["tracker_socket"], {"cmd": "claim", "game": game_name},
+                                     reply_timeout=2.0)
+    except (OSError, ValueError):
+        return 0
+    return reply.get("minutes", 0) if reply and reply.get("result") else 0
+
+
+def hand_off(runcommand_pid, launch, minutes):
+    """Track the game from a detached child, so the hook can return now
+
+    The child imports the tracker itself instead of starting another
+    interpreter, waits for runcommand to start the emulator, and then hands
+    the session to the supervisor (or tracks it).
+    """
+    # The log listener thread must not be running across fork()
+    arcade_log.shutdown()
+    if os.fork() > 0:
+        return
+    try:
+        os.setsid()
+        # Detach from runcommand's terminal; the tracker logs to its own file
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.close(devnull)
+        import time_tracker
+        time_tracker.setup_logging()
+        time_tracker.launch(runcommand_pid, launch["emulator"], launch["rom"], launch["game"], minutes)
+    except Exception as e:
+        logging.error(f"Time tracking hand-off failed for {launch['game']}: {e}")
+    finally:
+        arcade_log.shutdown()
+        os._exit(0)
+
+
+def run(argv, runcommand_pid):
+    """Handle one launch, returning the hook's exit code (non-zero aborts it)"""
+    started = time.perf_counter()
+    logging.info("Starting runcommand hook")
+
+    launch = parse_launch(argv)
+    game = launch["game"]
+    logging.info(f"Game: {game}, System: {launch['system']}, Emulator: {launch['emulator']}")
+
+    if should_skip(launch):
+        logging.info(f"Skipping validation for {game}")
+        LAUNCHES.inc("skipped")
+        OVERHEAD.observe(time.perf_counter() - started)
+        METRICS.flush()
+        return 0
+
+    credit = claim_credit(game)
+    if credit:
+        logging.info(f"Resuming {game} with {credit} minutes left from an interrupted session")
+        LAUNCHES.inc("resumed")
+        OVERHEAD.observe(time.perf_counter() - started)
+        METRICS.flush()
+        hand_off(runcommand_pid, launch, credit)
+        return 0
+
+    logging.info(f"Running validation for {game}")
+    # Warm the page cache while the player enters a code
+    prefetcher = prefetch.Prefetcher(prefetch.launch_files(launch["rom"], launch["command"])).start()
+    validation_started = time.perf_counter()
+    ok = validation_client.validate_or_run(game)
+    validation_time = time.perf_counter() - validation_started
+    prefetcher.cancel()  # On success too: the emulator reads the rest itself
+    PREFETCHED.inc(amount=prefetcher.bytes_read)
+    logging.debug(f"Prefetched {prefetcher.bytes_read} bytes in {prefetcher.elapsed:.2f} s")
+
+    if not ok:
+        logging.warning(f"Validation failed for {game} (exit code: 1)")
+        LAUNCHES.inc("rejected")
+        OVERHEAD.observe(time.perf_counter() - started - validation_time)
+        METRICS.flush()
+        return 1
+
+    logging.info("Validation successful, launching game with time tracking")
+    LAUNCHES.inc("validated")
+    OVERHEAD.observe(time.perf_counter() - started - validation_time)
+    METRICS.flush()
+    hand_off(runcommand_pid, launch, CONFIG["minutes"])
+    return 0
+
+
+def main():
+    """Main entry point"""
+    if len(sys.argv) < 4:
+        print("Usage: python runcommand_hook.py <system> <emulator> <rom> [<command>]")
+        sys.exit(1)
+
+    arcade_log.setup("hook", CONFIG["log_file"])
+
+    # runcommand-onstart.sh execs us, so our parent is runcommand itself
+    try:
+        code = run(sys.argv[1:], os.getppid())
+    except Exception:
+        logging.exception("runcommand hook failed")
+        raise
+    sys.exit(code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - SDL Screen
+Draws the validation screen straight to KMS/framebuffer through
+pygame/SDL, with an event loop that stands in for the Tk root window
+"""
+import math
+import time
+import heapq
+import select
+import itertools
+import pygame
+import move_glyphs
+import joystick_input
+
+# Configuration
+CONFIG = {
+    "size": (800, 480),      # Window size when not fullscreen
+    "key_interval": 0.02,     # Seconds between keyboard checks just after a key,
+    "key_idle_interval": 0.1  # and when idle, if no input device could be watched
+}
+
+READABLE = 2  # Same value as tkinter.READABLE
+
+# Tk key sequences the validation screen binds, as SDL keys
+KEYS = {
+    "<Up>": pygame.K_UP, "<Down>": pygame.K_DOWN,
+    "<Left>": pygame.K_LEFT, "<Right>": pygame.K_RIGHT,
+    "a": pygame.K_a, "b": pygame.K_b, "x": pygame.K_x, "y": pygame.K_y,
+    "<Escape>": pygame.K_ESCAPE
+}
+
+# Fonts and glyph surfaces, created once per process
+FONTS = {}
+GLYPHS = {}
+
+
+def get_font(size, bold=False):
+    """Return SDL_ttf's built-in font at a Tk point size"""
+    key = (size, bold)
+    if key not in FONTS:
+        FONTS[key] = pygame.font.Font(None, int(size * 1.6))
+        FONTS[key].set_bold(bold)
+    return FONTS[key]
+
+
+def draw_shapes(surface, shapes, offset=(0, 0)):
+    """Draw move_glyphs shapes with pygame.draw"""
+    ox, oy = offset
+    for shape in shapes:
+        kind = shape[0]
+        if kind == "polygon":
+            pygame.draw.polygon(surface, shape[2], [(x + ox, y + oy) for x, y in shape[1]])
+        elif kind == "rect":
+            x1, y1, x2, y2 = shape[1]
+            pygame.draw.rect(surface, shape[2], (x1 + ox, y1 + oy, x2 - x1, y2 - y1))
+        elif kind == "oval":
+            (x1, y1, x2, y2), fill, outline, width, dash = shape[1:]
+            rect = pygame.Rect(x1 + ox, y1 + oy, x2 - x1, y2 - y1)
+            if fill:
+                pygame.draw.ellipse(surface, fill, rect)
+            if outline and not dash:
+                pygame.draw.ellipse(surface, outline, rect, width)
+            elif outline:
+                # Dashes measured along the perimeter, like Tk's dash pattern
+                radius = (rect.width + rect.height) / 4.0
+                period = (dash[0] + dash[1]) / radius
+                on = dash[0] / radius
+                for step in range(int(2 * math.pi / period) + 1):
+                    start = step * period
+                    pygame.draw.arc(surface, outline, rect, start, min(start + on, 2 * math.pi), width)
+        elif kind == "text":
+            (cx, cy), letter, fill = shape[1], shape[2], shape[3]
+            for by, row in enumerate(move_glyphs.LETTERS.get(letter, ())):
+                for bx, pixel in enumerate(row):
+                    if pixel == "#":
+                        surface.fill(fill, (cx - 2 + bx + ox, cy - 3 + by + oy, 1, 1))
+
+
+def get_glyph(move, state, colors):
+    """Return the cached surface for a move icon or input slot state"""
+    key = (move, state)
+    if key not in GLYPHS:
+        if state is None:
+            shapes = move_glyphs.move_shapes(move, colors)
+        else:
+            shapes = move_glyphs.slot_shapes(move, state, colors)
+        glyph = pygame.Surface((move_glyphs.SIZE, move_glyphs.SIZE))
+        glyph.fill(colors["background"])
+        draw_shapes(glyph, shapes)
+        GLYPHS[key] = glyph
+    return GLYPHS[key]
+
+
+class SdlRoot:
+    """The part of the Tk root window API the validation screen uses
+
+    Timers, idle callbacks and file handlers run from one select() loop;
+    the display is only opened while the screen is shown, so a daemon
+    releases KMS to the emulator between games.
+    """
+
+    def __init__(self, fullscreen=True):
+        """Open the display"""
+        pygame.display.init()
+        pygame.font.init()
+        self.fullscreen = fullscreen
+        self.surface = None
+        self.timers = []
+        self.cancelled = set()
+        self.idle = []
+        self.files = {}     # fileno -> (file, callback)
+        self.bindings = {}  # SDL key -> callback
+        self.dirty = []     # Screen rectangles changed since the last update
+        self.ids = itertools.count(1)
+        self.running = False
+        self.wakeups = None  # Input devices watched while the display is open
+        self.last_key = float("-inf")
+        self.deiconify()
+
+    def after(self, ms, func, *args):
+        """Call func after ms milliseconds"""
+        ident = f"after#{next(self.ids)}"
+        heapq.heappush(self.timers, (time.monotonic() + ms / 1000.0, ident, func, args))
+        return ident
+
+    def after_idle(self, func, *args):
+        """Call func once pending events have been handled"""
+        ident = f"idle#{next(self.ids)}"
+        self.idle.append((ident, func, args))
+        return ident
+
+    def after_cancel(self, ident):
+        """Cancel a pending after or after_idle call"""
+        if ident:
+            self.cancelled.add(ident)
+
+    def createfilehandler(self, file, mask, callback):
+        """Call callback(file, mask) whenever file is readable"""
+        fileno = file if isinstance(file, int) else file.fileno()
+        self.files[fileno] = (file, callback)
+
+    def deletefilehandler(self, file):
+        """Stop watching file"""
+        fileno = file if isinstance(file, int) else file.fileno()
+        self.files.pop(fileno, None)
+
+    def bind(self, sequence, callback):
+        """Call callback(None) when the key for a Tk key sequence is pressed"""
+        self.bindings[KEYS[sequence]] = callback
+
+    def withdraw(self):
+        """Close the display"""
+        if self.surface is not None:
+            self.wakeups.close()
+            pygame.display.quit()
+            self.surface = None
+
+    def deiconify(self):
+        """Open the display, fullscreen at the native mode if configured"""
+        if self.surface is not None:
+            return
+        pygame.display.init()
+        if self.fullscreen:
+            self.surface = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
+        else:
+            self.surface = pygame.display.set_mode(CONFIG["size"])
+        pygame.mouse.set_visible(False)
+        pygame.event.set_allowed(None)
+        pygame.event.set_allowed([pygame.QUIT, pygame.KEYDOWN, pygame.JOYAXISMOTION,
+                                  pygame.JOYHATMOTION, pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP])
+        # Keys are pumped after every wakeup, so the callback has nothing to do
+        self.wakeups = joystick_input.InputWakeups(self, lambda: None)
+
+    def update(self, rect=None):
+        """Mark part of the screen (default all of it) as changed"""
+        self.dirty.append(rect or self.surface.get_rect())
+
+    def present(self):
+        """Push changed rectangles to the display"""
+        if self.dirty and self.surface is not None:
+            pygame.display.update(self.dirty)
+        self.dirty = []
+
+    def run_idle(self):
+        """Run idle callbacks, including ones they schedule"""
+        while self.idle:
+            idle, self.idle = self.idle, []
+            for ident, func, args in idle:
+                if ident in self.cancelled:
+                    self.cancelled.discard(ident)
+                else:
+                    func(*args)
+
+    def pump(self):
+        """Dispatch bound keys and quit requests"""
+        if self.surface is None:
+            return
+        for event in pygame.event.get((pygame.QUIT, pygame.KEYDOWN)):
+            self.last_key = time.monotonic()
+            if event.type == pygame.QUIT:
+                callback = self.bindings.get(pygame.K_ESCAPE)
+            else:
+                callback = self.bindings.get(event.key)
+            if callback:
+                callback(None)
+
+    def mainloop(self):
+        """Run until quit() or destroy()"""
+        self.running = True
+        while self.running:
+            self.run_idle()
+            self.present()
+
+            timeout = None
+            if self.timers:
+                timeout = max(0, self.timers[0][0] - time.monotonic())
+            if self.surface is not None and not self.wakeups.fds:
+                # No input device to wait on: poll SDL for keys instead
+                recent = time.monotonic() - self.last_key < joystick_input.CONFIG["active_period"]
+                interval = CONFIG["key_interval"] if recent else CONFIG["key_idle_interval"]
+                timeout = interval if timeout is None else min(timeout, interval)
+            readable = []
+            if self.files or timeout is None:
+                readable = select.select(list(self.files), [], [], timeout)[0]
+            else:
+                time.sleep(timeout)
+            for fileno in readable:
+                if fileno in self.files:
+                    file, callback = self.files[fileno]
+                    callback(file, READABLE)
+            self.pump()
+
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                _, ident, func, args = heapq.heappop(self.timers)
+                if ident in self.cancelled:
+                    self.cancelled.discard(ident)
+                    continue
+                func(*args)
+                if not self.running:
+                    break
+
+    def quit(self):
+        """Leave mainloop"""
+        self.running = False
+
+    def destroy(self):
+        """Leave mainloop and close the display"""
+        self.running = False
+        self.withdraw()
+
+
+class Widget:
+    """A screen rectangle that redraws itself when configured"""
+
+    def __init__(self, root, rect, background):
+        """Remember where the widget lives on screen"""
+        self.root = root
+        self.rect = pygame.Rect(rect)
+        self.background = background
+
+    def clear(self):
+        """Fill the widget with the background and mark it for update"""
+        self.root.surface.fill(self.background, self.rect)
+        self.root.update(self.rect)
+
+
+class Text(Widget):
+    """Centered single-line text, configured like a Tk Label"""
+
+    def __init__(self, root, rect, background, text, fg, font):
+        """Draw the initial text"""
+        super().__init__(root, rect, background)
+        self.text = text
+        self.fg = fg
+        self.font = font
+        self.draw()
+
+    def draw(self):
+        """Render the current text"""
+        self.clear()
+        image = self.font.render(self.text, True, self.fg)
+        self.root.surface.blit(image, image.get_rect(center=self.rect.center))
+
+    def config(self, text=None, fg=None):
+        """Change the text and/or color"""
+        self.text = self.text if text is None else text
+        self.fg = self.fg if fg is None else fg
+        self.draw()
+
+
+class Slot(Widget):
+    """An input slot showing a glyph, configured like a Tk image Label"""
+
+    def __init__(self, root, rect, background, border, image):
+        """Draw the slot border and initial glyph"""
+        super().__init__(root, rect, background)
+        pygame.draw.rect(root.surface, border, self.rect.inflate(2, 2), 1)
+        self.config(image=image)
+
+    def config(self, image):
+        """Show a glyph surface"""
+        self.root.surface.blit(image, self.rect)
+        self.root.update(self.rect)
+
+
+class TimerBar(Widget):
+    """The countdown bar, configured like the Tk canvas rectangle"""
+
+    def __init__(self, root, rect, background, fill, border):
+        """Draw the border and a full bar"""
+        super().__init__(root, rect, background)
+        self.fill = fill
+        pygame.draw.rect(root.surface, border, self.rect.inflate(2, 2), 1)
+        self.coords(None, 0, 0, self.rect.width, self.rect.height)
+
+    def coords(self, item, x1, y1, x2, y2):
+        """Set the bar to span x1..x2"""
+        self.clear()
+        self.root.surface.fill(self.fill, (self.rect.x + x1, self.rect.y + y1, x2 - x1, y2 - y1))
+
+
+class Layout:
+    """Places the validation screen's parts top to bottom, like the Tk packer"""
+
+    def __init__(self, root, colors):
+        """Clear the screen"""
+        self.root = root
+        self.colors = colors
+        self.width, self.height = root.surface.get_size()
+        self.y = 0
+        root.surface.fill(colors["background"])
+        root.update()
+
+    def text(self, text, fg, size, bold=False, before=0, after=0):
+        """Add a line of centered text"""
+        font = get_font(size, bold)
+        self.y += before
+        rect = (0, self.y, self.width, font.get_linesize())
+        self.y += font.get_linesize() + after
+        return Text(self.root, rect, self.colors["background"], text, fg, font)
+
+    def footer(self, text, fg, size, after=0):
+        """Add a line of centered text at the bottom of the screen"""
+        font = get_font(size)
+        rect = (0, self.height - after - font.get_linesize(), self.width, font.get_linesize())
+        return Text(self.root, rect, self.colors["background"], text, fg, font)
+
+    def box(self, top, bottom):
+        """Outline the area from top to the current position"""
+        rect = pygame.Rect(50, top, self.width - 100, bottom - top)
+        pygame.draw.rect(self.root.surface, self.colors["highlight"], rect, 2)
+
+    def grid(self, count, per_row, pitch, before=0, after=0):
+        """Return the top-left corners of count cells, per_row to a row"""
+        self.y += before
+        cells = []
+        for i in range(count):
+            columns = min(per_row, count - i // per_row * per_row)
+            left = (self.width - columns * pitch) // 2 + 5
+            cells.append((left + i % per_row * pitch, self.y + i // per_row * (move_glyphs.SIZE + 4)))
+        rows = (count + per_row - 1) // per_row
+        self.y += rows * (move_glyphs.SIZE + 4) + after
+        return cells
+
+    def destroy(self):
+        """Blank the screen"""
+        if self.root.surface is not None:
+            self.root.surface.fill(self.colors["background"])
+            self.root.update()
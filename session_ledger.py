@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Session Ledger
+Turns runcommand.log and time_tracker.log into per-session records kept
+in a columnar store, and answers usage and revenue queries from it
+"""
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import array
+import argparse
+from collections import Counter, defaultdict
+
+# Configuration
+CONFIG = {
+    "hook_log": "/home/pi/arcade/logs/runcommand.log",
+    "tracker_log": "/home/pi/arcade/logs/time_tracker.log",
+    "ledger": "/home/pi/arcade/ledger",  # Column files and checkpoint
+    "rotated": 3,          # Rotated copies (log.1 ... log.3) to read
+    "join_window": 300,    # Seconds from a validation to its tracking start
+    "grace": 60            # Seconds to wait for "Force killed" after "Time expired"
+}
+
+# How sessions ended, stored as one byte
+REASONS = ("closed_early", "terminated", "force_killed", "cancelled")
+
+# Every timezone's offset from UTC is a whole number of quarter hours, so
+# a quarter-hour slot never straddles a local hour, day or month
+SLOT = 900
+
+# Tables and their columns (array typecodes). Game names are stored as
+# indexes into the "games" list in checkpoint.json.
+TABLES = {
+    "sessions": (("start", "q"), ("duration", "i"), ("game", "I"),
+                 ("minutes", "H"), ("reason", "B"), ("validated", "B")),
+    "validations": (("time", "q"), ("game", "I"), ("ok", "B"))
+}
+
+# Line layouts: arcade_log ("2026-01-31 20:15:02 hook INFO msg"), the
+# tracker's old basicConfig ("2026-01-31 20:15:02,123 - msg") and the
+# hook's old $(date) prefix ("Sat Jan 31 20:15:02 UTC 2026 - msg")
+ISO_LINE = re.compile(rb"(\d{4}-\d\d-\d\d \d\d):(\d\d):(\d\d)(?:,\d+ -| \S+ \S+) (.*)")
+DATE_LINE = re.compile(rb"\w{3} (\w{3}) +(\d+) (\d\d):(\d\d):(\d\d) (?:\S+ )?(\d{4}) - (.*)")
+MONTHS = {m.encode(): i for i, m in enumerate(
+    ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"), 1)}
+
+# Events, tried in order against each message
+EVENTS = [
+    ("run", re.compile(rb"Running validation for (.*)")),
+    ("valid", re.compile(rb"Validation successful")),
+    ("invalid", re.compile(rb"Validation failed for (.*) \(exit code")),
+    ("start", re.compile(rb"Started tracking (.*) \(PID: \d+\) for (\d+) minutes")),
+    ("closed", re.compile(rb"Game (.*) closed before time limit")),
+    ("expired", re.compile(rb"Time expired for (.*), terminating")),
+    ("killed", re.compile(rb"Force killed (.*)")),
+    ("stopped", re.compile(rb"Stopped tracking (.*) \(PID: \d+\)")),
+    ("extended", re.compile(rb"Extended (.*) \(PID: \d+\) by (\d+) minutes"))
+]
+
+
+class LineParser:
+    """Turns log lines into (time, kind, fields) events"""
+
+    def __init__(self, events=None):
+        """Match messages against events ((kind, pattern) pairs, tried in order)"""
+        self.events = events or EVENTS
+        self.hour_epochs = {}
+
+    def timestamp(self, line):
+        """Return (epoch seconds, message) for a log line, or None"""
+        match = ISO_LINE.match(line)
+        if match:
+            hour, minute, second, message = match.groups()
+            # mktime once per hour of log rather than once per line
+            base = self.hour_epochs.get(hour)
+            if base is None:
+                base = self.hour_epochs[hour] = int(time.mktime(time.strptime(hour.decode(), "%Y-%m-%d %H")))
+            return base + int(minute) * 60 + int(second), message
+        match = DATE_LINE.match(line)
+        if match and match.group(1) in MONTHS:
+            month, day, hour, minute, second, year, message = match.groups()
+            moment = (int(year), MONTHS[month], int(day), int(hour), int(minute), int(second), 0, 0, -1)
+            return int(time.mktime(moment)), message
+        return None
+
+    def event(self, line):
+        """Return (epoch seconds, kind, fields) for a log line, or None"""
+        parsed = self.timestamp(line)
+        if parsed is None:
+            return None
+        moment, message = parsed
+        for kind, pattern in self.events:
+            match = pattern.match(message)
+            if match:
+                return moment, kind, [field.decode(errors="replace") for field in match.groups()]
+        return None
+
+
+class Table:
+    """Append-only columns, one binary file per column"""
+
+    def __init__(self, directory, name, columns):
+        """Load the columns, dropping rows past the checkpointed count"""
+        self.paths = {column: os.path.join(directory, f"{name}.{column}") for column, _ in columns}
+        self.columns = {column: array.array(code) for column, code in columns}
+        self.saved = 0
+
+    def load(self, rows):
+        """Read the first rows rows of every column"""
+        for column, values in self.columns.items():
+            path = self.paths[column]
+            if not os.path.exists(path):
+                continue
+            with open(path, "r+b") as f:
+                # A crash between writing columns and the checkpoint
+                # leaves extra rows; the checkpoint is the truth
+                f.truncate(rows * values.itemsize)
+                values.fromfile(f, rows)
+        self.saved = rows
+
+    def append(self, **row):
+        """Add a row"""
+        for column, values in self.columns.items():
+            values.append(row[column])
+
+    def __len__(self):
+        """Number of rows"""
+        return len(next(iter(self.columns.values())))
+
+    def save(self):
+        """Append rows added since the last save to the column files"""
+        for column, values in self.columns.items():
+            with open(self.paths[column], "ab") as f:
+                values[self.saved:].tofile(f)
+        self.saved = len(self)
+
+
+class Ledger:
+    """Session records built incrementally from the logs
+
+    checkpoint.json holds, per log file inode, how far it has been read,
+    plus sessions still in progress, so each update only reads bytes
+    appended (or rotated in) since the last one.
+    """
+
+    def __init__(self, directory=None):
+        """Open the ledger, creating it if needed"""
+        self.directory = directory or CONFIG["ledger"]
+        os.makedirs(self.directory, exist_ok=True)
+        self.checkpoint_path = os.path.join(self.directory, "checkpoint.json")
+        try:
+            with open(self.checkpoint_path) as f:
+                self.checkpoint = json.load(f)
+        except FileNotFoundError:
+            self.checkpoint = {"offsets": {}, "rows": {}, "games": [], "state": {}}
+
+        self.games = self.checkpoint["games"]
+        self.game_ids = {game: i for i, game in enumerate(self.games)}
+        self.tables = {}
+        for name, columns in TABLES.items():
+            table = Table(self.directory, name, columns)
+            table.load(self.checkpoint["rows"].get(name, 0))
+            self.tables[name] = table
+
+        state = self.checkpoint["state"]
+        self.hook_game = state.get("hook_game")
+        self.validated = state.get("validated", {})  # game -> validation time
+        self.open = state.get("open", {})            # game -> session in progress
+        self.parser = LineParser()
+
+    def game_id(self, game):
+        """Return the dictionary index for a game name"""
+        index = self.game_ids.get(game)
+        if index is None:
+            index = self.game_ids[game] = len(self.games)
+            self.games.append(game)
+        return index
+
+    def read_events(self, path, events):
+        """Append (time, order, kind, fields) for new lines of path and its rotations"""
+        offsets = self.checkpoint["offsets"]
+        for index in range(CONFIG["rotated"], -1, -1):
+            name = f"{path}.{index}" if index else path
+            try:
+                fd = os.open(name, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                stat = os.fstat(fd)
+                key = f"{stat.st_dev}:{stat.st_ino}"
+                offset = offsets.get(key, 0)
+                if stat.st_size < offset:
+                    offset = 0  # Truncated and rewritten
+                if stat.st_size == offset:
+                    offsets[key] = offset
+                    continue
+                with mmap.mmap(fd, stat.st_size, prot=mmap.PROT_READ) as data:
+                    # Stop at the last complete line; the rest is read next
+                    # time. Rotated files are finished, so read all of them.
+                    end = stat.st_size if index else data.rfind(b"\n", offset) + 1
+                    while offset < end:
+                        newline = data.find(b"\n", offset, end)
+                        if newline < 0:
+                            newline = end
+                        event = self.parser.event(data[offset:newline])
+                        offset = newline + 1
+                        if event is not None:
+                            moment, kind, fields = event
+                            events.append((moment, len(events), kind, fields))
+                offsets[key] = max(end, offsets.get(key, 0))
+            finally:
+                os.close(fd)
+        return events
+
+    def close_session(self, game, end, reason):
+        """Write out the session in progress for game"""
+        session = self.open.pop(game)
+        self.tables["sessions"].append(
+            start=session["start"], duration=max(0, end - session["start"]),
+            game=self.game_id(game), minutes=min(session["minutes"], 65535),
+            reason=REASONS.index(reason), validated=session["validated"])
+
+    def apply(self, moment, kind, fields):
+        """Fold one event into the ledger"""
+        if kind == "run":
+            self.hook_game = fields[0]
+        elif kind in ("valid", "invalid"):
+            game = fields[0] if kind == "invalid" else self.hook_game
+            if game is None:
+                return
+            ok = kind == "valid"
+            self.tables["validations"].append(time=moment, game=self.game_id(game), ok=int(ok))
+            if ok:
+                self.validated[game] = moment
+        elif kind == "start":
+            game = fields[0]
+            self.finish_expired(game)
+            if game in self.open:
+                # The previous session's end never made it into the log
+                self.close_session(game, moment, "terminated")
+            since = self.validated.pop(game, None)
+            validated = since is not None and moment - since <= CONFIG["join_window"]
+            self.open[game] = {"start": moment, "minutes": int(fields[1]),
+                               "validated": int(validated), "expired": None}
+        elif fields[0] not in self.open:
+            return
+        elif kind == "extended":
+            self.open[fields[0]]["minutes"] += int(fields[1])
+        elif kind == "expired":
+            # Wait a little for a "Force killed" before deciding how it ended
+            self.open[fields[0]]["expired"] = moment
+        elif kind == "closed":
+            self.close_session(fields[0], moment, "closed_early")
+        elif kind == "killed":
+            session = self.open[fields[0]]
+            self.close_session(fields[0], session["expired"] or moment, "force_killed")
+        elif kind == "stopped":
+            self.close_session(fields[0], moment, "cancelled")
+
+    def finish_expired(self, game, now=None):
+        """Close an expired session whose grace period has passed"""
+        session = self.open.get(game)
+        if session and session["expired"] is not None:
+            if now is None or now - session["expired"] > CONFIG["grace"]:
+                self.close_session(game, session["expired"], "terminated")
+
+    def update(self):
+        """Read new log lines and append the sessions they complete
+
+        The tracker log is read before the hook log, so a start read here
+        has its validation in the same batch or an earlier one (a
+        validation is always logged before its tracking starts). Within
+        one second hook events sort first: the tracker often logs the
+        start in the same second as "Validation successful".
+        """
+        events = self.read_events(CONFIG["tracker_log"], [])
+        tracked = len(events)
+        self.read_events(CONFIG["hook_log"], events)
+        events.sort(key=lambda event: (event[0], event[1] < tracked, event[1]))
+        for moment, _, kind, fields in events:
+            self.apply(moment, kind, fields)
+        now = time.time()
+        for game in list(self.open):
+            self.finish_expired(game, now)
+        self.save()
+        return len(events)
+
+    def save(self):
+        """Append new rows, then record them in the checkpoint"""
+        for table in self.tables.values():
+            table.save()
+        self.checkpoint["rows"] = {name: len(table) for name, table in self.tables.items()}
+        self.checkpoint["state"] = {"hook_game": self.hook_game,
+                                    "validated": self.validated, "open": self.open}
+        temp = self.checkpoint_path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(self.checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.checkpoint_path)
+
+
+def bucket_label(moment, per):
+    """Format a timestamp as its local hour, day or month"""
+    layout = {"hour": "%Y-%m-%d %H:00", "day": "%Y-%m-%d", "month": "%Y-%m"}[per]
+    return time.strftime(layout, time.localtime(moment))
+
+
+def selected_rows(ledger, table, time_column, args):
+    """Indexes of rows matching --game and --since"""
+    columns = ledger.tables[table].columns
+    times = columns[time_column]
+    since = time.mktime(time.strptime(args.since, "%Y-%m-%d")) if args.since else None
+    game = ledger.game_ids.get(args.game, -1) if args.game else None
+    return [i for i in range(len(times))
+            if (since is None or times[i] >= since) and (game is None or columns["game"][i] == game)]
+
+
+def plays(ledger, args):
+    """Print plays per game per hour, day or month"""
+    sessions = ledger.tables["sessions"].columns
+    # Count per slot first, so only one time per slot is formatted
+    counts = Counter()
+    for i in selected_rows(ledger, "sessions", "start", args):
+        counts[(sessions["start"][i] // SLOT, sessions["game"][i])] += 1
+    totals = Counter()
+    for (slot, game), count in counts.items():
+        totals[(bucket_label(slot * SLOT, args.per), ledger.games[game])] += count
+    for (label, game), count in sorted(totals.items()):
+        print(f"{label}\t{game}\t{count}")
+
+
+def lengths(ledger, args):
+    """Print session count, average length and end reasons per game"""
+    sessions = ledger.tables["sessions"].columns
+    stats = defaultdict(lambda: [0, 0, Counter()])
+    for i in selected_rows(ledger, "sessions", "start", args):
+        entry = stats[sessions["game"][i]]
+        entry[0] += 1
+        entry[1] += sessions["duration"][i]
+        entry[2][REASONS[sessions["reason"][i]]] += 1
+    print("game\tsessions\tavg_minutes\t" + "\t".join(REASONS))
+    for game, (count, total, reasons) in sorted(stats.items(), key=lambda item: ledger.games[item[0]]):
+        ends = "\t".join(str(reasons[reason]) for reason in REASONS)
+        print(f"{ledger.games[game]}\t{count}\t{total / count / 60:.1f}\t{ends}")
+
+
+def validations(ledger, args):
+    """Print successful and failed validations per game"""
+    columns = ledger.tables["validations"].columns
+    counts = defaultdict(lambda: [0, 0])
+    for i in selected_rows(ledger, "validations", "time", args):
+        counts[columns["game"][i]][columns["ok"][i]] += 1
+    print("game\tsucceeded\tfailed")
+    for game, (failed, succeeded) in sorted(counts.items(), key=lambda item: ledger.games[item[0]]):
+        print(f"{ledger.games[game]}\t{succeeded}\t{failed}")
+
+
+def main():
+    """Main entry point"""
+    parser = argparse.ArgumentParser(description="Session ledger built from the arcade logs")
+    parser.add_argument("--ledger", default=CONFIG["ledger"], help="ledger directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("update", help="read new log lines only")
+    for name, description in (("plays", "plays per game per hour/day/month"),
+                              ("lengths", "average session length per game"),
+                              ("validations", "validation outcomes per game")):
+        command = commands.add_parser(name, help=description)
+        command.add_argument("--game", help="only this game")
+        command.add_argument("--since", help="only from this date (YYYY-MM-DD)")
+        if name == "plays":
+            command.add_argument("--per", choices=("hour", "day", "month"), default="hour")
+    args = parser.parse_args()
+
+    ledger = Ledger(args.ledger)
+    # Queries catch up on the logs first; that only reads new bytes
+    count = ledger.update()
+    if args.command == "update":
+        print(f"Read {count} new events; {len(ledger.tables['sessions'])} sessions in the ledger")
+    elif args.command == "plays":
+        plays(ledger, args)
+    elif args.command == "lengths":
+        lengths(ledger, args)
+    else:
+        validations(ledger, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Session State
+Fixed-size session records in a memory-mapped file, so the tracker can
+pick its sessions back up after a crash or restart
+"""
+import os
+import sys
+import time
+import mmap
+import struct
+
+# Configuration
+CONFIG = {
+    "path": "/home/pi/arcade/sessions.state",  # Survives reboots (unlike /run)
+    "slots": 16                                # Most sessions tracked at once
+}
+
+# Header: magic, boot id of the boot the records belong to
+HEADER = struct.Struct("<4s16s12x")
+MAGIC = b"ATS1"
+
+# Record: state, pid, process start time (to spot a reused pid), started,
+# deadline, checkpoint (time.monotonic(), which counts from boot and so
+# stays valid across tracker restarts), remaining seconds (while paused,
+# or as a credit) and the game name
+RECORD = struct.Struct("<B3xIQdddd56s")
+CHECKPOINT_OFFSET = 1 + 3 + 4 + 8 + 8 + 8  # Where the checkpoint field starts
+
+FREE, RUNNING, PAUSED, CREDIT = range(4)
+STATES = ("free", "running", "paused", "credit")
+
+
+def boot_id():
+    """Return this boot's 16-byte id"""
+    with open("/proc/sys/kernel/random/boot_id") as f:
+        return bytes.fromhex(f.read().strip().replace("-", ""))
+
+
+def process_start_time(pid):
+    """Return pid's start time in clock ticks since boot, or None if it is gone"""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # Fields after the command name, which may itself contain ") "
+    fields = stat[stat.rindex(b")") + 2:].split()
+    return int(fields[19])
+
+
+def encode_game(game):
+    """Return the game name as stored in a record (truncated to fit)"""
+    return game.encode()[:56].decode(errors="ignore")
+
+
+class SessionState:
+    """The tracker's sessions, one fixed-size record per slot
+
+    Records are rewritten in place and msync'd when a session starts,
+    pauses, resumes, is extended or ends. checkpoint() only stamps the
+    time on every live record, so after a reboot the remaining time is
+    known to within one checkpoint interval.
+    """
+
+    def __init__(self, path=None, slots=None):
+        """Map the state file, creating it if needed"""
+        self.path = path or CONFIG["path"]
+        self.slots = slots or CONFIG["slots"]
+        size = HEADER.size + self.slots * RECORD.size
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size != size:
+            # New file or a different slot count: start empty
+            os.ftruncate(self.fd, 0)
+            os.ftruncate(self.fd, size)
+        self.data = mmap.mmap(self.fd, size)
+        magic, stored_boot = HEADER.unpack_from(self.data, 0)
+        self.boot = boot_id()
+        if magic != MAGIC:
+            self.data[:] = bytes(size)
+            HEADER.pack_into(self.data, 0, MAGIC, self.boot)
+            self.data.flush()
+        # Records from an earlier boot hold no live processes, only time owed
+        self.previous_boot = magic == MAGIC and stored_boot != self.boot
+
+    def close(self):
+        """Unmap the state file"""
+        self.data.close()
+        os.close(self.fd)
+
+    def offset(self, slot):
+        """Return the file offset of a slot's record"""
+        return HEADER.size + slot * RECORD.size
+
+    def read(self, slot):
+        """Return a slot's record as a dict"""
+        state, pid, start_time, started, deadline, checkpoint, remaining, game = \
+            RECORD.unpack_from(self.data, self.offset(slot))
+        return {"slot": slot, "state": state, "pid": pid, "start_time": start_time,
+                "started": started, "deadline": deadline, "checkpoint": checkpoint,
+                "remaining": remaining, "game": game.rstrip(b"\0").decode(errors="ignore")}
+
+    def records(self):
+        """Yield every record that is in use"""
+        for slot in range(self.slots):
+            if self.data[self.offset(slot)] != FREE:
+                yield self.read(slot)
+
+    def allocate(self):
+        """Return a free slot, or None if every slot is in use"""
+        for slot in range(self.slots):
+            if self.data[self.offset(slot)] == FREE:
+                return slot
+        return None
+
+    def write(self, slot, state, pid=0, start_time=0, started=0.0, deadline=0.0,
+              checkpoint=0.0, remaining=0.0, game=""):
+        """Rewrite a slot's record and sync it to disk"""
+        RECORD.pack_into(self.data, self.offset(slot), state, pid, start_time, started,
+                         deadline, checkpoint, remaining, encode_game(game).encode())
+        self.data.flush()
+
+    def free(self, slot):
+        """Mark a slot unused"""
+        self.data[self.offset(slot)] = FREE
+        self.data.flush()
+
+    def checkpoint(self, now):
+        """Stamp every running record with now, with one msync for the file"""
+        for slot in range(self.slots):
+            offset = self.offset(slot)
+            if self.data[offset] == RUNNING:
+                struct.pack_into("<d", self.data, offset + CHECKPOINT_OFFSET, now)
+        self.data.flush()
+
+    def adopt_boot(self):
+        """Mark the records as belonging to this boot"""
+        HEADER.pack_into(self.data, 0, MAGIC, self.boot)
+        self.data.flush()
+        self.previous_boot = False
+
+
+def main():
+    """Print the state file's records"""
+    path = sys.argv[1] if len(sys.argv) > 1 else CONFIG["path"]
+    state = SessionState(path)
+    try:
+        for record in state.records():
+            if record["state"] == RUNNING and not state.previous_boot:
+                record["remaining"] = max(0, record["deadline"] - time.monotonic())
+            print(f"{record['slot']}\t{STATES[record['state']]}\t{record['pid']}\t"
+                  f"{record['game']}\t{record['remaining']:.0f}s")
+    finally:
+        state.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,72 +5,585 @@ Monitors game processes and terminates them after time limit
 """
 import sys
 import os
+import math
 import time
+import heapq
+import errno
+import select
 import signal
 import logging
-from datetime import datetime
+import selectors
+import local_socket
+import arcade_log
+import metrics
+import session_state
+from emulator_pid import resolve_emulator_pid
 
-# Configure logging
+# Log files
 LOG_FILE = "/home/pi/arcade/logs/time_tracker.log"
-os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
 
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.INFO,
-    format='%(asctime)s - %(message)s')
+# Configuration
+CONFIG = {
+    "grace_period": 5,    # Seconds between SIGTERM and SIGKILL
+    "poll_interval": 10,  # Seconds between checks when pidfds are unavailable
+    "checkpoint_interval": 30,  # Seconds between state file checkpoints
+    "topup_minutes": 30,  # Time added by entering another code (--topup)
+    "socket": "/home/pi/arcade/run/time_tracker.sock"  # Supervisor socket
+}
+
+# Metrics, added to /home/pi/arcade/metrics/time_tracker.prom as sessions end
+METRICS = metrics.Registry("time_tracker")
+SESSION_LENGTH = METRICS.histogram(
+    "arcade_session_duration_seconds", "How long tracked games ran",
+    (60, 300, 600, 900, 1200, 1800, 2700, 3600, 7200))
+SESSION_ENDS = METRICS.counter(
+    "arcade_session_ends_total", "Tracked games by how they ended", "reason",
+    ("closed_early", "terminated", "force_killed", "cancelled"))
+
+def setup_logging():
+    """Configure queued logging (done in main so the module can be imported)"""
+    arcade_log.setup("time_tracker", LOG_FILE)
+
+def open_pidfd(pid):
+    """Return a pidfd for pid, or None if the kernel doesn't support them
+    
+    Raises ProcessLookupError if the process has already exited.
+    """
+    try:
+        return os.pidfd_open(pid)
+    except AttributeError:
+        return None
+    except OSError as e:
+        if e.errno in (errno.ENOSYS, errno.EPERM):
+            return None
+        raise
+
+def process_exists(pid):
+    """Check whether a process exists"""
+    try:
+        os.kill(pid, 0)  # Signal 0 tests if process exists
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def wait_for_exit(pid, pidfd, timeout):
+    """Wait up to timeout seconds for pid to exit, returning True if it did"""
+    if pidfd is not None:
+        # The pidfd becomes readable the moment the process exits
+        poller = select.poll()
+        poller.register(pidfd, select.POLLIN)
+        return bool(poller.poll(max(timeout, 0) * 1000))
+    
+    # Fallback for kernels without pidfd_open
+    deadline = time.monotonic() + timeout
+    while process_exists(pid):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(CONFIG["poll_interval"], remaining))
+    return True
+
+def signal_game(pid, sig):
+    """Send sig to the game's whole process group when it leads one
+    
+    runcommand usually starts the emulator as a group leader. If it shares
+    a group with something else (e.g. EmulationStation or this tracker),
+    only the emulator itself is signalled.
+    """
+    pgid = os.getpgid(pid)
+    if pgid == pid and pgid != os.getpgrp():
+        os.killpg(pgid, sig)
+    else:
+        os.kill(pid, sig)
+
+def record_session(started, reason):
+    """Count a finished session and export the metrics"""
+    SESSION_LENGTH.observe(time.monotonic() - started)
+    SESSION_ENDS.inc(reason)
+    METRICS.flush()
+
+def terminate_game(pid, pidfd, game_name):
+    """Stop a game with SIGTERM, escalating to SIGKILL if it doesn't exit
+    
+    Returns "force_killed" if SIGKILL was needed, otherwise "terminated".
+    """
+    try:
+        # First try a graceful termination
+        signal_game(pid, signal.SIGTERM)
+        
+        # Wait for it to close, but no longer than the grace period
+        if wait_for_exit(pid, pidfd, CONFIG["grace_period"]):
+            return "terminated"
+        
+        # Process still exists, force kill
+        signal_game(pid, signal.SIGKILL)
+        logging.info(f"Force killed {game_name}")
+        return "force_killed"
+    except ProcessLookupError:
+        # Process already terminated
+        pass
+    except Exception as e:
+        logging.error(f"Error terminating game: {e}")
+    return "terminated"
 
 def track_game_time(pid, game_name, minutes):
     """Track a game and terminate it after specified time"""
     logging.info(f"Started tracking {game_name} (PID: {pid}) for {minutes} minutes")
     
-    end_time = time.time() + (minutes * 60)
+    pid = int(pid)
+    pidfd = None
+    started = time.monotonic()
     
     try:
-        # Monitor the game
-        while time.time() < end_time:
-            # Check if process still exists
-            try:
-                os.kill(int(pid), 0)  # Signal 0 tests if process exists
-            except OSError:
-                # Game already closed
-                logging.info(f"Game {game_name} closed before time limit")
-                return
-                
-            # Wait 10 seconds before checking again
-            time.sleep(10)
-            
+        try:
+            pidfd = open_pidfd(pid)
+        except ProcessLookupError:
+            logging.info(f"Game {game_name} closed before time limit")
+            record_session(started, "closed_early")
+            return
+        
+        # Monitor the game, sleeping until it exits or time runs out
+        if wait_for_exit(pid, pidfd, minutes * 60):
+            logging.info(f"Game {game_name} closed before time limit")
+            record_session(started, "closed_early")
+            return
+        
         # Time's up - terminate the game
         logging.info(f"Time expired for {game_name}, terminating")
-        try:
-            # First try a graceful termination
-            os.kill(int(pid), signal.SIGTERM)
-            
-            # Wait a moment to let it close
-            time.sleep(2)
+        record_session(started, terminate_game(pid, pidfd, game_name))
+        
+    except Exception as e:
+        logging.error(f"Time tracking error: {e}")
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+class TrackerSupervisor:
+    """Tracks every running game session in a single process
+    
+    Deadlines live in a heap of (wake time, pid) entries; an entry is stale
+    (and skipped) once its session is gone or has been rescheduled. Game
+    exits arrive as readable pidfds, and add/extend/pause/resume/cancel/
+    claim/list requests arrive as JSON lines on a Unix socket.
+    
+    Every session also has a record in the session state file. A restarted
+    supervisor re-adopts the games still running; after a reboot, the time
+    left on each interrupted session becomes a credit that the next launch
+    of the same game claims instead of asking for a code.
+    """
+    
+    def __init__(self, socket_path, state=None):
+        """Start listening for requests"""
+        self.sessions = {}  # pid -> session record
+        self.heap = []
+        self.state = state or session_state.SessionState()
+        self.selector = selectors.DefaultSelector()
+        self.recover()
+        self.next_checkpoint = time.monotonic() + CONFIG["checkpoint_interval"]
+        self.server = local_socket.listen(socket_path)
+        self.selector.register(self.server, selectors.EVENT_READ, None)
+        logging.info(f"Supervisor listening on {socket_path}")
+    
+    def recover(self):
+        """Re-adopt sessions from the state file, or turn them into credits
+        
+        Looks at each record once: a game from this boot that is still
+        running (same pid and start time) is tracked again, one that is
+        gone is dropped, and any session from an earlier boot is owed the
+        time it had left at its last checkpoint.
+        """
+        now = time.monotonic()
+        for record in self.state.records():
+            slot, game = record["slot"], record["game"]
+            if record["state"] == session_state.CREDIT:
+                continue
+            if self.state.previous_boot:
+                remaining = record["remaining"]
+                if record["state"] == session_state.RUNNING:
+                    remaining = record["deadline"] - record["checkpoint"]
+                if remaining > 0:
+                    self.state.write(slot, session_state.CREDIT, remaining=remaining, game=game)
+                    logging.info(f"Credited {game} with {remaining:.0f}s left when the cabinet restarted")
+                else:
+                    self.state.free(slot)
+                continue
             
-            # Check if it's still running
+            pid = record["pid"]
+            if session_state.process_start_time(pid) != record["start_time"]:
+                logging.info(f"Game {game} (PID: {pid}) ended while the tracker was down")
+                self.state.free(slot)
+                continue
             try:
-                os.kill(int(pid), 0)
-                # If we get here, process still exists, force kill
-                os.kill(int(pid), signal.SIGKILL)
-                logging.info(f"Force killed {game_name}")
-            except OSError:
-                # Process already terminated
-                pass
-                
+                pidfd = open_pidfd(pid)
+            except ProcessLookupError:
+                self.state.free(slot)
+                continue
+            paused = record["state"] == session_state.PAUSED
+            session = {
+                "pid": pid,
+                "game": game,
+                "pidfd": pidfd,
+                "slot": slot,
+                "start_time": record["start_time"],
+                "started": record["started"],
+                "deadline": record["deadline"],
+                "paused": paused,
+                "remaining": record["remaining"],
+                "terminating": False
+            }
+            self.sessions[pid] = session
+            if pidfd is not None:
+                self.selector.register(pidfd, selectors.EVENT_READ, pid)
+            self.schedule(session)
+            left = session["remaining"] if paused else session["deadline"] - now
+            logging.info(f"Re-adopted {game} (PID: {pid}) with {max(0, left):.0f}s left")
+        self.state.adopt_boot()
+    
+    def save(self, session):
+        """Write a session's record to the state file"""
+        self.state.write(
+            session["slot"], session_state.PAUSED if session["paused"] else session_state.RUNNING,
+            pid=session["pid"], start_time=session["start_time"], started=session["started"],
+            deadline=session["deadline"], checkpoint=time.monotonic(),
+            remaining=session["remaining"], game=session["game"])
+    
+    def schedule(self, session):
+        """Push the session's next wake time onto the heap"""
+        # A paused game has no deadline until it is resumed
+        wake = float("inf") if session["paused"] else session["deadline"]
+        if session["pidfd"] is None:
+            # Without a pidfd, exits are only noticed by checking periodically
+            wake = min(wake, time.monotonic() + CONFIG["poll_interval"])
+        session["wake"] = wake
+        heapq.heappush(self.heap, (wake, session["pid"]))
+    
+    def add(self, pid, game_name, minutes):
+        """Start tracking a game"""
+        pid = int(pid)
+        if pid in self.sessions:
+            raise ValueError(f"PID {pid} is already tracked")
+        slot = self.state.allocate()
+        if slot is None:
+            raise ValueError("No free session slots")
+        logging.info(f"Started tracking {game_name} (PID: {pid}) for {minutes} minutes")
+        started = time.monotonic()
+        try:
+            pidfd = open_pidfd(pid)
+            start_time = session_state.process_start_time(pid)
+            if start_time is None:
+                raise ProcessLookupError(pid)
+        except ProcessLookupError:
+            logging.info(f"Game {game_name} closed before time limit")
+            record_session(started, "closed_early")
+            return
+        
+        session = {
+            "pid": pid,
+            "game": game_name,
+            "pidfd": pidfd,
+            "slot": slot,
+            "start_time": start_time,
+            "started": started,
+            "deadline": started + minutes * 60,
+            "paused": False,
+            "remaining": 0.0,
+            "terminating": False
+        }
+        self.sessions[pid] = session
+        self.save(session)
+        if pidfd is not None:
+            self.selector.register(pidfd, selectors.EVENT_READ, pid)
+        self.schedule(session)
+    
+    def extend(self, pid, minutes):
+        """Give a running game more time"""
+        session = self.sessions[int(pid)]
+        if session["terminating"]:
+            raise ValueError(f"PID {pid} is already being terminated")
+        if session["paused"]:
+            session["remaining"] += minutes * 60
+        else:
+            session["deadline"] += minutes * 60
+        self.save(session)
+        self.schedule(session)
+        logging.info(f"Extended {session['game']} (PID: {pid}) by {minutes} minutes")
+    
+    def pause(self, pid):
+        """Stop a game (SIGSTOP) and its clock"""
+        session = self.sessions[int(pid)]
+        if session["terminating"] or session["paused"]:
+            raise ValueError(f"PID {pid} can't be paused")
+        signal_game(session["pid"], signal.SIGSTOP)
+        session["remaining"] = max(0.0, session["deadline"] - time.monotonic())
+        session["paused"] = True
+        self.save(session)
+        self.schedule(session)
+        logging.info(f"Paused {session['game']} (PID: {pid}) with {session['remaining']:.0f}s left")
+    
+    def resume(self, pid):
+        """Continue a paused game (SIGCONT) and its clock"""
+        session = self.sessions[int(pid)]
+        if not session["paused"]:
+            raise ValueError(f"PID {pid} is not paused")
+        session["deadline"] = time.monotonic() + session["remaining"]
+        session["paused"] = False
+        session["remaining"] = 0.0
+        self.save(session)
+        self.schedule(session)
+        signal_game(session["pid"], signal.SIGCONT)
+        logging.info(f"Resumed {session['game']} (PID: {pid})")
+    
+    def claim(self, game_name):
+        """Use up a credit for game_name, returning its whole minutes (0 if none)"""
+        stored = session_state.encode_game(game_name)
+        for record in self.state.records():
+            if record["state"] == session_state.CREDIT and record["game"] == stored:
+                self.state.free(record["slot"])
+                return math.ceil(record["remaining"] / 60)
+        return 0
+    
+    def checkpoint(self):
+        """Stamp the running sessions' records with the time"""
+        now = time.monotonic()
+        self.state.checkpoint(now)
+        self.next_checkpoint = now + CONFIG["checkpoint_interval"]
+    
+    def remove(self, pid):
+        """Stop tracking a session"""
+        session = self.sessions.pop(pid)
+        self.state.free(session["slot"])
+        if session["pidfd"] is not None:
+            self.selector.unregister(session["pidfd"])
+            os.close(session["pidfd"])
+        return session
+    
+    def cancel(self, pid):
+        """Stop tracking a game without terminating it"""
+        session = self.remove(int(pid))
+        if session["paused"]:
+            signal_game(session["pid"], signal.SIGCONT)
+        logging.info(f"Stopped tracking {session['game']} (PID: {pid})")
+        record_session(session["started"], "cancelled")
+    
+    def list(self):
+        """Return a summary of every tracked session"""
+        now = time.monotonic()
+        return [
+            {
+                "pid": session["pid"],
+                "game": session["game"],
+                "remaining": int(session["remaining"]) if session["paused"]
+                             else max(0, int(session["deadline"] - now)),
+                "paused": session["paused"],
+                "terminating": session["terminating"]
+            }
+            for session in self.sessions.values()
+        ]
+    
+    def game_exited(self, pid):
+        """Handle a game process that has exited"""
+        session = self.remove(pid)
+        if not session["terminating"]:
+            logging.info(f"Game {session['game']} closed before time limit")
+            record_session(session["started"], "closed_early")
+        else:
+            record_session(session["started"], "terminated")
+    
+    def wake(self, session):
+        """Handle a session whose wake time has arrived"""
+        pid = session["pid"]
+        if session["pidfd"] is None and not process_exists(pid):
+            self.game_exited(pid)
+            return
+        if session["paused"] or time.monotonic() < session["deadline"]:
+            self.schedule(session)
+            return
+        
+        try:
+            if not session["terminating"]:
+                # Time's up - ask the game to close, then allow a grace period
+                logging.info(f"Time expired for {session['game']}, terminating")
+                signal_game(pid, signal.SIGTERM)
+                session["terminating"] = True
+                session["deadline"] = time.monotonic() + CONFIG["grace_period"]
+                self.schedule(session)
+                return
+            
+            # Process still exists after the grace period, force kill
+            signal_game(pid, signal.SIGKILL)
+            logging.info(f"Force killed {session['game']}")
+            reason = "force_killed"
+        except ProcessLookupError:
+            # Process already terminated
+            reason = "terminated"
         except Exception as e:
             logging.error(f"Error terminating game: {e}")
+            reason = "terminated"
+        self.remove(pid)
+        record_session(session["started"], reason)
+    
+    def handle_request(self):
+        """Answer one request on the supervisor socket"""
+        try:
+            conn, _ = self.server.accept()
+        except BlockingIOError:
+            return
+        try:
+            conn.settimeout(1.0)
+            message = local_socket.recv_message(conn)
+            if not message:
+                return
+            cmd = message.get("cmd")
+            try:
+                if cmd == "add":
+                    self.add(message["pid"], message["game"], message["minutes"])
+                elif cmd == "extend":
+                    self.extend(message["pid"], message["minutes"])
+                elif cmd == "pause":
+                    self.pause(message["pid"])
+                elif cmd == "resume":
+                    self.resume(message["pid"])
+                elif cmd == "cancel":
+                    self.cancel(message["pid"])
+                elif cmd == "claim":
+                    local_socket.send_message(conn, {"result": True, "minutes": self.claim(message["game"])})
+                    return
+                elif cmd != "list":
+                    raise ValueError(f"Unknown command: {cmd}")
+                reply = {"result": True, "sessions": self.list()}
+            except (KeyError, ValueError, TypeError, ProcessLookupError) as e:
+                reply = {"result": False, "error": str(e)}
+            local_socket.send_message(conn, reply)
+        except (OSError, ValueError) as e:
+            logging.error(f"Supervisor request error: {e}")
+        finally:
+            conn.close()
+    
+    def run(self):
+        """Serve requests and enforce deadlines until killed"""
+        while True:
+            # Drop heap entries for sessions that were removed or rescheduled
+            while self.heap:
+                wake, pid = self.heap[0]
+                session = self.sessions.get(pid)
+                if session and session["wake"] == wake:
+                    break
+                heapq.heappop(self.heap)
             
-    except Exception as e:
-        logging.error(f"Time tracking error: {e}")
+            wake = self.next_checkpoint
+            if self.heap:
+                wake = min(wake, self.heap[0][0])
+            timeout = max(0, wake - time.monotonic())
+            
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    self.handle_request()
+                elif key.data in self.sessions:
+                    self.game_exited(key.data)
+            
+            # Handle every session that is now due
+            now = time.monotonic()
+            if now >= self.next_checkpoint:
+                self.checkpoint()
+            while self.heap and self.heap[0][0] <= now:
+                wake, pid = heapq.heappop(self.heap)
+                session = self.sessions.get(pid)
+                if session and session["wake"] == wake:
+                    self.wake(session)
 
-if __name__ == "__main__":
+def send_to_supervisor(message):
+    """Send a request to the supervisor, returning None if it isn't running"""
+    try:
+        return local_socket.request(CONFIG["socket"], message, reply_timeout=5.0)
+    except OSError:
+        return None
+
+def start_tracking(pid, game_name, minutes):
+    """Hand a session to the supervisor, or track it here if none is running"""
+    reply = send_to_supervisor({"cmd": "add", "pid": int(pid), "game": game_name, "minutes": minutes})
+    if reply is not None:
+        if not reply.get("result"):
+            logging.error(f"Supervisor refused {game_name} (PID: {pid}): {reply.get('error')}")
+        return
+    
+    track_game_time(pid, game_name, minutes)
+
+def topup(pid):
+    """Pause a game, ask for another code and add time if it is accepted
+    
+    Returns the supervisor's last reply, or None if it isn't running.
+    """
+    reply = send_to_supervisor({"cmd": "pause", "pid": pid})
+    if reply is None or not reply.get("result"):
+        return reply
+    game_name = next(session["game"] for session in reply["sessions"] if session["pid"] == pid)
+    try:
+        import validation_client
+        if validation_client.validate_or_run(game_name):
+            send_to_supervisor({"cmd": "extend", "pid": pid, "minutes": CONFIG["topup_minutes"]})
+        else:
+            logging.info(f"Top-up for {game_name} (PID: {pid}) rejected")
+    finally:
+        reply = send_to_supervisor({"cmd": "resume", "pid": pid})
+    return reply
+
+def launch(runcommand_pid, emulator, rom, game_name, minutes):
+    """Wait for runcommand to start the emulator, then track it"""
+    pid = resolve_emulator_pid(int(runcommand_pid), rom, emulator)
+    if pid is None:
+        logging.error(f"Could not find emulator process for {game_name}")
+        return
+    logging.info(f"Emulator PID: {pid}")
+    start_tracking(pid, game_name, minutes)
+
+def main():
+    """Main entry point"""
+    setup_logging()
+    
+    if len(sys.argv) >= 2 and sys.argv[1] == "--supervisor":
+        TrackerSupervisor(CONFIG["socket"]).run()
+        return
+    
+    commands = ("--list", "--extend", "--pause", "--resume", "--topup", "--cancel")
+    if len(sys.argv) >= 2 and sys.argv[1] in commands:
+        if sys.argv[1] == "--list":
+            message = {"cmd": "list"}
+        elif sys.argv[1] == "--extend" and len(sys.argv) >= 4:
+            message = {"cmd": "extend", "pid": int(sys.argv[2]), "minutes": int(sys.argv[3])}
+        elif len(sys.argv) >= 3 and sys.argv[1] != "--extend":
+            message = {"cmd": sys.argv[1][2:], "pid": int(sys.argv[2])}
+        else:
+            print("Usage: python time_tracker.py --extend <pid> <minutes> | --pause|--resume|--topup|--cancel <pid>")
+            sys.exit(1)
+        if message["cmd"] == "topup":
+            reply = topup(message["pid"])
+        else:
+            reply = send_to_supervisor(message)
+        if reply is None:
+            print("Supervisor is not running")
+            sys.exit(1)
+        if not reply.get("result"):
+            print(f"Error: {reply.get('error')}")
+            sys.exit(1)
+        for session in reply["sessions"]:
+            paused = "\tpaused" if session["paused"] else ""
+            print(f"{session['pid']}\t{session['game']}\t{session['remaining']}s{paused}")
+        return
+    
     if len(sys.argv) < 4:
         print("Usage: python time_tracker.py <pid> <game_name> <minutes>")
+        print("       python time_tracker.py --supervisor | --list")
+        print("       python time_tracker.py --extend <pid> <minutes>")
+        print("       python time_tracker.py --pause | --resume | --topup | --cancel <pid>")
         sys.exit(1)
         
     pid = sys.argv[1]
     game_name = sys.argv[2]
     minutes = int(sys.argv[3])
     
-    track_game_time(pid, game_name, minutes)
+    start_tracking(pid, game_name, minutes)
+
+if __name__ == "__main__":
+    main()
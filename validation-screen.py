@@ -3,20 +3,38 @@
 Arcade Payment System - Code Validation Screen
 Handles Konami-style code validation with joystick input
 """
+import time
+IMPORT_STARTED = time.perf_counter()  # For --profile
 import os
 import sys
-import json
-import time
-import pygame
-import tkinter as tk
-from tkinter import font
-from datetime import datetime
+import logging
+from code_store import open_code_store
+import local_socket
+import arcade_log
+import metrics
+import joystick_input
+import move_glyphs
+IMPORTED = time.perf_counter()
+
+# Imported on first use: tkinter only by the Tk renderer, pygame only by
+# the SDL renderer or when the joystick has no evdev device, and
+# derived_codes only for the derived code scheme
+tk = font = None
 
 # Configuration
 CONFIG = {
     "fullscreen": True,          # Run in fullscreen mode
     "timeout": 60,               # Seconds to enter code
-    "database": "/home/pi/arcade/codes.json"  # Demo code database
+    "database": "/home/pi/arcade/codes.json",  # Demo code database
+    "code_store": "/home/pi/arcade/codes.db",  # Indexed code store
+    "code_scheme": "stored",     # "stored", "derived" (derived_codes.py) or "remote" (code_client.py)
+    "moves_per_row": 12,         # Move icons per row before wrapping
+    "renderer": "tk",            # "tk", or "sdl" to draw through SDL without X
+    "socket": "/home/pi/arcade/run/validation.sock",  # Daemon socket
+    "fetch_poll_ms": 100,        # How often to check whether a remote store's fetch finished
+    "demo_code": False,          # Accept the demo code when a game has no codes (free play)
+    # Startup limits checked by --profile (sized for a Pi 3)
+    "budgets": {"import_ms": 400, "first_frame_ms": 1500, "peak_rss_mb": 48}
 }
 
 # Color definitions
@@ -36,72 +54,218 @@ COLORS = {
     "incorrect": "#ff0000"  # Red
 }
 
+# Metrics, added to /home/pi/arcade/metrics/validation.prom after each game
+METRICS = metrics.Registry("validation")
+FIRST_FRAME = METRICS.histogram(
+    "arcade_validation_first_frame_seconds", "Time from opening the screen to its first frame",
+    (0.05, 0.1, 0.25, 0.5, 1, 2, 5))
+INPUT_LATENCY = METRICS.histogram(
+    "arcade_validation_input_latency_seconds", "Time from a move to its slot being redrawn",
+    (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25))
+CODE_LOAD = METRICS.histogram(
+    "arcade_validation_code_load_seconds", "Time to load a code from the code store",
+    (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+OUTCOMES = METRICS.counter(
+    "arcade_validation_outcomes_total", "Code entries by outcome", "outcome",
+    ("success", "incorrect", "timeout"))
+
+# Fonts, glyph images and joystick are created once per process so
+# the daemon keeps them warm between games
+FONTS = {}
+GLYPHS = {}
+JOYSTICK = {"ready": False, "device": None}
+
+def load_tk():
+    """Import tkinter, once"""
+    global tk, font
+    if tk is None:
+        import tkinter as tk
+        from tkinter import font
+
+def get_font(size, weight="normal"):
+    """Return a shared Arial font of the given size"""
+    key = (size, weight)
+    if key not in FONTS:
+        FONTS[key] = font.Font(family="Arial", size=size, weight=weight)
+    return FONTS[key]
+
+def get_glyph(move, state=None):
+    """Return the pre-rendered image for a move icon or input slot state"""
+    key = (move, state)
+    if key not in GLYPHS:
+        if state is None:
+            shapes = move_glyphs.move_shapes(move, COLORS)
+        else:
+            shapes = move_glyphs.slot_shapes(move, state, COLORS)
+        rows = move_glyphs.rasterize(shapes, COLORS["background"])
+        image = tk.PhotoImage(width=move_glyphs.SIZE, height=move_glyphs.SIZE)
+        image.put(" ".join("{" + " ".join(row) + "}" for row in rows))
+        GLYPHS[key] = image
+    return GLYPHS[key]
+
+def init_joystick():
+    """Initialize pygame's joystick support and return the first joystick, or None
+    
+    Only the subsystems joystick events need are started: not audio,
+    fonts or the rest of pygame.init().
+    """
+    if JOYSTICK["ready"]:
+        return JOYSTICK["device"]
+    
+    import pygame
+    if not pygame.display.get_init():
+        # pygame only delivers events once video is up; with the Tk renderer
+        # the dummy driver provides them without opening a display
+        if CONFIG["renderer"] != "sdl":
+            os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        pygame.display.init()
+    pygame.joystick.init()
+    
+    # Set up joystick
+    if pygame.joystick.get_count() > 0:
+        JOYSTICK["device"] = pygame.joystick.Joystick(0)
+        JOYSTICK["device"].init()
+        logging.info(f"Found joystick: {JOYSTICK['device'].get_name()}")
+    else:
+        logging.warning("No joystick detected!")
+    JOYSTICK["ready"] = True
+    return JOYSTICK["device"]
+
+def open_store():
+    """Open the code store for the configured code scheme"""
+    if CONFIG["code_scheme"] == "derived":
+        from derived_codes import DerivedCodeStore
+        return DerivedCodeStore()
+    if CONFIG["code_scheme"] == "remote":
+        from code_client import RemoteCodeStore
+        return RemoteCodeStore()
+    return open_code_store(CONFIG["code_store"], CONFIG["database"])
+
 class ValidationScreen:
     """Code validation screen with joystick input handling"""
     
-    def __init__(self, root, game_name):
-        """Initialize the validation screen"""
+    def __init__(self, root, game_name, store=None, controls=None, on_finish=None):
+        """Initialize the validation screen
+        
+        When on_finish is given it is called with the result instead of
+        destroying the window and exiting, and store and controls are kept
+        open by the caller (daemon mode).
+        """
+        self.opened = time.perf_counter()
         self.root = root
         self.game_name = game_name
+        self.store = store
+        self.own_store = store is None
+        self.shared_controls = controls
+        self.on_finish = on_finish
+        self.finished = False
         self.time_remaining = CONFIG["timeout"]
         self.timer_id = None
-        self.poll_id = None
+        self.redraw_id = None
+        self.fetch_id = None
+        self.dirty = set()  # Slot indices and "timer" awaiting a redraw
+        self.input_time = None  # When the move awaiting a redraw arrived
+        self.code_id = None
         self.expected_sequence = []
+        self.entry_length = 0  # Input slots: the longest live code's moves
         self.user_sequence = []
+        self.slot_correct = []
+        self.code_complete = False  # Entered moves spell out a live code
+        self.matched_code = None
+        self.no_codes = False  # Nothing can be entered; the screen times out
         self.entry_complete = False
         self.validation_result = False
-        self.last_input_time = 0  # For debouncing
-        
-        # Initialize pygame for joystick input
-        pygame.init()
-        pygame.joystick.init()
-        
-        # Set up joystick
-        self.joystick = None
-        if pygame.joystick.get_count() > 0:
-            self.joystick = pygame.joystick.Joystick(0)
-            self.joystick.init()
-            print(f"Found joystick: {self.joystick.get_name()}")
-        else:
-            print("No joystick detected!")
+        
+        # Set up joystick input (debounced per control by the backend)
+        self.controls = controls or joystick_input.open_controls(self.root, init_joystick)
+        self.controls.listen(self.handle_input)
             
-        # Load demo code
+        # Load a code to show
+        start = time.perf_counter()
         self.load_code()
+        CODE_LOAD.observe(time.perf_counter() - start)
             
-        # Build the UI
+        # Build the UI; Tk draws it on the next idle pass
         self.setup_ui()
+        self.root.after_idle(self.first_frame)
         
-        # Start input polling and timer
-        self.poll_id = self.root.after(50, self.poll_input)
+        # Start timer
         self.timer_id = self.root.after(1000, self.update_timer)
         
+        # A remote store may still be fetching this game's codes
+        fetch_pending = getattr(self.store, "fetch_pending", None)
+        if fetch_pending is not None and fetch_pending(self.game_name):
+            self.fetch_id = self.root.after(CONFIG["fetch_poll_ms"], self.watch_fetch)
+        
     def load_code(self):
-        """Load a code from the demo database"""
+        """Load the next usable code for this game from the code store
+        
+        Any live code for the game is accepted; this one is shown on
+        screen, and the longest live code sets the number of input slots.
+        """
         try:
-            if os.path.exists(CONFIG["database"]):
-                with open(CONFIG["database"], 'r') as f:
-                    codes = json.load(f)
-                    
-                # Find a code for this game
-                for code in codes:
-                    if code.get("game") == self.game_name and not code.get("used", False):
-                        # Check if code is expired
-                        if "expires_at" not in code or code["expires_at"] > time.time():
-                            self.expected_sequence = code.get("sequence", [])
-                            break
+            if self.store is None:
+                self.store = open_store()
+            code = self.store.next_code(self.game_name)
+                
+            if code:
+                self.code_id = code["id"]
+                self.expected_sequence = code["sequence"]
+                self.entry_length = self.store.max_length(self.game_name)
+            
+            # Running out of codes must not turn into free play, so the
+            # demo code is only offered when asked for (and never by a
+            # remote store, whose empty cache may just not be fetched yet)
+            demo = CONFIG["demo_code"] and getattr(self.store, "offers_demo_code", True)
+            if not self.expected_sequence and not demo:
+                logging.warning(f"No codes available for {self.game_name}")
+                self.no_codes = True
             
-            # If no valid code found or no database exists, use a demo code
-            if not self.expected_sequence:
-                print("Using demo code")
+            elif not self.expected_sequence:
+                logging.info("Using demo code")
                 self.expected_sequence = ["UP", "UP", "DOWN", "DOWN", "LEFT", "RIGHT", "LEFT", "RIGHT"]
                 
         except Exception as e:
-            print(f"Error loading code: {e}")
-            # Use a fallback code
-            self.expected_sequence = ["UP", "UP", "DOWN", "DOWN", "LEFT", "RIGHT", "LEFT", "RIGHT"]
+            # A broken store must not turn into free play with the demo code
+            logging.error(f"Error loading code: {e}")
+            self.code_id = None
+            self.expected_sequence = []
+            self.no_codes = True
+        self.entry_length = max(self.entry_length, len(self.expected_sequence))
+    
+    def watch_fetch(self):
+        """Reload the code once the store's fetch of this game finishes
+        
+        Until then a remote store has only its stale (or no) cached codes,
+        which would otherwise stand for the whole timeout.
+        """
+        self.fetch_id = None
+        if self.finished or self.validation_result or self.time_remaining <= 0:
+            return
+        # Wait out the fetch, and don't swap the code under a player entering one
+        if self.store.fetch_pending(self.game_name) or self.user_sequence:
+            self.fetch_id = self.root.after(CONFIG["fetch_poll_ms"], self.watch_fetch)
+            return
+        self.reload_code()
+    
+    def reload_code(self):
+        """Load the code again, rebuilding the screen if it changed"""
+        shown = (self.code_id, self.expected_sequence, self.entry_length, self.no_codes)
+        self.code_id, self.expected_sequence, self.entry_length, self.no_codes = None, [], 0, False
+        self.load_code()
+        if (self.code_id, self.expected_sequence, self.entry_length, self.no_codes) == shown:
+            return
+        if self.redraw_id:
+            self.root.after_cancel(self.redraw_id)
+            self.redraw_id = None
+        self.dirty = set()
+        self.frame.destroy()
+        self.setup_ui()
     
     def setup_ui(self):
         """Create the user interface"""
+        load_tk()
+        
         # Configure window
         self.root.title(f"Enter Code for {self.game_name}")
         self.root.configure(bg=COLORS["background"])
@@ -110,10 +274,14 @@ class ValidationScreen:
         if CONFIG["fullscreen"]:
             self.root.attributes("-fullscreen", True)
         
+        # Everything lives in one frame so a daemon can tear it down
+        self.frame = tk.Frame(self.root, bg=COLORS["background"])
+        self.frame.pack(fill=tk.BOTH, expand=True)
+        
         # Title
-        title_font = font.Font(family="Arial", size=32, weight="bold")
+        title_font = get_font(32, "bold")
         self.title = tk.Label(
-            self.root,
+            self.frame,
             text=self.game_name,
             fg=COLORS["highlight"],
             bg=COLORS["background"],
@@ -122,9 +290,9 @@ class ValidationScreen:
         self.title.pack(pady=(20, 5))
         
         # Instructions
-        instruction_font = font.Font(family="Arial", size=16)
+        instruction_font = get_font(16)
         self.instruction = tk.Label(
-            self.root,
+            self.frame,
             text="ENTER SECRET CODE TO PLAY",
             fg=COLORS["UP"],
             bg=COLORS["background"],
@@ -134,7 +302,7 @@ class ValidationScreen:
         
         # Code display frame
         self.code_frame = tk.Frame(
-            self.root,
+            self.frame,
             bg=COLORS["background"],
             highlightbackground=COLORS["highlight"],
             highlightthickness=2,
@@ -148,7 +316,7 @@ class ValidationScreen:
             text="ENTER THIS SEQUENCE:",
             fg=COLORS["text"],
             bg=COLORS["background"],
-            font=font.Font(family="Arial", size=12)
+            font=get_font(12)
         )
         code_label.pack(pady=(10, 5))
         
@@ -160,12 +328,12 @@ class ValidationScreen:
         self.sequence_frame.pack(pady=(5, 15))
         
         # Display the code sequence
-        for move in self.expected_sequence:
-            self.create_move_icon(self.sequence_frame, move)
+        for i, move in enumerate(self.expected_sequence):
+            self.create_move_icon(self.sequence_frame, move, i)
         
         # User input frame
         self.input_frame = tk.Frame(
-            self.root,
+            self.frame,
             bg=COLORS["background"],
             highlightbackground=COLORS["highlight"],
             highlightthickness=2,
@@ -179,7 +347,7 @@ class ValidationScreen:
             text="YOUR INPUT:",
             fg=COLORS["text"],
             bg=COLORS["background"],
-            font=font.Font(family="Arial", size=12)
+            font=get_font(12)
         )
         input_label.pack(pady=(10, 5))
         
@@ -192,32 +360,34 @@ class ValidationScreen:
         
         # Create empty slots for user input
         self.input_slots = []
-        for _ in range(len(self.expected_sequence)):
-            slot = tk.Canvas(
+        self.slot_images = []
+        per_row = CONFIG["moves_per_row"]
+        for i in range(self.entry_length):
+            image = get_glyph(None, "empty")
+            slot = tk.Label(
                 self.input_container,
-                width=40,
-                height=40,
+                image=image,
                 bg=COLORS["background"],
                 highlightbackground=COLORS["text"],
-                highlightthickness=1
+                highlightthickness=1,
+                bd=0
             )
-            # Draw dashed circle
-            slot.create_oval(5, 5, 35, 35, outline=COLORS["text"], dash=(3, 3))
-            slot.pack(side=tk.LEFT, padx=5)
+            slot.grid(row=i // per_row, column=i % per_row, padx=5, pady=2)
             self.input_slots.append(slot)
+            self.slot_images.append(image)
         
         # Status message
         self.status = tk.Label(
-            self.root,
-            text="ENTER FIRST MOVE...",
+            self.frame,
+            text=self.first_prompt(),
             fg=COLORS["text"],
             bg=COLORS["background"],
-            font=font.Font(family="Arial", size=14)
+            font=get_font(14)
         )
         self.status.pack(pady=(0, 15))
         
         # Timer bar
-        timer_frame = tk.Frame(self.root, bg=COLORS["background"])
+        timer_frame = tk.Frame(self.frame, bg=COLORS["background"])
         timer_frame.pack(fill=tk.X, padx=100, pady=(0, 15))
         
         self.timer_canvas = tk.Canvas(
@@ -235,178 +405,177 @@ class ValidationScreen:
             fill=COLORS["highlight"]
         )
         
+        self.timer_text = f"TIME REMAINING: {self.time_remaining} SEC"
+        self.timer_width = 600
         self.timer_label = tk.Label(
             timer_frame,
-            text=f"TIME REMAINING: {self.time_remaining} SEC",
+            text=self.timer_text,
             fg=COLORS["text"],
             bg=COLORS["background"],
-            font=font.Font(family="Arial", size=10)
+            font=get_font(10)
         )
         self.timer_label.pack(pady=(5, 0))
         
         # Help text
         help_text = tk.Label(
-            self.root,
+            self.frame,
             text="USE JOYSTICK AND BUTTONS TO ENTER CODE",
             fg="#aaaaaa",
             bg=COLORS["background"],
-            font=font.Font(family="Arial", size=10)
+            font=get_font(10)
         )
         help_text.pack(side=tk.BOTTOM, pady=15)
         
-        # Key bindings for keyboard fallback/testing
-        self.root.bind("<Up>", lambda e: self.handle_input("UP"))
-        self.root.bind("<Down>", lambda e: self.handle_input("DOWN"))
-        self.root.bind("<Left>", lambda e: self.handle_input("LEFT"))
-        self.root.bind("<Right>", lambda e: self.handle_input("RIGHT"))
-        self.root.bind("a", lambda e: self.handle_input("A"))
-        self.root.bind("b", lambda e: self.handle_input("B"))
-        self.root.bind("x", lambda e: self.handle_input("X"))
-        self.root.bind("y", lambda e: self.handle_input("Y"))
+        self.bind_keys()
+    
+    def bind_keys(self):
+        """Key bindings for keyboard fallback/testing"""
+        self.root.bind("<Up>", lambda e: self.controls.press("UP"))
+        self.root.bind("<Down>", lambda e: self.controls.press("DOWN"))
+        self.root.bind("<Left>", lambda e: self.controls.press("LEFT"))
+        self.root.bind("<Right>", lambda e: self.controls.press("RIGHT"))
+        self.root.bind("a", lambda e: self.controls.press("A"))
+        self.root.bind("b", lambda e: self.controls.press("B"))
+        self.root.bind("x", lambda e: self.controls.press("X"))
+        self.root.bind("y", lambda e: self.controls.press("Y"))
         self.root.bind("<Escape>", lambda e: self.cancel())
     
-    def create_move_icon(self, parent, move):
+    def create_move_icon(self, parent, move, index=0):
         """Create an icon representing a move"""
-        color = COLORS.get(move, COLORS["text"])
-        
-        # Create canvas for the icon
-        icon = tk.Canvas(
+        icon = tk.Label(
             parent,
-            width=40,
-            height=40,
+            image=get_glyph(move),
             bg=COLORS["background"],
-            highlightthickness=0
+            bd=0
         )
-        
-        # Draw the appropriate shape based on the move
-        if move == "UP":
-            icon.create_polygon(10, 30, 20, 10, 30, 30, fill=color)
-            icon.create_rectangle(15, 30, 25, 35, fill=color)
-        elif move == "DOWN":
-            icon.create_polygon(10, 10, 20, 30, 30, 10, fill=color)
-            icon.create_rectangle(15, 5, 25, 10, fill=color)
-        elif move == "LEFT":
-            icon.create_polygon(30, 10, 10, 20, 30, 30, fill=color)
-            icon.create_rectangle(30, 15, 35, 25, fill=color)
-        elif move == "RIGHT":
-            icon.create_polygon(10, 10, 30, 20, 10, 30, fill=color)
-            icon.create_rectangle(5, 15, 10, 25, fill=color)
-        else:  # Button
-            icon.create_oval(5, 5, 35, 35, fill=color, outline=COLORS["text"], width=2)
-            icon.create_text(20, 20, text=move, fill=COLORS["text"])
-        
-        icon.pack(side=tk.LEFT, padx=5)
+        per_row = CONFIG["moves_per_row"]
+        icon.grid(row=index // per_row, column=index % per_row, padx=5, pady=2)
         return icon
     
-    def poll_input(self):
-        """Poll for joystick input"""
-        if self.joystick and not self.entry_complete:
-            # Process pygame events
-            pygame.event.pump()
-            
-            # Check joystick position (with dead zone)
-            x_axis = self.joystick.get_axis(0)
-            y_axis = self.joystick.get_axis(1)
-            
-            # Use a threshold to avoid accidental inputs
-            if y_axis < -0.7:  # UP
-                self.handle_input("UP")
-            elif y_axis > 0.7:  # DOWN
-                self.handle_input("DOWN")
-            elif x_axis < -0.7:  # LEFT
-                self.handle_input("LEFT")
-            elif x_axis > 0.7:  # RIGHT
-                self.handle_input("RIGHT")
-            
-            # Check buttons
-            for i, btn in enumerate(["A", "B", "X", "Y"]):
-                if i < self.joystick.get_numbuttons() and self.joystick.get_button(i):
-                    self.handle_input(btn)
-        
-        # Schedule next poll if not complete
-        if not self.entry_complete:
-            self.poll_id = self.root.after(50, self.poll_input)
+    def first_prompt(self):
+        """Return the status line shown before the first move"""
+        return "NO CODES AVAILABLE" if self.no_codes else "ENTER FIRST MOVE..."
+    
+    def first_frame(self):
+        """Record how long the screen took to appear"""
+        FIRST_FRAME.observe(time.perf_counter() - self.opened)
     
     def handle_input(self, move):
         """Handle user input of a move"""
         # Ignore if entry is complete or input is full
-        if self.entry_complete or len(self.user_sequence) >= len(self.expected_sequence):
-            return
-        
-        # Simple debounce to prevent multiple inputs
-        current_time = time.time()
-        if current_time - self.last_input_time < 0.3:
+        if self.finished or self.entry_complete or len(self.user_sequence) >= self.entry_length:
             return
         
-        self.last_input_time = current_time
+        if self.input_time is None:
+            self.input_time = time.perf_counter()
         
         # Add the move
         self.user_sequence.append(move)
         
-        # Update display
-        self.update_user_input()
+        # Walk the prefix index one move further
+        is_live = self.check_prefix()
+        self.slot_correct.append(is_live)
+        
+        # Redraw the filled slot and the newly highlighted one
+        index = len(self.user_sequence) - 1
+        self.invalidate(index)
+        if index + 1 < self.entry_length:
+            self.invalidate(index + 1)
         
-        # Check if sequence is complete
-        if len(self.user_sequence) == len(self.expected_sequence):
+        # Finish on a complete code, a dead prefix or a full input
+        if self.code_complete or not is_live or len(self.user_sequence) == self.entry_length:
             self.entry_complete = True
             self.validate_sequence()
         else:
             # Update status for next input
             next_idx = len(self.user_sequence) + 1
-            total = len(self.expected_sequence)
+            total = self.entry_length
             self.status.config(text=f"ENTER NEXT MOVE ({next_idx}/{total})")
     
-    def update_user_input(self):
-        """Update the display of user input"""
-        for i, move in enumerate(self.user_sequence):
-            # Get the slot canvas
-            slot = self.input_slots[i]
-            
-            # Clear the slot
-            slot.delete("all")
-            
-            # Get color for this move
-            color = COLORS.get(move, COLORS["text"])
-            
-            # Draw the appropriate shape based on the move
-            if move == "UP":
-                slot.create_polygon(10, 30, 20, 10, 30, 30, fill=color)
-                slot.create_rectangle(15, 30, 25, 35, fill=color)
-            elif move == "DOWN":
-                slot.create_polygon(10, 10, 20, 30, 30, 10, fill=color)
-                slot.create_rectangle(15, 5, 25, 10, fill=color)
-            elif move == "LEFT":
-                slot.create_polygon(30, 10, 10, 20, 30, 30, fill=color)
-                slot.create_rectangle(30, 15, 35, 25, fill=color)
-            elif move == "RIGHT":
-                slot.create_polygon(10, 10, 30, 20, 10, 30, fill=color)
-                slot.create_rectangle(5, 15, 10, 25, fill=color)
-            else:  # Button
-                slot.create_oval(5, 5, 35, 35, fill=color, outline=COLORS["text"], width=2)
-                slot.create_text(20, 20, text=move, fill=COLORS["text"])
+    def glyph(self, move, state=None):
+        """Return the cached image for a move icon or slot state"""
+        return get_glyph(move, state)
+    
+    def slot_glyph(self, index):
+        """Return the image an input slot should currently show"""
+        if index < len(self.user_sequence):
+            move = self.user_sequence[index]
+            is_correct = self.slot_correct[index]
+            return self.glyph(move, "correct" if is_correct else "incorrect")
+        # Highlight the current position once entry has started
+        if index == len(self.user_sequence) and index > 0:
+            return self.glyph(None, "current")
+        return self.glyph(None, "empty")
+    
+    def invalidate(self, region):
+        """Mark a slot index or "timer" for redrawing on the next idle"""
+        self.dirty.add(region)
+        if not self.redraw_id:
+            self.redraw_id = self.root.after_idle(self.redraw)
+    
+    def redraw(self):
+        """Redraw only the regions that changed since the last redraw"""
+        self.redraw_id = None
+        dirty, self.dirty = self.dirty, set()
+        
+        for region in dirty:
+            if region == "timer":
+                continue
+            image = self.slot_glyph(region)
+            if image is not self.slot_images[region]:
+                self.input_slots[region].config(image=image)
+                self.slot_images[region] = image
+        
+        if "timer" in dirty:
+            text = f"TIME REMAINING: {self.time_remaining} SEC"
+            if text != self.timer_text:
+                self.timer_label.config(text=text)
+                self.timer_text = text
             
-            # Add indicator for correct/incorrect
-            is_correct = (i < len(self.expected_sequence) and move == self.expected_sequence[i])
-            indicator_color = COLORS["correct"] if is_correct else COLORS["incorrect"]
-            slot.create_oval(15, 35, 25, 45, fill=indicator_color)
-        
-        # Highlight the current position if not complete
-        if len(self.user_sequence) < len(self.expected_sequence):
-            current_idx = len(self.user_sequence)
-            self.input_slots[current_idx].create_oval(
-                0, 0, 40, 40,
-                outline=COLORS["highlight"],
-                width=2,
-                dash=(5, 3)
-            )
+            progress = max(self.time_remaining, 0) / CONFIG["timeout"]
+            bar_width = int(600 * progress)
+            if bar_width != self.timer_width:
+                self.timer_canvas.coords(self.timer_bar, 0, 0, bar_width, 20)
+                self.timer_width = bar_width
+        
+        if self.input_time is not None:
+            INPUT_LATENCY.observe(time.perf_counter() - self.input_time)
+            self.input_time = None
+    
+    def check_prefix(self):
+        """Check the moves entered so far against every live code
+        
+        Returns False as soon as no code starts with them, and sets
+        code_complete once they spell out a whole code.
+        """
+        if self.code_id is not None:
+            try:
+                code = self.store.find_code(self.game_name, self.user_sequence)
+                if code:
+                    self.code_complete = True
+                    self.matched_code = code["id"]
+                    return True
+                return self.store.has_prefix(self.game_name, self.user_sequence)
+            except Exception as e:
+                # Reject rather than fall back to the displayed sequence,
+                # which would then be accepted without being redeemed
+                logging.error(f"Error checking code: {e}")
+                return False
+        
+        # Demo code: only the displayed sequence works
+        entered = len(self.user_sequence)
+        if self.user_sequence != self.expected_sequence[:entered]:
+            return False
+        self.code_complete = entered == len(self.expected_sequence)
+        return True
     
     def validate_sequence(self):
-        """Check if the entered sequence matches the expected one"""
-        is_valid = (self.user_sequence == self.expected_sequence)
+        """Redeem the code the entered sequence matched, if any"""
+        is_valid = self.code_complete and self.mark_code_used()
         
+        OUTCOMES.inc("success" if is_valid else "incorrect")
         if is_valid:
             self.validation_result = True
-            self.mark_code_used()
             self.status.config(text="CODE CORRECT! LAUNCHING GAME...", fg=COLORS["correct"])
             self.root.after(2000, self.success)
         else:
@@ -414,101 +583,330 @@ class ValidationScreen:
             self.root.after(2000, self.reset_input)
     
     def mark_code_used(self):
-        """Mark the code as used in the database"""
+        """Redeem the matched code, returning False if it was already used"""
+        if self.matched_code is None:
+            return True  # Demo code
         try:
-            if os.path.exists(CONFIG["database"]):
-                with open(CONFIG["database"], 'r') as f:
-                    codes = json.load(f)
-                
-                # Find and mark the code
-                for code in codes:
-                    if code.get("game") == self.game_name and code.get("sequence") == self.expected_sequence:
-                        code["used"] = True
-                        code["used_at"] = int(time.time())
-                        break
-                
-                # Write back to database
-                with open(CONFIG["database"], 'w') as f:
-                    json.dump(codes, f, indent=2)
+            if not self.store.redeem(self.matched_code):
+                logging.warning(f"Code {self.matched_code} was already redeemed")
+                return False
         except Exception as e:
-            print(f"Error marking code as used: {e}")
+            # An unredeemed code could be used again, so reject the entry
+            logging.error(f"Error marking code as used: {e}")
+            return False
+        logging.info(f"Redeemed code {self.matched_code} for {self.game_name}")
+        return True
     
     def reset_input(self):
         """Reset the user input for another try"""
+        # Time may have run out while the wrong code was shown
+        if self.finished or self.time_remaining <= 0:
+            return
+        
         self.user_sequence = []
+        self.slot_correct = []
+        self.code_complete = False
+        self.matched_code = None
         self.entry_complete = False
         
         # Clear input slots
-        for slot in self.input_slots:
-            slot.delete("all")
-            slot.create_oval(5, 5, 35, 35, outline=COLORS["text"], dash=(3, 3))
+        for i in range(len(self.input_slots)):
+            self.invalidate(i)
         
         self.status.config(text="ENTER FIRST MOVE...", fg=COLORS["text"])
-        
-        # Restart input polling if needed
-        if not self.poll_id:
-            self.poll_id = self.root.after(50, self.poll_input)
     
     def update_timer(self):
         """Update the countdown timer"""
         self.time_remaining -= 1
         
-        # Update display
-        self.timer_label.config(text=f"TIME REMAINING: {self.time_remaining} SEC")
-        
-        # Update timer bar
-        progress = self.time_remaining / CONFIG["timeout"]
-        bar_width = int(600 * progress)
-        self.timer_canvas.coords(self.timer_bar, 0, 0, bar_width, 20)
+        # Update label and bar on the next redraw
+        self.invalidate("timer")
         
         # Check if time's up
         if self.time_remaining <= 0:
             self.entry_complete = True
+            OUTCOMES.inc("timeout")
             self.status.config(text="TIME'S UP! CODE EXPIRED.", fg=COLORS["incorrect"])
             self.root.after(2000, self.cancel)
             return
         
-        # Schedule next update if not complete
-        if not self.entry_complete:
+        # Keep counting down through incorrect attempts
+        if not self.validation_result:
             self.timer_id = self.root.after(1000, self.update_timer)
     
     def success(self):
         """Close with success"""
-        self.cleanup()
-        self.root.destroy()
-        sys.exit(0)  # Exit with success code
+        self.finish(True)
     
     def cancel(self):
         """Cancel and exit"""
+        self.finish(False)
+    
+    def finish(self, result):
+        """Close the screen and report the result"""
+        if self.finished:
+            return
+        self.finished = True
         self.cleanup()
+        
+        if self.on_finish:
+            # Daemon mode: keep the window and pygame alive for the next game
+            self.frame.destroy()
+            self.on_finish(result)
+            METRICS.flush()
+            return
+        
         self.root.destroy()
-        sys.exit(1)  # Exit with error code
+        METRICS.flush()
+        sys.exit(0 if result else 1)  # Exit code tells the hook the result
     
     def cleanup(self):
         """Clean up resources"""
         # Cancel any pending timers
         if self.timer_id:
             self.root.after_cancel(self.timer_id)
-        if self.poll_id:
-            self.root.after_cancel(self.poll_id)
+        if self.redraw_id:
+            self.root.after_cancel(self.redraw_id)
+        if self.fetch_id:
+            self.root.after_cancel(self.fetch_id)
+        
+        # Close the code store unless a daemon owns it
+        if self.own_store and self.store:
+            self.store.close()
+            self.store = None
+        
+        # Stop input, closing the device unless a daemon owns it
+        self.controls.listen(None)
+        if self.controls is not self.shared_controls:
+            self.controls.close()
+        
+        # Clean up pygame (if it was used) unless a daemon is keeping it warm
+        pygame = sys.modules.get("pygame")
+        if self.on_finish is None and pygame is not None:
+            if pygame.joystick.get_init() and pygame.joystick.get_count() > 0:
+                pygame.joystick.quit()
+            pygame.quit()
+
+class SdlValidationScreen(ValidationScreen):
+    """The validation screen drawn through pygame/SDL (KMS or framebuffer)
+    
+    root is an sdl_screen.SdlRoot. The layout matches the Tk screen, and
+    its parts take the same config calls, so input handling, redraws and
+    the timer are shared with ValidationScreen.
+    """
+    
+    def setup_ui(self):
+        """Draw the screen"""
+        per_row = CONFIG["moves_per_row"]
+        pitch = move_glyphs.SIZE + 10
+        import sdl_screen
+        layout = sdl_screen.Layout(self.root, COLORS)
+        self.frame = layout
+        
+        layout.text(self.game_name, COLORS["highlight"], 32, bold=True, before=20, after=5)
+        layout.text("ENTER SECRET CODE TO PLAY", COLORS["UP"], 16, after=20)
+        
+        # Code sequence
+        top = layout.y
+        layout.text("ENTER THIS SEQUENCE:", COLORS["text"], 12, before=10, after=5)
+        cells = layout.grid(len(self.expected_sequence), per_row, pitch, before=5, after=15)
+        for cell, move in zip(cells, self.expected_sequence):
+            self.root.surface.blit(self.glyph(move), cell)
+        layout.box(top, layout.y)
+        layout.y += 20
+        
+        # Input slots
+        top = layout.y
+        layout.text("YOUR INPUT:", COLORS["text"], 12, before=10, after=5)
+        cells = layout.grid(self.entry_length, per_row, pitch, before=5, after=15)
+        self.slot_images = [self.glyph(None, "empty") for _ in cells]
+        self.input_slots = [
+            sdl_screen.Slot(self.root, (x, y, move_glyphs.SIZE, move_glyphs.SIZE),
+                            COLORS["background"], COLORS["text"], image)
+            for (x, y), image in zip(cells, self.slot_images)
+        ]
+        layout.box(top, layout.y)
+        layout.y += 20
+        
+        self.status = layout.text(self.first_prompt(), COLORS["text"], 14, after=15)
         
-        # Clean up pygame
-        if pygame.joystick.get_count() > 0:
-            pygame.joystick.quit()
-        pygame.quit()
+        # Timer bar
+        self.timer_text = f"TIME REMAINING: {self.time_remaining} SEC"
+        self.timer_width = 600
+        self.timer_canvas = sdl_screen.TimerBar(
+            self.root, ((layout.width - 600) // 2, layout.y, 600, 20),
+            COLORS["background"], COLORS["highlight"], COLORS["text"])
+        self.timer_bar = None
+        layout.y += 20
+        self.timer_label = layout.text(self.timer_text, COLORS["text"], 10, before=5)
+        
+        layout.footer("USE JOYSTICK AND BUTTONS TO ENTER CODE", "#aaaaaa", 10, after=15)
+        self.bind_keys()
+        self.root.present()
+    
+    def glyph(self, move, state=None):
+        """Return the cached surface for a move icon or slot state"""
+        import sdl_screen
+        return sdl_screen.get_glyph(move, state, COLORS)
+
+def make_root():
+    """Create the root window for the configured renderer"""
+    if CONFIG["renderer"] == "sdl":
+        import sdl_screen
+        return sdl_screen.SdlRoot(CONFIG["fullscreen"])
+    load_tk()
+    return tk.Tk()
+
+def screen_class():
+    """Return the validation screen class for the configured renderer"""
+    if CONFIG["renderer"] == "sdl":
+        return SdlValidationScreen
+    return ValidationScreen
+
+class ValidationDaemon:
+    """Long-running validator that serves requests over a Unix socket
+    
+    Requests are JSON lines such as {"cmd": "validate", "game": "Pac-Man"};
+    the reply {"result": true/false} is sent once the player is done.
+    """
+    
+    def __init__(self, root, socket_path):
+        """Warm up pygame, the code store and fonts, then start listening"""
+        self.root = root
+        self.client = None
+        self.screen = None
+        
+        self.controls = joystick_input.open_controls(self.root, init_joystick)
+        if CONFIG["renderer"] == "sdl":
+            import sdl_screen
+            sdl_screen.get_font(32, True)
+        else:
+            get_font(32, "bold")
+        self.store = open_store()
+        
+        self.server = local_socket.listen(socket_path)
+        self.root.createfilehandler(self.server, joystick_input.READABLE, self.accept)
+        self.root.withdraw()
+        logging.info(f"Validation daemon listening on {socket_path}")
+    
+    def accept(self, server, mask):
+        """Handle a new connection from the runcommand hook"""
+        try:
+            conn, _ = self.server.accept()
+        except BlockingIOError:
+            return
+        try:
+            conn.settimeout(1.0)
+            message = local_socket.recv_message(conn)
+            if not message:
+                conn.close()
+                return
+            
+            if message.get("cmd") == "ping":
+                local_socket.send_message(conn, {"result": True})
+                conn.close()
+            elif message.get("cmd") == "validate" and message.get("game"):
+                if self.screen:
+                    # Only one player can be at the cabinet at a time
+                    local_socket.send_message(conn, {"result": False, "error": "busy"})
+                    conn.close()
+                    return
+                self.client = conn
+                self.start(message["game"])
+            else:
+                local_socket.send_message(conn, {"result": False, "error": "bad request"})
+                conn.close()
+        except (OSError, ValueError) as e:
+            logging.error(f"Error handling request: {e}")
+            conn.close()
+    
+    def start(self, game_name):
+        """Show the validation screen for a game"""
+        self.root.deiconify()
+        self.screen = screen_class()(self.root, game_name, store=self.store,
+                                     controls=self.controls, on_finish=self.finish)
+    
+    def finish(self, result):
+        """Send the result back to the hook and hide the window"""
+        self.screen = None
+        self.root.withdraw()
+        try:
+            local_socket.send_message(self.client, {"result": result})
+        except OSError as e:
+            logging.error(f"Error sending result: {e}")
+        finally:
+            self.client.close()
+            self.client = None
+
+def process_age():
+    """Return seconds since this process started (10 ms resolution)"""
+    with open("/proc/self/stat", "rb") as f:
+        stat = f.read()
+    start_ticks = int(stat[stat.rindex(b")") + 2:].split()[19])
+    with open("/proc/uptime") as f:
+        uptime = float(f.read().split()[0])
+    return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+
+def profile_startup(game_name):
+    """Open the screen once and report startup costs against CONFIG["budgets"]
+    
+    Reports import time, time from process start to the first frame and
+    peak RSS, then exits non-zero if any is over budget.
+    """
+    import resource
+    root = make_root()
+    screen = screen_class()(root, game_name, on_finish=lambda result: None)
+    
+    def report():
+        if CONFIG["renderer"] == "sdl":
+            root.present()
+        else:
+            root.update_idletasks()
+        results = {
+            "import_ms": (IMPORTED - IMPORT_STARTED) * 1000,
+            "first_frame_ms": process_age() * 1000,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        }
+        over = False
+        for name, value in results.items():
+            budget = CONFIG["budgets"][name]
+            verdict = "OVER BUDGET" if value > budget else "ok"
+            over = over or value > budget
+            print(f"{name:15} {value:8.1f}  budget {budget:6}  {verdict}")
+            logging.info(f"Startup {name} {value:.1f} (budget {budget})")
+        screen.cleanup()
+        root.destroy()
+        sys.exit(1 if over else 0)
+    
+    root.after_idle(report)
+    root.mainloop()
 
 def main():
     """Main entry point"""
     # Check command line arguments
     if len(sys.argv) < 2:
         print("Usage: python validation_screen.py <game_name>")
+        print("       python validation_screen.py --daemon")
+        print("       python validation_screen.py --profile [game_name]")
         sys.exit(1)
     
+    arcade_log.setup("validation")
+    
+    if sys.argv[1] == "--daemon":
+        root = make_root()
+        daemon = ValidationDaemon(root, CONFIG["socket"])
+        root.mainloop()
+        return
+    
+    if sys.argv[1] == "--profile":
+        profile_startup(sys.argv[2] if len(sys.argv) > 2 else "Profile")
+        return
+    
     game_name = sys.argv[1]
     
     # Create and run the validation screen
-    root = tk.Tk()
-    app = ValidationScreen(root, game_name)
+    root = make_root()
+    app = screen_class()(root, game_name)
     root.mainloop()
 
 if __name__ == "__main__":
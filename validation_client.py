@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Arcade Payment System - Validation Client
+Asks the validation daemon to validate a game, falling back to the
+one-shot validation screen when the daemon isn't running
+"""
+import os
+import sys
+import logging
+import local_socket
+
+# Configuration
+CONFIG = {
+    "socket": "/home/pi/arcade/run/validation.sock",  # Daemon socket
+    "validation_screen": "/home/pi/arcade/validation_screen.py"  # One-shot fallback
+}
+
+def validate(game_name):
+    """Return the daemon's verdict for game_name, or None if it isn't running"""
+    try:
+        reply = local_socket.request(CONFIG["socket"], {"cmd": "validate", "game": game_name})
+    except OSError as e:
+        logging.warning(f"Validation daemon unavailable: {e}")
+        return None
+    if reply.get("error"):
+        logging.error(f"Validation daemon error: {reply['error']}")
+    return bool(reply.get("result"))
+
+def validate_or_run(game_name):
+    """Return True if a code was accepted, through the daemon or, if it
+    isn't running, a one-shot validation screen"""
+    result = validate(game_name)
+    if result is None:
+        result = os.spawnv(os.P_WAIT, sys.executable,
+                           [sys.executable, CONFIG["validation_screen"], game_name]) == 0
+    return result
+
+def main():
+    """Main entry point"""
+    if len(sys.argv) < 2:
+        print("Usage: python validation_client.py <game_name>")
+        sys.exit(1)
+    
+    game_name = sys.argv[1]
+    result = validate(game_name)
+    
+    if result is None:
+        # Fall back to the one-shot validation screen
+        os.execv(sys.executable, [sys.executable, CONFIG["validation_screen"], game_name])
+    
+    sys.exit(0 if result else 1)
+
+if __name__ == "__main__":
+    main()